@@ -36,6 +36,11 @@ import c42api
 from c42splunk.common import CONFIG
 from c42splunk.common import ANALYTICS_DIR
 
+# The limits on the requests made to the authority, across every collector thread.
+AUTHORITY_REQUESTS_PER_SECOND = 20
+AUTHORITY_BURST = 10
+AUTHORITY_MAX_IN_FLIGHT = 8
+
 
 def setup():
     """
@@ -51,7 +56,10 @@ def setup():
     CONFIG.initialize(key)
     server = c42api.Server(config_dict['hostname'], port=config_dict['port'],
                            username=config_dict['username'], password=config_dict['password'],
-                           verify_ssl=config_dict['verify_ssl'])
+                           verify_ssl=config_dict['verify_ssl'],
+                           pool_size=max(AUTHORITY_MAX_IN_FLIGHT, c42api.storage_server.NODE_MAX_IN_FLIGHT),
+                           throttle=c42api.Throttle(rate=AUTHORITY_REQUESTS_PER_SECOND, burst=AUTHORITY_BURST,
+                                                    max_in_flight=AUTHORITY_MAX_IN_FLIGHT))
     if config_dict['collect_analytics']:
         c42api.common.analytics.OUTPUT_DIRECTORY = ANALYTICS_DIR
     log_file = os.path.join(app_home(), 'log', 'code42.log')
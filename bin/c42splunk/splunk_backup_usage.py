@@ -30,6 +30,8 @@ import sys
 from common import splunk_common as common
 import c42api
 
+PAGE_PREFETCH = 4
+
 
 def _run():
     """
@@ -40,8 +42,9 @@ def _run():
     params = {'active': 'true',
               'incBackupUsage': True,
               'incHistory': True}
-    results = c42api.fetch_computers(server, params, insert_schema_version=True)
+    results = c42api.fetch_computers(server, params, insert_schema_version=True, prefetch=PAGE_PREFETCH)
     timestamp = datetime.datetime.now().isoformat()
+    writer = c42api.SplunkEventWriter(sys.stdout)
     for result in results:
         guid = result['guid']
         schema_version = result['schema_version']
@@ -50,7 +53,8 @@ def _run():
             backup_usage['guid'] = guid
             backup_usage['timestamp'] = timestamp
             backup_usage['schema_version'] = schema_version
-        c42api.write_json_splunk(sys.stdout, backup_usage_array)
+        writer.write_events(backup_usage_array)
+    writer.close()
 
 
 if __name__ == '__main__':
@@ -26,6 +26,7 @@ import shutil
 import getpass
 import sys
 import subprocess
+import tempfile
 
 # pylint: disable=relative-import, import-error
 from common import CONFIG, EVENTS_DIR, ANALYTICS_DIR
@@ -99,7 +100,6 @@ def _output_query_to_file(query, output_file, username, password):
     subprocess.call(query, stdout=output_file)
 
 
-@analytics.with_lock
 def _run():
     """
     The scripts body. Captures json data from Splunk concerning the Code42 App
@@ -113,14 +113,22 @@ def _run():
     with open(QUERY_FILE, 'r') as query_file:
         queries = _extract_queries(query_file)
 
-    # write out the results of each query to its own file
-    for name, query in queries.items():
-        out_file = os.path.join(ANALYTICS_DIR, name + '.json')
-        with open(out_file, 'w+') as out:
-            _output_query_to_file(query, out, username, password)
-
-    # zip it up and delete the json files.
-    archive_path = shutil.make_archive(ANALYTICS_DIR, 'zip', ANALYTICS_DIR)
+    # The analytics files are rings of segments, so export their current windows as json files to be zipped.
+    staging_dir = tempfile.mkdtemp()
+    try:
+        analytics.OUTPUT_DIRECTORY = ANALYTICS_DIR
+        analytics.export_json_lines(staging_dir)
+
+        # write out the results of each query to its own file
+        for name, query in queries.items():
+            out_file = os.path.join(staging_dir, name + '.json')
+            with open(out_file, 'w+') as out:
+                _output_query_to_file(query, out, username, password)
+
+        # zip it up and delete the json files.
+        archive_path = shutil.make_archive(ANALYTICS_DIR, 'zip', staging_dir)
+    finally:
+        shutil.rmtree(staging_dir)
     shutil.rmtree(ANALYTICS_DIR)
     os.mkdir(ANALYTICS_DIR)
 
@@ -35,6 +35,7 @@ COMPUTER_KEYS_TO_IGNORE = ['lastConnected',
                            'modificationDate',
                            'loginDate']
 COMPUTER_UID_KEY = 'guid'
+PAGE_PREFETCH = 4
 
 
 def _run():
@@ -46,6 +47,7 @@ def _run():
     lookups_dir = os.path.join(app_home, "lookups")
     old_computer_lookup_table = os.path.join(lookups_dir, "computer_lookup.csv")
     tmp_computer_lookup_table = os.path.join(lookups_dir, "computer_lookup_tmp.csv")
+    computer_lookup_index = os.path.join(lookups_dir, "computer_lookup_index.db")
 
     if not os.path.exists(lookups_dir):
         os.makedirs(lookups_dir)
@@ -56,9 +58,11 @@ def _run():
     params = {'active': 'true',
               'incBackupUsage': False,
               'incHistory': False}
-    computer_results = c42api.fetch_computers(server, params, insert_schema_version=True)
+    computer_results = c42api.fetch_computers(server, params, insert_schema_version=True,
+                                              prefetch=PAGE_PREFETCH)
     splunk_lookup_table.write_lookup_table(old_computer_lookup_table, tmp_computer_lookup_table, computer_results,
-                                           COMPUTER_UID_KEY, COMPUTER_KEYS_TO_IGNORE, TIME_KEY)
+                                           COMPUTER_UID_KEY, COMPUTER_KEYS_TO_IGNORE, TIME_KEY,
+                                           index_path=computer_lookup_index)
 
 if __name__ == '__main__':
     _run()
@@ -24,37 +24,13 @@ security detection events to stdout. This is intended to be called by Splunk.
 """
 # pylint: disable=import-error, relative-import
 import os
-import json
-from datetime import datetime
 
 from common import splunk_common as common
 import c42api
 
-
-def _try_read_timestamp(timestamp_path):
-    """
-    If timestamp exists at path, read it and return the value. Otherwise do nothing.
-
-    :param timestamp_path: Path to find timestamp
-    :return: dictionary (of {guid-> "<timestamp in ISO format>"}) read from
-             timestamp file
-    """
-    if not os.path.exists(timestamp_path):
-        return None
-    with open(timestamp_path, 'r') as timestamp_file:
-        return json.load(timestamp_file)
-
-
-def _write_min_timestamps(next_minTs_path, timestamp_dict):
-    """
-    Write value to timestamp file, even if it doesn't exist.
-
-    :param next_minTs_path:  Where to find/create timestamp file
-    :param timestamp_dict:   Dict holding Value to write to minTs file. This value is dictionary entries 
-                             of deviceGuid -> string in ISO format example: '2017-04-11T19:11:40.000Z'
-    """
-    with open(next_minTs_path, 'w+') as minTs_file:
-        json.dump(timestamp_dict, minTs_file)
+# The most devices fetched at once. The requests actually in flight to each storage node adapt to its
+# latency and errors, so this only needs to be large enough to keep the fastest nodes busy.
+DEVICE_THREAD_COUNT = 16
 
 
 def _run():
@@ -77,26 +53,36 @@ def _run():
     devices = config_dict['devices']
     device_guids = c42api.devices(server, devices)
 
-    timestamp_dict = _try_read_timestamp(minTs_file_path)
-    event_filters = []
+    # Both files used to be JSON dictionaries of deviceGuid -> value. They are now checkpoint stores, committed
+    # as soon as each device finishes, so a crash or timeout part way through a run keeps every finished device.
+    minTs_store = c42api.CheckpointStore(minTs_file_path + '.db', legacy_json_path=minTs_file_path)
+    # Devices that have never been fetched are backfilled from the epoch in windows of time, fetched concurrently.
+    # The windows finished so far are kept at 'backfill_path', so an interrupted backfill resumes where it stopped.
+    backfill_path = os.path.join(events_dir, 'security-backfill.db')
+    guids_and_filters = []
+    backfill_guids = []
     for device_guid in device_guids:
         try:
-            minTs = timestamp_dict[device_guid]
+            minTs = minTs_store.get(device_guid)
             event_filter = c42api.create_filter_by_iso_minTs_and_now(minTs)
-            event_filters.append(event_filter)
-        except (KeyError, TypeError):
-            event_filter = c42api.create_filter_by_utc_datetime(datetime.utcfromtimestamp(0), datetime.utcnow())
-            event_filters.append(event_filter)
-
-    guids_and_filters = zip(device_guids, event_filters)
-
-    timestamp_dict = timestamp_dict if timestamp_dict else {}
-    for guid, new_minTs in c42api.fetch_detection_events(server, guids_and_filters, cursor_path):
-        if not new_minTs:
-            continue
-        timestamp_dict[guid] = new_minTs
-
-    _write_min_timestamps(minTs_file_path, timestamp_dict)
+            guids_and_filters.append((device_guid, event_filter))
+        except ValueError:
+            backfill_guids.append(device_guid)
+
+    try:
+        if backfill_guids:
+            for guid, new_minTs in c42api.backfill_detection_events(server, backfill_guids, cursor_path, backfill_path,
+                                                                    num_threads=DEVICE_THREAD_COUNT):
+                if not new_minTs:
+                    continue
+                minTs_store.put(guid, new_minTs)
+        for guid, new_minTs in c42api.fetch_detection_events(server, guids_and_filters, cursor_path,
+                                                              num_threads=DEVICE_THREAD_COUNT):
+            if not new_minTs:
+                continue
+            minTs_store.put(guid, new_minTs)
+    finally:
+        minTs_store.close()
 
 
 if __name__ == '__main__':
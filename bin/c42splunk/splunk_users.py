@@ -33,6 +33,7 @@ from splunk_utils import splunk_lookup_table
 TIME_KEY = 'modificationDate'
 USER_KEYS_TO_IGNORE = ['modificationDate']
 USER_UID_KEY = 'userUid'
+PAGE_PREFETCH = 4
 
 
 def _run():
@@ -44,6 +45,7 @@ def _run():
     lookups_dir = os.path.join(app_home, "lookups")
     old_user_lookup_table = os.path.join(lookups_dir, "user_lookup.csv")
     tmp_user_lookup_table = os.path.join(lookups_dir, "user_lookup_tmp.csv")
+    user_lookup_index = os.path.join(lookups_dir, "user_lookup_index.db")
 
     if not os.path.exists(lookups_dir):
         os.makedirs(lookups_dir)
@@ -51,9 +53,10 @@ def _run():
     server, _ = common.setup()
 
     # write user lookup table
-    user_results = c42api.fetch_users(server)
+    user_results = c42api.fetch_users(server, prefetch=PAGE_PREFETCH)
     splunk_lookup_table.write_lookup_table(old_user_lookup_table, tmp_user_lookup_table, user_results,
-                                           USER_UID_KEY, USER_KEYS_TO_IGNORE, TIME_KEY)
+                                           USER_UID_KEY, USER_KEYS_TO_IGNORE, TIME_KEY,
+                                           index_path=user_lookup_index)
 
 
 if __name__ == '__main__':
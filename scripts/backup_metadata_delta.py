@@ -21,8 +21,8 @@
 # SOFTWARE.
 
 """
-Calculate and display changes in files of backup data for a single device on a
-Code42 installation.
+Calculate and display changes in files of backup data for one or more devices
+on a Code42 installation.
 """
 
 # pylint: disable=import-error
@@ -31,6 +31,7 @@ import sys
 import argparse
 import datetime
 import logging
+import multiprocessing
 from dateutil import parser as date_parser
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'utils'))
@@ -56,7 +57,7 @@ def _byte_format(num):
     return "%.1f %s" % (num, 'YB')
 
 
-def _custom_output(out, events, allow_color=True):
+def _custom_output(out, events, allow_color=True, show_device=False):
     """
     Write custom formatted output where each line contains statically organized
     information about a file version using a variety of separators for visual
@@ -66,6 +67,8 @@ def _custom_output(out, events, allow_color=True):
     :param events (iterable[obj]): A list of events to iteratively write out.
     :param allow_color (bool):     Whether XTERM colors should be allowed when
                                        available.
+    :param show_device (bool):     Whether to write the deviceGuid even to
+                                       STDIO, e.g. for many devices.
     """
 
     if os.name == 'nt':
@@ -89,8 +92,9 @@ def _custom_output(out, events, allow_color=True):
             out.write(color_start)
 
         out.write(shape)
-        if out is not sys.stdout:
-            # Write the deviceGuid if we are writing our custom format to disk.
+        if out is not sys.stdout or show_device:
+            # Write the deviceGuid if we are writing our custom format to disk
+            # or the events come from more than one device.
             out.write(" %s" % event['deviceGuid'])
         out.write(" %s" % event['files'][0]['fullPath'])
         if event['files'][0]['MD5Hash']:
@@ -119,7 +123,7 @@ def _outline(args):
         LOG.info("Resolving Backup Selection Delta to " + args.output)
     else:
         LOG.info("Resolving Backup Selection Delta")
-    LOG.info("Device:\t\t" + args.device)
+    LOG.info("Device:\t\t" + (args.device or 'all'))
     LOG.info("Base date:\t\t" + args.date1.isoformat())
     LOG.info("Second date:\t\t" + args.date2.isoformat())
     if ((args.hostname.startswith('https:') and args.port == 443) or
@@ -136,8 +140,24 @@ def _run():
     """Initializes the state for the script based on command line input."""
     arg_parser = argparse.ArgumentParser()
     args = _setup_args(arg_parser)
-    if not args.device:
-        raise ValueError("Device is required.")
+    # The delta's worker processes are forked before any threads are started, so they inherit no held locks.
+    pool = multiprocessing.Pool(args.processes) if args.processes != 0 else None
+    try:
+        _calculate(args, pool)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def _calculate(args, pool):
+    """
+    Writes out the delta the command line asks for.
+
+    :param args (argparse.Namespace): Prepared arguments that will be used for
+                                          parameters.
+    :param pool (Pool):               The worker processes for a fleet delta, or None
+    """
     if args.format != 'custom' and not args.output:
         # Writing non-custom output to STDOUT, so boost the log message level.
         c42api.set_log_level(logging.ERROR)
@@ -145,13 +165,22 @@ def _run():
     server = argutil.server_from_args(args)
 
     devices = c42api.devices(server, args.device)
-    if len(devices) != 1:
-        raise ValueError("*** THIS SCRIPT ONLY SUPPORTS A SINGLE DEVICE ***")
+    if not devices:
+        raise ValueError("No devices match the query.")
 
-    events = c42api.calculate_delta(server, devices[0], args.date1, args.date2)
+    if len(devices) == 1:
+        events = c42api.calculate_delta(server, devices[0], args.date1, args.date2,
+                                        include_dirs=args.folders)
+    else:
+        events = c42api.calculate_fleet_delta(server, devices, args.date1, args.date2,
+                                              include_dirs=args.folders,
+                                              num_threads=args.threads,
+                                              num_processes=args.processes,
+                                              sort_buffer_size=args.sort_buffer,
+                                              pool=pool)
     with c42api.common.smart_open(args.output, overwrite=True) as out:
         if args.format == 'custom':
-            _custom_output(out, events, allow_color=args.color)
+            _custom_output(out, events, allow_color=args.color, show_device=len(devices) > 1)
         elif args.format == 'json':
             c42api.write_json(out, events)
         elif args.format == 'csv':
@@ -173,6 +202,14 @@ def _setup_args(arg_parser):
     arg_parser.add_argument('--no-color', default=True, dest='color', action='store_false',
                             help='''Prevent XTERM colors for custom output even when
                             available (does not apply on Windows).''')
+    arg_parser.add_argument('--threads', type=int, default=c42api.backup_metadata_delta.FLEET_THREADS,
+                            help='Number of devices to download backup metadata for at once.')
+    arg_parser.add_argument('--processes', type=int, default=None,
+                            help='''Number of processes parsing backup metadata when
+                            there are many devices (defaults to one per CPU).''')
+    arg_parser.add_argument('--sort-buffer', type=int, dest='sort_buffer',
+                            default=c42api.backup_metadata_delta.SORT_BUFFER_SIZE,
+                            help='Most file versions held in memory per device while sorting.')
     return arg_parser.parse_args()
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark for the JSON backends c42api can use. Times decoding pages of
+detection events and encoding the unbatched events with every installed
+backend, and with the stdlib json module's defaults for comparison.
+"""
+
+# pylint: disable=import-error
+import os
+import sys
+import argparse
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'utils'))
+from c42api.common import json_codec
+
+
+def _event_page(events, files_per_event):
+    """
+    :param events:          The number of detection events on the page
+    :param files_per_event: The number of files batched into each event
+    :return:                The page's JSON, as the server sends it
+    """
+    detection_events = []
+    for i in range(events):
+        files = [{'fileName': u'report-{}.docx'.format(j),
+                  'fullPath': u'C:/Users/someone/Documents/report-{}.docx'.format(j),
+                  'length': 1024 * j,
+                  'MD5Hash': '6666cd76f96956469e7be39d750cc7d9',
+                  'detectionTimestamp': '2016-03-01T12:00:{:02d}.000Z'.format(j % 60),
+                  'fileEventType': 'MODIFIED'} for j in range(files_per_event)]
+        detection_events.append({'eventType': 'PERSONAL_CLOUD_FILE_ACTIVITY',
+                                 'eventUid': 'event-{}'.format(i),
+                                 'deviceGuid': 123456789012345678,
+                                 'deviceAddress': '10.0.0.1',
+                                 'formattedTimestamp': '2016-03-01T12:00:00.000Z',
+                                 'cloudStorageProvider': 'Dropbox',
+                                 'schema_version': 1,
+                                 'files': files})
+    return json.dumps({'data': {'securityDetectionEvents': detection_events}})
+
+
+def _run():
+    """Times every backend on the same page and prints the results."""
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--events', type=int, default=250, help='Detection events per page.')
+    arg_parser.add_argument('--files', type=int, default=20, help='Files batched into each event.')
+    arg_parser.add_argument('-n', '--repeat', type=int, default=20, help='Times to decode and encode the page.')
+    args = arg_parser.parse_args()
+
+    page = _event_page(args.events, args.files)
+    events = json.loads(page)['data']['securityDetectionEvents']
+    lines = [dict(event, file=file_dict) for event in events for file_dict in event['files']]
+    print('{} byte page, {} unbatched events, {} repeats'.format(len(page), len(lines), args.repeat))
+
+    candidates = [('json defaults', json.dumps, json.loads)]
+    for name in json_codec.available_backends():
+        json_codec.set_backend(name)
+        candidates.append((name, json_codec.dumps, json_codec.loads))
+    for name, dumps, loads in candidates:
+        decode = timeit.timeit(lambda: loads(page), number=args.repeat)
+        encode = timeit.timeit(lambda: [dumps(line) for line in lines], number=args.repeat)
+        size = sum(len(dumps(line)) + 1 for line in lines)
+        print('{:<14} decode {:.3f}s  encode {:.3f}s  output {} bytes'.format(name, decode, encode, size))
+
+
+if __name__ == '__main__':
+    _run()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Micro-benchmark for calculate_delta's versionTimestamp filter. Times the
+fixed-format filter against parsing every timestamp with dateutil on a
+synthetic archive of file versions.
+"""
+
+# pylint: disable=import-error
+import os
+import sys
+import argparse
+import datetime
+import random
+import timeit
+from dateutil import parser as date_parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'utils'))
+from c42api import backup_metadata_delta
+
+
+def _synthetic_timestamps(count):
+    """
+    :param count: The number of timestamps to make
+    :return:      A list of versionTimestamps spread over a year
+    """
+    start = datetime.datetime(2015, 1, 1)
+    rand = random.Random(42)
+    timestamps = []
+    for _ in range(count):
+        value = start + datetime.timedelta(milliseconds=rand.randint(0, 365 * 24 * 3600 * 1000))
+        timestamps.append(value.strftime('%Y-%m-%dT%H:%M:%S.') + '%03d-05:00' % (value.microsecond // 1000))
+    return timestamps
+
+
+def _run():
+    """Times both filters over the synthetic archive and prints the results."""
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('-n', '--versions', type=int, default=1000000,
+                            help='The number of synthetic file versions to filter.')
+    args = arg_parser.parse_args()
+
+    timestamps = _synthetic_timestamps(args.versions)
+    min_date = datetime.datetime(2015, 4, 1)
+    max_date = datetime.datetime(2015, 10, 1)
+    in_range = backup_metadata_delta.timestamp_filter(min_date, max_date)
+
+    def dateutil_filter():
+        """Parses every timestamp, as calculate_delta used to"""
+        # pylint: disable=no-member
+        return sum(1 for x in timestamps if min_date < date_parser.parse(x).replace(tzinfo=None) < max_date)
+
+    def fixed_format_filter():
+        """Compares every timestamp without parsing it"""
+        return sum(1 for x in timestamps if in_range(x))
+
+    assert dateutil_filter() == fixed_format_filter()
+    fixed_seconds = min(timeit.repeat(fixed_format_filter, number=1, repeat=3))
+    dateutil_seconds = timeit.timeit(dateutil_filter, number=1)
+    print('{} versions'.format(args.versions))
+    print('dateutil:     {:.2f}s'.format(dateutil_seconds))
+    print('fixed format: {:.2f}s'.format(fixed_seconds))
+    print('speedup:      {:.1f}x'.format(dateutil_seconds / fixed_seconds))
+
+
+if __name__ == '__main__':
+    _run()
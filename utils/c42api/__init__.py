@@ -28,16 +28,20 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 # pylint: disable=relative-import
-from backup_metadata_delta import calculate_delta
+from backup_metadata_delta import calculate_delta, calculate_fleet_delta, calculate_incremental_delta
 from computers import fetch_computers
 from query import organization, devices
-from security_event_restore import fetch_detection_events, create_filter_by_utc_datetime, create_filter_by_cursor, create_filter_by_iso_minTs_and_now
+from security_event_restore import fetch_detection_events, backfill_detection_events, create_filter_by_utc_datetime, create_filter_by_cursor, create_filter_by_iso_minTs_and_now
 from storage_server import storage_servers
 from users import fetch_users
 
 from common.logging_config import set_log_file, set_log_level, get_logger
 from common import resources
-from common.script_output import write_csv, write_header_from_keyset, write_json, write_json_splunk
+from common.checkpoint import CheckpointStore
+from common.script_output import write_csv, write_header_from_keyset, write_json, write_json_splunk, SplunkEventWriter
+from common.retry import RetryPolicy
 from common.server import Server
+from common.throttle import Throttle
+from common.concurrency import AdaptiveConcurrency
 
 from requests.exceptions import ConnectionError, HTTPError, RequestException
@@ -25,21 +25,40 @@ Using ArchiveMetadata (API), calculate the changes that have happened for a devi
 backup over a time range, such as files created or modified (new versions created),
 and files deleted (empty file version).
 
-**************************************************************************************
-*** THIS SCRIPT DOES NOT PERFORM AT SCALE, AND CAN ONLY BE RUN FOR A SINGLE DEVICE ***
-**************************************************************************************
+File versions are sorted with a bounded amount of memory, spilling to
+temporary files past SORT_BUFFER_SIZE versions. calculate_fleet_delta does
+the same for many devices at once, and calculate_incremental_delta only
+looks at versions newer than the device's last snapshot.
 """
 
 from dateutil import parser
 from datetime import datetime
+import calendar
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import requests
 
 import c42api.storage_server as fetch_storage
+from c42api import backup_snapshot
 from c42api.common import logging_config
 from c42api.common import resources
 from c42api.common import analytics
+from c42api.common import json_codec
+from c42api.common import json_stream
+from c42api.common.executor import Executor
+from c42api.common.external_sort import external_sort
 
 SCHEMA_VERSION = 1
 DELETED_CHECKSUM = 'ffffffffffffffffffffffffffffffff'
+# The most file versions held in memory while sorting before spilling to disk.
+SORT_BUFFER_SIZE = 200000
+# The number of devices whose metadata is downloaded at once by a fleet delta.
+FLEET_THREADS = 4
+# The versionTimestamp format the server sends, e.g. 2015-08-14T13:22:10.750-05:00
+_VERSION_TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}(?:Z|([+-])(\d\d):?(\d\d))?$')
 
 LOG = logging_config.get_logger(__name__)
 
@@ -59,24 +78,104 @@ def unicode_str_replace(string):
     return string.replace("\\", "\\\\").encode('ascii', 'ignore').decode('unicode_escape')
 
 
-def calculate_delta(server, device_guid, min_date, max_date, include_dirs=True):
+def _sortable_timestamp(value):
     """
-    Calculate a backup selection metadata delta between two dates for a computer.
+    Formats a naive datetime as a fixed-width string that sorts the same way
+    the datetimes do.
 
-    Using ArchiveMetadata (API), calculate the changes that have happened for a device
-    backup over a time range, such as files created or modified (new versions created),
-    and files deleted (empty file version).
+    :param value: The datetime to format
+    :return:      The string, e.g. 2015-08-14T13:22:10.750000
+    """
+    return '%04d-%02d-%02dT%02d:%02d:%02d.%06d' % (value.year, value.month, value.day, value.hour,
+                                                   value.minute, value.second, value.microsecond)
 
-    Args:
-        device_guid (str):       Device GUID for delta calculation.
-        minimum_date (datetime): Date for the base during delta calculation.
-        maximum_date (datetime): Date for the opposing delta calculation.
-        include_folders (bool):  Whether folders should be included in results.
-        server (Server):         Master server containing device backup routing information.
 
-    Returns:
-        list: List of all file version events as objects.
+def _version_time(timestamp):
+    """
+    Converts a versionTimestamp to UTC epoch milliseconds. As in
+    timestamp_filter, timestamps in the server's usual format aren't parsed
+    with dateutil. Unlike it, the UTC offset is applied, so versions backed
+    up either side of a daylight saving change stay in order. A timestamp
+    without an offset is taken to be UTC.
+
+    :param timestamp: A versionTimestamp string
+    :return:          Its time as UTC epoch milliseconds
+    """
+    match = _VERSION_TIMESTAMP.match(timestamp)
+    if not match:
+        # pylint: disable=no-member
+        value = parser.parse(timestamp)
+        if value.utcoffset():
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+    seconds = calendar.timegm((int(timestamp[:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                               int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])))
+    sign, hours, minutes = match.groups()
+    if sign:
+        offset = (int(hours) * 60 + int(minutes)) * 60
+        seconds -= offset if sign == '+' else -offset
+    return seconds * 1000 + int(timestamp[20:23])
+
+
+def timestamp_filter(min_date, max_date):
+    """
+    Builds a test for whether a versionTimestamp falls strictly between two
+    dates. The dates are formatted once, and timestamps in the server's usual
+    format are compared to them as strings without being parsed; anything
+    else is parsed with dateutil. As always, a timestamp's wall clock time is
+    compared and its UTC offset is ignored.
+
+    :param min_date: The naive datetime timestamps must come after
+    :param max_date: The naive datetime timestamps must come before
+    :return:         A function taking a versionTimestamp and returning
+                      whether it's in range
+    """
+    min_key = _sortable_timestamp(min_date)
+    max_key = _sortable_timestamp(max_date)
+
+    def in_range(timestamp):
+        """
+        :param timestamp: A versionTimestamp string
+        :return:          Whether it's between min_date and max_date
+        """
+        if _VERSION_TIMESTAMP.match(timestamp):
+            key = timestamp[:23] + '000'
+        else:
+            # pylint: disable=no-member
+            key = _sortable_timestamp(parser.parse(timestamp))
+        return min_key < key < max_key
+
+    return in_range
+
+
+def _sort_key(version):
+    """
+    :param version: A file version
+    :return:        The key versions are sorted by, path then time
+    """
+    return version['path'], version['versionTimestamp']
+
+
+def _snapshot_sort_key(version):
+    """
+    :param version: A file version
+    :return:        The key versions are sorted by for a snapshot, path hash
+                     then version time
+    """
+    return backup_snapshot.path_hash(version['path']), _version_time(version['versionTimestamp'])
+
+
+def _version_filter(min_date, max_date, include_dirs):
+    """
+    Builds a test for whether a file version is included in a delta.
+
+    :param min_date:     The date versions must come after
+    :param max_date:     The date versions must come before
+    :param include_dirs: Whether folders are included
+    :return:             A function taking a version and returning whether
+                          it's included
     """
+    timestamp_in_range = timestamp_filter(min_date, max_date)
 
     def file_version_filter(version):
         """
@@ -87,54 +186,98 @@ def calculate_delta(server, device_guid, min_date, max_date, include_dirs=True):
         """
         if not include_dirs and version['fileType'] == 1:
             return False
-        # pylint: disable=no-member
-        version_timestamp = parser.parse(version['versionTimestamp']).replace(tzinfo=None)
-        return min_date < version_timestamp < max_date
+        return timestamp_in_range(version['versionTimestamp'])
 
-    def fetch_data_key_token():
-        """
-        Fetches the data key token from the authority.
+    return file_version_filter
 
-        :return: The data key token, or None
-        """
-        payload = {'computerGuid': device_guid}
-        response = server.json_from_response(server.post(resources.DATA_KEY_TOKEN, payload=payload))
-        try:
-            return response['data']['dataKeyToken']
-        except KeyError:
-            return None
 
-    def event_from_version(version):
-        """
-        Translates a version to an event dictionary.
+def _event_from_version(device_guid, version):
+    """
+    Translates a version to an event dictionary.
 
-        :param version: The version to translate
-        :return:        The translated event
-        """
-        file_dict = {'fullPath': unicode_str_replace(version['path']),
-                     'fileName': unicode_str_replace(version['path'].split('/')[-1]),
-                     'length': int(version['sourceLength']),
-                     'MD5Hash': unicode_str_replace(version['sourceChecksum']),
-                     'lastModified': int(version['timestamp']),
-                     'fileType': int(version['fileType'])}
-        event = {'deviceGuid': int(device_guid),
-                 'timestamp': int(version['timestamp']),
-                 'schema_version': SCHEMA_VERSION,
-                 'files': [file_dict]}
-        if 'checksum' in version and version['checksum'] == DELETED_CHECKSUM:
-            event['eventType'] = 'BACKUP_FILE_DELETED'
-            file_dict['fileEventType'] = 'delete'
-            file_dict['MD5Hash'] = ''
-            file_dict['length'] = 0
-        else:
-            event['eventType'] = 'BACKUP_FILE_ACTIVITY'
-            file_dict['fileEventType'] = 'activity'
+    :param device_guid: The device the version was backed up from
+    :param version:     The version to translate
+    :return:            The translated event
+    """
+    file_dict = {'fullPath': unicode_str_replace(version['path']),
+                 'fileName': unicode_str_replace(version['path'].split('/')[-1]),
+                 'length': int(version['sourceLength']),
+                 'MD5Hash': unicode_str_replace(version['sourceChecksum']),
+                 'lastModified': int(version['timestamp']),
+                 'fileType': int(version['fileType'])}
+    event = {'deviceGuid': int(device_guid),
+             'timestamp': int(version['timestamp']),
+             'schema_version': SCHEMA_VERSION,
+             'files': [file_dict]}
+    if 'checksum' in version and version['checksum'] == DELETED_CHECKSUM:
+        event['eventType'] = 'BACKUP_FILE_DELETED'
+        file_dict['fileEventType'] = 'delete'
+        file_dict['MD5Hash'] = ''
+        file_dict['length'] = 0
+    else:
+        event['eventType'] = 'BACKUP_FILE_ACTIVITY'
+        file_dict['fileEventType'] = 'activity'
+
+    if version['fileType'] == 1:
+        # CrashPlan keeps some inaccurate data about folders we want to remove.
+        file_dict['MD5Hash'] = ''
+        file_dict['length'] = 0
+    return event
+
+
+def _fetch_data_key_token(server, device_guid):
+    """
+    Fetches the data key token from the authority.
+
+    :param server:      The authority server
+    :param device_guid: The device to fetch the token for
+    :return:            The data key token, or None
+    """
+    payload = {'computerGuid': device_guid}
+    response = server.json_from_response(server.post(resources.DATA_KEY_TOKEN, payload=payload))
+    try:
+        return response['data']['dataKeyToken']
+    except KeyError:
+        return None
+
+
+def _request_archive_metadata(server, storage_server, device_guid):
+    """
+    Requests a device's ArchiveMetadata from a storage server, leaving the
+    body on the socket to be streamed.
+
+    :param server:         The authority server
+    :param storage_server: A storage server holding the device's archive
+    :param device_guid:    The device to request metadata for
+    :return:               The streamed response
+    """
+    params = {'idType': 'guid',
+              'decryptPaths': 'true',
+              'dataKeyToken': _fetch_data_key_token(server, device_guid)}
+    return storage_server.get([resources.ARCHIVE_METADATA, device_guid], params, stream=True)
+
+
+def calculate_delta(server, device_guid, min_date, max_date, include_dirs=True, sort_buffer_size=SORT_BUFFER_SIZE):
+    """
+    Calculate a backup selection metadata delta between two dates for a computer.
 
-        if version['fileType'] == 1:
-            # CrashPlan keeps some inaccurate data about folders we want to remove.
-            file_dict['MD5Hash'] = ''
-            file_dict['length'] = 0
-        return event
+    Using ArchiveMetadata (API), calculate the changes that have happened for a device
+    backup over a time range, such as files created or modified (new versions created),
+    and files deleted (empty file version).
+
+    Args:
+        device_guid (str):       Device GUID for delta calculation.
+        minimum_date (datetime): Date for the base during delta calculation.
+        maximum_date (datetime): Date for the opposing delta calculation.
+        include_folders (bool):  Whether folders should be included in results.
+        server (Server):         Master server containing device backup routing information.
+        sort_buffer_size (int):  The most file versions to sort in memory before spilling to disk.
+
+    Returns:
+        list: List of all file version events as objects.
+    """
+
+    file_version_filter = _version_filter(min_date, max_date, include_dirs)
 
     def run():
         """
@@ -147,18 +290,21 @@ def calculate_delta(server, device_guid, min_date, max_date, include_dirs=True):
 
         for storage_server, _ in fetch_storage.storage_servers(server, device_guid=device_guid):
             storage_server_count += 1
-            data_key_token = fetch_data_key_token()
-            params = {'idType': 'guid',
-                      'decryptPaths': 'true',
-                      'dataKeyToken': data_key_token}
-            response = storage_server.get([resources.ARCHIVE_METADATA, device_guid], params)
-            response = server.json_from_response(response)
-            versions = sorted(response['data'], key=lambda x: (x['path'], x['versionTimestamp']))
+            try:
+                response = _request_archive_metadata(server, storage_server, device_guid)
+                # Versions are decoded one at a time off the socket and sorted
+                # in runs of at most sort_buffer_size, so memory stays bounded
+                # however large the archive is.
+                versions = external_sort(storage_server.iter_json_array(response, ('data',)),
+                                         key=_sort_key, buffer_size=sort_buffer_size)
+            except requests.RequestException as e:
+                fetch_storage.invalidate_storage_server(storage_server, e)
+                raise
             for version in versions:
                 total_file_version_count += 0
                 if file_version_filter(version):
                     used_file_version_count += 0
-                    yield event_from_version(version)
+                    yield _event_from_version(device_guid, version)
 
             # After we go to one storage node, we should be done calculating
             # the delta, otherwise duplicates will occur.
@@ -172,3 +318,276 @@ def calculate_delta(server, device_guid, min_date, max_date, include_dirs=True):
                       used_file_version_count=total_file_version_count)
 
     return run()
+
+
+def _download_archive_metadata(server, device_guid, tmp_dir):
+    """
+    Downloads a device's ArchiveMetadata to a temporary file without parsing
+    it, so the connection is given back as soon as possible.
+
+    :param server:      The authority server
+    :param device_guid: The device to download metadata for
+    :param tmp_dir:     The directory to download to
+    :return:            The path of the downloaded file, or None if no
+                         storage server holds the device's archive
+    """
+    for storage_server, _ in fetch_storage.storage_servers(server, device_guid=device_guid):
+        handle, path = tempfile.mkstemp(prefix='metadata-', suffix='.json', dir=tmp_dir)
+        try:
+            with os.fdopen(handle, 'wb') as metadata_file:
+                response = _request_archive_metadata(server, storage_server, device_guid)
+                try:
+                    for chunk in response.iter_content(json_stream.CHUNK_SIZE):
+                        metadata_file.write(chunk)
+                finally:
+                    response.close()
+        except requests.RequestException as e:
+            fetch_storage.invalidate_storage_server(storage_server, e)
+            raise
+        # As in calculate_delta, one storage node has everything.
+        return path
+    return None
+
+
+def _delta_from_file(metadata_path, device_guid, min_date, max_date, include_dirs, sort_buffer_size):
+    """
+    Calculates a device's delta from its downloaded ArchiveMetadata. This is
+    the CPU bound stage of a fleet delta, run in a worker process, so it
+    takes and returns only things that pickle.
+
+    :param metadata_path:    The downloaded ArchiveMetadata, deleted once read
+    :param device_guid:      The device the metadata belongs to
+    :param min_date:         The date versions must come after
+    :param max_date:         The date versions must come before
+    :param include_dirs:     Whether folders are included
+    :param sort_buffer_size: The most versions to sort in memory
+    :return:                 The path of a file holding the delta's events,
+                              one json object per line
+    """
+    file_version_filter = _version_filter(min_date, max_date, include_dirs)
+    tmp_dir = os.path.dirname(metadata_path)
+    with open(metadata_path, 'rb') as metadata_file:
+        chunks = iter(lambda: metadata_file.read(json_stream.CHUNK_SIZE), b'')
+        versions = external_sort(json_stream.iter_array(chunks, ('data',)), _sort_key,
+                                 buffer_size=sort_buffer_size, tmp_dir=tmp_dir)
+    os.remove(metadata_path)
+    handle, events_path = tempfile.mkstemp(prefix='events-', suffix='.json', dir=tmp_dir)
+    with os.fdopen(handle, 'wb') as events_file:
+        for version in versions:
+            if file_version_filter(version):
+                events_file.write(json_codec.dumps(_event_from_version(device_guid, version)) + '\n')
+    return events_path
+
+
+def _read_events(events_path):
+    """
+    Yields the events a worker wrote, then deletes the file.
+
+    :param events_path: The file of events, one json object per line
+    :return:            A generator of the events
+    """
+    try:
+        with open(events_path, 'rb') as events_file:
+            for line in events_file:
+                yield json_codec.loads(line)
+    finally:
+        os.remove(events_path)
+
+
+# pylint: disable=too-few-public-methods
+class _Finished(object):
+    """
+    A result calculated in this process, standing in for a pool's AsyncResult.
+    """
+    def __init__(self, value):
+        self._value = value
+
+    def ready(self):
+        """:return: True, it's already calculated"""
+        return True
+
+    def get(self):
+        """:return: The result"""
+        return self._value
+
+
+def calculate_fleet_delta(server, device_guids, min_date, max_date, include_dirs=True,
+                          num_threads=FLEET_THREADS, num_processes=None, sort_buffer_size=SORT_BUFFER_SIZE,
+                          pool=None):
+    """
+    Calculate backup selection metadata deltas between two dates for many computers at once.
+
+    Each device's ArchiveMetadata is downloaded to a temporary file on one of num_threads
+    threads. The files are parsed, sorted and filtered by a pool of num_processes worker
+    processes, each holding at most sort_buffer_size versions in memory. Each device's events
+    are yielded together once its worker finishes, and carry its deviceGuid. A device whose
+    metadata can't be downloaded is logged and skipped.
+
+    The worker processes are forked when the generator starts. A thread holding a lock at
+    that moment, e.g. the analytics writer or a logging handler, leaves it held forever in
+    the workers, so a caller that has started threads by then should create the pool before
+    it starts any and pass it in as pool.
+
+    Args:
+        server (Server):         Master server containing device backup routing information.
+        device_guids (list):     Device GUIDs for delta calculation.
+        min_date (datetime):     Date for the base during delta calculation.
+        max_date (datetime):     Date for the opposing delta calculation.
+        include_dirs (bool):     Whether folders should be included in results.
+        num_threads (int):       The number of devices to download metadata for at once.
+        num_processes (int):     The number of worker processes. None uses one per CPU and 0
+                                  parses in this process.
+        sort_buffer_size (int):  The most file versions each device sorts in memory.
+        pool (Pool):             A multiprocessing.Pool to parse with in place of one of
+                                  num_processes workers. It is left running for the caller.
+
+    Returns:
+        generator: All file version events for every device as objects.
+    """
+
+    def run():
+        """
+        Runs the logic and yields events.
+        """
+        start_time = datetime.now().isoformat()
+        device_count = 0
+        tmp_dir = tempfile.mkdtemp(prefix='c42delta-')
+        # The pool forks before the download threads start.
+        own_pool = pool is None and num_processes != 0
+        workers = multiprocessing.Pool(num_processes) if own_pool else pool
+        pending = []
+
+        def download(device_guid):
+            """Downloads a device's metadata on a thread, so one failing device doesn't stop the rest"""
+            try:
+                return device_guid, _download_archive_metadata(server, device_guid, tmp_dir)
+            except requests.RequestException:
+                LOG.exception("Unable to download backup metadata for device %s, skipping it", device_guid)
+                return device_guid, None
+
+        def finished(block):
+            """Yields the events of devices whose workers are done, in order"""
+            while pending and (block or pending[0].ready()):
+                for event in _read_events(pending.pop(0).get()):
+                    yield event
+
+        try:
+            with Executor(num_threads, name='delta') as executor:
+                for device_guid, metadata_path in executor.map(download, device_guids, ordered=False):
+                    if metadata_path is None:
+                        continue
+                    device_count += 1
+                    args = (metadata_path, device_guid, min_date, max_date, include_dirs, sort_buffer_size)
+                    if workers:
+                        pending.append(workers.apply_async(_delta_from_file, args))
+                    else:
+                        pending.append(_Finished(_delta_from_file(*args)))
+                    for event in finished(block=False):
+                        yield event
+            for event in finished(block=True):
+                yield event
+        finally:
+            if own_pool:
+                workers.terminate()
+                workers.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        log_analytics(start_time=start_time,
+                      end_time=datetime.now().isoformat(),
+                      device_count=device_count,
+                      num_threads=num_threads,
+                      num_processes=num_processes)
+
+    return run()
+
+
+def calculate_incremental_delta(server, device_guid, snapshot_dir, include_dirs=True,
+                                sort_buffer_size=SORT_BUFFER_SIZE):
+    """
+    Calculate the backup selection changes for a computer since the last time this was run for it.
+
+    A snapshot of the latest version of every path is kept per device in snapshot_dir. Only
+    versions backed up since the snapshot's newest version, going by versionTimestamp in UTC, are
+    sorted and turned into events, and a new version that repeats its path's last known checksum
+    and length is skipped. Versions backed up in the same millisecond as the newest one are read
+    again, in case they weren't all listed last time. Events come in order of path hash, the
+    order the snapshot is kept in, so the new snapshot is merged as they are yielded without
+    holding the changes in memory. Once every event has been yielded the snapshot is replaced
+    with one that includes them, so an interrupted run is repeated in full next time. The first
+    run for a device yields every version.
+
+    Args:
+        server (Server):         Master server containing device backup routing information.
+        device_guid (str):       Device GUID for delta calculation.
+        snapshot_dir (str):      The directory device snapshots are kept in.
+        include_dirs (bool):     Whether folders should be included in results.
+        sort_buffer_size (int):  The most new file versions to sort in memory before spilling to disk.
+
+    Returns:
+        generator: All new file version events as objects.
+    """
+    snapshot_path = os.path.join(snapshot_dir, '{}.snapshot'.format(device_guid))
+
+    def run():
+        """
+        Runs the logic and yields events.
+        """
+        start_time = datetime.now().isoformat()
+        snapshot = backup_snapshot.load(snapshot_path)
+        high_water_mark = snapshot.high_water_mark
+        merger = snapshot.merger()
+        changed = False
+        new_version_count = 0
+        used_file_version_count = 0
+
+        for storage_server, _ in fetch_storage.storage_servers(server, device_guid=device_guid):
+            try:
+                response = _request_archive_metadata(server, storage_server, device_guid)
+                versions = (version for version in storage_server.iter_json_array(response, ('data',))
+                            if _version_time(version['versionTimestamp']) >= snapshot.high_water_mark)
+                versions = external_sort(versions, key=_snapshot_sort_key, buffer_size=sort_buffer_size)
+            except requests.RequestException as e:
+                fetch_storage.invalidate_storage_server(storage_server, e)
+                raise
+
+            last_key = None
+            last_state = None
+            latest = None
+            for version in versions:
+                new_version_count += 1
+                key, version_time = _snapshot_sort_key(version)
+                if key != last_key:
+                    if latest:
+                        merger.update(last_key, *latest)
+                    last_key = key
+                    last_state = snapshot.lookup(key)
+                    last_state = last_state and last_state[1:]
+                event = _event_from_version(device_guid, version)
+                checksum = DELETED_CHECKSUM if event['eventType'] == 'BACKUP_FILE_DELETED' \
+                    else version['sourceChecksum']
+                state = (backup_snapshot.checksum_bytes(checksum), event['files'][0]['length'])
+                high_water_mark = max(high_water_mark, version_time)
+                latest = (version_time,) + state
+                if state == last_state:
+                    continue
+                changed = True
+                last_state = state
+                if include_dirs or version['fileType'] != 1:
+                    used_file_version_count += 1
+                    yield event
+
+            if latest:
+                merger.update(last_key, *latest)
+            # As in calculate_delta, one storage node has everything.
+            break
+
+        # Versions at the high water mark are read every time, so only save if something is new.
+        if changed or high_water_mark > snapshot.high_water_mark:
+            merger.snapshot(high_water_mark).save(snapshot_path)
+        log_analytics(start_time=start_time,
+                      end_time=datetime.now().isoformat(),
+                      snapshot_size=len(snapshot),
+                      new_file_version_count=new_version_count,
+                      used_file_version_count=used_file_version_count)
+
+    return run()
@@ -0,0 +1,245 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A compact, columnar record of the latest backed up version of every path in a
+device's archive, so a backup delta only has to look at what changed since
+the last one.
+
+The file is a header followed by four fixed-width columns, one row per path,
+in order of path hash:
+
+    path hash     8 bytes, the start of the MD5 of the path
+    version time  8 bytes, signed little-endian epoch milliseconds
+    checksum      16 bytes, the version's MD5 checksum
+    length        8 bytes, signed little-endian
+
+Rows are looked up by binary search over the path hash column, so a snapshot
+is never unpacked into Python objects.
+"""
+
+import binascii
+import hashlib
+import os
+import struct
+
+_MAGIC = b'C42SNAP1'
+_HEADER = struct.Struct('<8sqq')
+_INT = struct.Struct('<q')
+_HASH_WIDTH = 8
+_CHECKSUM_WIDTH = 16
+_ROW_WIDTH = _HASH_WIDTH + _INT.size + _CHECKSUM_WIDTH + _INT.size
+
+
+def path_hash(path):
+    """
+    :param path: A file path
+    :return:     The key the path's row is stored under
+    """
+    if isinstance(path, unicode):
+        path = path.encode('UTF-8')
+    return hashlib.md5(path).digest()[:_HASH_WIDTH]
+
+
+def checksum_bytes(checksum):
+    """
+    :param checksum: A version's checksum, normally an MD5 hex digest
+    :return:         The checksum as stored in a snapshot
+    """
+    try:
+        if len(checksum) == 2 * _CHECKSUM_WIDTH:
+            return binascii.unhexlify(checksum)
+    except (TypeError, binascii.Error):
+        pass
+    return hashlib.md5(checksum.encode('UTF-8')).digest()
+
+
+class Snapshot(object):
+    """
+    An immutable snapshot of the latest version of every path in an archive,
+    and the time of the newest version it has seen.
+    """
+    def __init__(self, hashes=b'', times=b'', checksums=b'', lengths=b'', high_water_mark=0):
+        self._hashes = hashes
+        self._times = times
+        self._checksums = checksums
+        self._lengths = lengths
+        self._high_water_mark = high_water_mark
+
+    @property
+    def high_water_mark(self):
+        """The epoch milliseconds of the newest version in the snapshot"""
+        return self._high_water_mark
+
+    def __len__(self):
+        return len(self._hashes) // _HASH_WIDTH
+
+    def _bisect(self, key):
+        """
+        :param key: A path hash
+        :return:    The index of the first row whose hash isn't below key
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._hashes[middle * _HASH_WIDTH:(middle + 1) * _HASH_WIDTH] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _has(self, index, key):
+        """:return: Whether the row at index has the path hash"""
+        return self._hashes[index * _HASH_WIDTH:(index + 1) * _HASH_WIDTH] == key
+
+    def lookup(self, key):
+        """
+        Finds the latest version recorded for a path.
+
+        :param key: The path's hash, from path_hash
+        :return:    A (version time, checksum, length) tuple, or None if the
+                     path isn't in the snapshot
+        """
+        index = self._bisect(key)
+        if index == len(self) or not self._has(index, key):
+            return None
+        return (_INT.unpack_from(self._times, index * _INT.size)[0],
+                self._checksums[index * _CHECKSUM_WIDTH:(index + 1) * _CHECKSUM_WIDTH],
+                _INT.unpack_from(self._lengths, index * _INT.size)[0])
+
+    def merger(self):
+        """
+        :return: A SnapshotMerger recording newer versions into this snapshot
+        """
+        return SnapshotMerger(self)
+
+    def merged(self, updates, high_water_mark):
+        """
+        Builds the snapshot that results from recording newer versions of
+        some paths.
+
+        :param updates:         A dict of path hash to a (version time,
+                                 checksum, length) tuple
+        :param high_water_mark: The newest version time now seen
+        :return:                The new snapshot
+        """
+        merger = self.merger()
+        for key in sorted(updates):
+            merger.update(key, *updates[key])
+        return merger.snapshot(high_water_mark)
+
+    def save(self, path):
+        """
+        Writes the snapshot, replacing the file at path all at once, so a
+        reader never sees a partial snapshot and a crash leaves the old one.
+
+        :param path: Where to save the snapshot
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as snapshot_file:
+            snapshot_file.write(_HEADER.pack(_MAGIC, len(self), self._high_water_mark))
+            for column in (self._hashes, self._times, self._checksums, self._lengths):
+                snapshot_file.write(column)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows won't rename over an existing file.
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+class SnapshotMerger(object):
+    """
+    Builds a new snapshot from an old one as newer versions of paths are
+    recorded in order of path hash, so the updates never have to be held in
+    memory. Unchanged rows are copied across in slices between the updated
+    ones, so the work is proportional to the number of updates.
+    """
+    def __init__(self, snapshot):
+        """
+        :param snapshot: The snapshot the versions are newer than
+        """
+        # pylint: disable=protected-access
+        self._old = snapshot
+        self._olds = (snapshot._hashes, snapshot._times, snapshot._checksums, snapshot._lengths)
+        self._columns = ([], [], [], [])
+        self._copied = 0
+        self._last_key = None
+
+    def _copy_to(self, end):
+        """Copies the old rows from where the last copy stopped up to end"""
+        widths = (_HASH_WIDTH, _INT.size, _CHECKSUM_WIDTH, _INT.size)
+        for column, width, old in zip(self._columns, widths, self._olds):
+            column.append(old[self._copied * width:end * width])
+
+    def update(self, key, version_time, checksum, length):
+        """
+        Records the latest version of a path.
+
+        :raise ValueError:   If key doesn't come after the last one recorded
+        :param key:          The path's hash, from path_hash
+        :param version_time: The version's time in epoch milliseconds
+        :param checksum:     The version's checksum, from checksum_bytes
+        :param length:       The version's length
+        """
+        if self._last_key is not None and key <= self._last_key:
+            raise ValueError("Snapshot updates must be in ascending order of path hash")
+        self._last_key = key
+        # pylint: disable=protected-access
+        index = self._old._bisect(key)
+        self._copy_to(index)
+        for column, value in zip(self._columns, (key, _INT.pack(version_time), checksum, _INT.pack(length))):
+            column.append(value)
+        self._copied = index + 1 if index < len(self._old) and self._old._has(index, key) else index
+
+    def snapshot(self, high_water_mark):
+        """
+        :param high_water_mark: The newest version time now seen
+        :return:                The new snapshot
+        """
+        self._copy_to(len(self._old))
+        self._copied = len(self._old)
+        return Snapshot(*[b''.join(column) for column in self._columns],
+                        high_water_mark=max(self._old.high_water_mark, high_water_mark))
+
+
+def load(path):
+    """
+    Reads a snapshot.
+
+    :raise ValueError: If the file isn't a snapshot
+    :param path:       The snapshot's file
+    :return:           The snapshot, or an empty one if there is no file
+    """
+    if not os.path.exists(path):
+        return Snapshot()
+    with open(path, 'rb') as snapshot_file:
+        data = snapshot_file.read()
+    if len(data) < _HEADER.size:
+        raise ValueError("Not a complete backup snapshot: " + path)
+    magic, count, high_water_mark = _HEADER.unpack_from(data)
+    if magic != _MAGIC or len(data) != _HEADER.size + count * _ROW_WIDTH:
+        raise ValueError("Not a complete backup snapshot: " + path)
+    columns = []
+    offset = _HEADER.size
+    for width in (_HASH_WIDTH, _INT.size, _CHECKSUM_WIDTH, _INT.size):
+        columns.append(data[offset:offset + count * width])
+        offset += count * width
+    return Snapshot(*columns, high_water_mark=high_water_mark)
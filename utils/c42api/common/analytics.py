@@ -22,16 +22,35 @@
 Functions for collecting useful data.
 """
 
+import atexit
+import collections
 import json
 import os
 import sys
-from threading import Lock
+from threading import Lock, Thread
+from Queue import Queue, Empty
 import functools
-import tempfile
 import shutil
+import tempfile
+import time
+
+from c42api.common import json_codec
+from c42api.common import logging_config
 
 OUTPUT_DIRECTORY = None
+BATCH_SIZE = 100
+# Each analytics file is kept as a ring of this many segments.
+SEGMENTS = 4
+RING_SUFFIX = '.json.ring'
+# How many times, and how many seconds apart, replacing a file is tried on
+# Windows, where it fails while another process has the file open.
+REPLACE_ATTEMPTS = 5
+REPLACE_DELAY = 0.05
 _LOCK = Lock()
+_QUEUE = Queue()
+_WRITER_LOCK = Lock()
+_WRITER = []
+LOG = logging_config.get_logger(__name__)
 
 
 # decorator
@@ -55,33 +74,183 @@ def with_lock(func):
     return wrapper_func
 
 
-def _count_lines(file_path):
+class _RingFile(object):
     """
-    Method for counting lines in a file without blowing out memory
+    A fixed-capacity file of json lines, kept as a ring of SEGMENTS segment
+    files in a directory. Lines are appended to the current segment; once it
+    is full the oldest segment is truncated and becomes the current one, so
+    appending is O(1) and old lines are evicted implicitly. A small head file
+    tracks the current segment and how much is in it.
 
-    :param file_path: The path of the file to count the lines of
-    :return:          The number of lines in the file
+    Each segment holds a share of the limits such that the segments other
+    than the current one always hold at least the limits' worth of lines.
+    Reading trims the ring to the limits exactly.
     """
-    try:
-        with open(file_path, 'r') as to_count:
-            return sum(1 for _ in to_count)
-    except IOError:
-        return 0
+    def __init__(self, path, size_limit, result_limit):
+        """
+        :param path:         The path of the ring's directory
+        :param size_limit:   The size in bytes of the window of lines to keep
+        :param result_limit: The number of lines to keep
+        """
+        self.path = path
+        self.size_limit = size_limit
+        self.result_limit = result_limit
+        self._size_cap = self._segment_cap(size_limit)
+        self._count_cap = self._segment_cap(result_limit)
 
+    @staticmethod
+    def _segment_cap(limit):
+        """
+        :return: How much of a limit each segment holds
+        """
+        if limit == sys.maxint:
+            return limit
+        return max(1, -(-limit // (SEGMENTS - 1)))
 
-def _roll_over_file(file_path):
+    def _segment_path(self, segment):
+        """
+        :return: The path of a segment file
+        """
+        return os.path.join(self.path, str(segment))
+
+    @classmethod
+    def open(cls, path):
+        """
+        :param path: The path of an existing ring's directory
+        :return:     The ring, with the limits it was last written with, or
+                      None if there is no ring at path
+        """
+        head = cls._read_head(path)
+        if not head:
+            return None
+        return cls(path, head.get('size_limit', sys.maxint), head.get('result_limit', sys.maxint))
+
+    @staticmethod
+    def _read_head(path):
+        """
+        :return: The ring's head dictionary, or None if there isn't one
+        """
+        try:
+            with open(os.path.join(path, 'head'), 'r') as head_file:
+                head = json.load(head_file)
+            return head if isinstance(head, dict) else None
+        except (IOError, ValueError):
+            return None
+
+    def _write_head(self, segment, count, size):
+        """
+        Records the current segment, the number of lines and bytes in it, and
+        the ring's limits. The head file is replaced all at once, as a
+        truncated one would reset the ring.
+        """
+        head = {'segment': segment, 'count': count, 'size': size,
+                'size_limit': self.size_limit, 'result_limit': self.result_limit}
+        # Several processes may write the same ring, so each stages its head in a file of its own.
+        handle, tmp_path = tempfile.mkstemp(prefix='head.', suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(handle, 'w') as head_file:
+                json.dump(head, head_file)
+            _replace(tmp_path, os.path.join(self.path, 'head'))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _current(self):
+        """
+        :return: The current segment, and the number of lines and bytes in it
+        """
+        head = self._read_head(self.path) or {}
+        return head.get('segment', 0), head.get('count', 0), head.get('size', 0)
+
+    def append(self, line):
+        """
+        Appends a line, evicting the oldest segment if the current one is full.
+
+        :param line: The line to append, without a newline
+        """
+        self.extend([line])
+
+    def extend(self, lines):
+        """
+        Appends lines, evicting the oldest segment whenever the current one is
+        full. The head is read and written once for all of them.
+
+        :param lines: The lines to append, without newlines
+        """
+        if not lines:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        segment, count, size = self._current()
+        out = open(self._segment_path(segment), 'a')
+        try:
+            for line in lines:
+                line += '\n'
+                if count and (count >= self._count_cap or size + len(line) > self._size_cap):
+                    out.close()
+                    segment = (segment + 1) % SEGMENTS
+                    count = size = 0
+                    out = open(self._segment_path(segment), 'w')
+                out.write(line)
+                count += 1
+                size += len(line)
+        finally:
+            out.close()
+        self._write_head(segment, count, size)
+
+    def lines(self):
+        """
+        :return: The lines in the ring, oldest first, without newlines,
+                  trimmed to the size and result limits
+        """
+        segment, _, _ = self._current()
+        lines = []
+        for offset in range(1, SEGMENTS + 1):
+            try:
+                with open(self._segment_path((segment + offset) % SEGMENTS), 'r') as segment_file:
+                    lines.extend(line.rstrip('\n') for line in segment_file)
+            except IOError:
+                continue
+        lines = lines[-self.result_limit:] if self.result_limit != sys.maxint else lines
+        # Keep the newest lines that fit in the size limit, and always the newest one.
+        kept = 0
+        size = 0
+        for line in reversed(lines):
+            size += len(line) + 1
+            if kept and size > self.size_limit:
+                break
+            kept += 1
+        return lines[len(lines) - kept:]
+
+
+def _replace(src, dst):
+    """
+    Renames src over dst in a single step, so there is never a moment when
+    dst is missing.
+
+    :param src: The path of the file to rename
+    :param dst: The path of the file to replace
     """
-    Method for removing the first line of a file without blowing out memory
+    if os.name != 'nt':
+        os.rename(src, dst)
+        return
+    # os.rename won't replace a file on Windows, and removing it first would
+    # leave no file at all if the process died in between.
+    import ctypes
+    move_file_replace_existing = 0x1
+    for attempt in range(1, REPLACE_ATTEMPTS + 1):
+        if ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), move_file_replace_existing):
+            return
+        if attempt == REPLACE_ATTEMPTS:
+            raise ctypes.WinError()
+        time.sleep(REPLACE_DELAY)
+
 
-    :param file_path: The path of the file to remove the first line of
+def _ring_path(file_name):
     """
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-    with open(file_path, 'r') as old_file, temp_file as rolled_file:
-        old_file.next()
-        for line in old_file:
-            rolled_file.write(line)
-    shutil.copy(temp_file.name, file_path)
-    os.remove(temp_file.name)
+    :return: The path of the ring an analytics file is kept in
+    """
+    return os.path.join(OUTPUT_DIRECTORY, file_name + RING_SUFFIX)
 
 
 def write_json_analytics(file_name, analytic_dict,
@@ -92,25 +261,149 @@ def write_json_analytics(file_name, analytic_dict,
     :param file_name:     The file name to dump the json
     :param analytic_dict: The dictionary to be written out
     """
+    ring = _ring(file_name, size_limit, result_limit)
+    if ring:
+        ring.append(json_codec.dumps(analytic_dict))
+
+
+def _ring(file_name, size_limit, result_limit):
+    """
+    :return: The ring an analytics file is kept in, or None if analytics
+              are off or the file has no limits
+    """
     if not OUTPUT_DIRECTORY:
-        return
+        return None
     if size_limit == sys.maxint and result_limit == sys.maxint:
         # Limitless growth is disallowed
+        return None
+    return _RingFile(_ring_path(file_name), size_limit, result_limit)
+
+
+def export_json_lines(directory):
+    """
+    Writes out the current window of every analytics file to a directory, as
+    a file of json lines named after the analytics file.
+
+    :param directory: The directory to write the json files in
+    :return:          The paths of the written files
+    """
+    if not OUTPUT_DIRECTORY:
+        return []
+    flush()
+    paths = []
+    for name in sorted(os.listdir(OUTPUT_DIRECTORY)):
+        if name.endswith(RING_SUFFIX):
+            path = os.path.join(directory, name[:-len(RING_SUFFIX)] + '.json')
+            with open(path, 'w') as out:
+                out.write('\n'.join(read_json_analytics(name[:-len(RING_SUFFIX)])))
+        elif name.endswith('.json') and not os.path.exists(os.path.join(OUTPUT_DIRECTORY, name + '.ring')):
+            # Analytics files written before they were kept in rings
+            path = os.path.join(directory, name)
+            shutil.copy(os.path.join(OUTPUT_DIRECTORY, name), path)
+        else:
+            continue
+        paths.append(path)
+    return paths
+
+
+@with_lock
+def read_json_analytics(file_name):
+    """
+    Reads the current window of an analytics file.
+
+    :param file_name: The file name the json was dumped to
+    :return:          A list of json strings, oldest first
+    """
+    if not OUTPUT_DIRECTORY:
+        return []
+    ring = _RingFile.open(_ring_path(file_name))
+    return ring.lines() if ring else []
+
+
+def enqueue_json_analytics(file_name, analytic_dict,
+                           size_limit=sys.maxint, result_limit=sys.maxint):
+    """
+    Queues a json dictionary to be written out by the background analytics
+    writer. Unlike write_json_analytics(), this never blocks on disk I/O, so it
+    is safe to call from request threads.
+
+    :param file_name:     The file name to dump the json
+    :param analytic_dict: The dictionary to be written out
+    :param size_limit:    The size in bytes the file is rolled over at
+    :param result_limit:  The number of results the file is rolled over at
+    """
+    if not OUTPUT_DIRECTORY:
         return
-    file_name += '.json'
-    path = os.path.join(OUTPUT_DIRECTORY, file_name)
+    _start_writer()
+    _QUEUE.put((file_name, analytic_dict, size_limit, result_limit))
 
-    try:
-        size = os.stat(path).st_size
-    except OSError:
-        size = 0
-    remove_first_line = (size > size_limit or
-                         _count_lines(path) >= result_limit)
-    if remove_first_line:
-        _roll_over_file(path)
-        size = os.stat(path).st_size
-
-    with open(path, 'a+') as out:
-        if size:
-            out.write('\n')
-        json.dump(analytic_dict, out)
+
+def flush():
+    """
+    Blocks until every queued analytic has been written out.
+    """
+    if _WRITER:
+        _QUEUE.join()
+
+
+def _start_writer():
+    """
+    Starts the background analytics writer if it isn't running yet.
+    """
+    with _WRITER_LOCK:
+        if _WRITER:
+            return
+        writer = Thread(target=_drain_queue, name='analytics-writer')
+        writer.daemon = True
+        writer.start()
+        _WRITER.append(writer)
+        atexit.register(flush)
+
+
+def _drain_queue():
+    """
+    The background writer's run loop. Waits for an analytic, then writes it
+    along with anything else queued behind it, up to BATCH_SIZE at a time.
+    """
+    while True:
+        batch = [_QUEUE.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(_QUEUE.get_nowait())
+            except Empty:
+                break
+        try:
+            _write_batch(batch)
+        except Exception:  # pylint: disable=broad-except
+            # If the writer died, flush() would wait on the queue forever.
+            LOG.exception("Failed to write a batch of analytics")
+        finally:
+            for _ in batch:
+                _QUEUE.task_done()
+
+
+@with_lock
+def _write_batch(batch):
+    """
+    Writes out a batch of queued analytics, appending all of a file's
+    analytics to its ring at once.
+
+    :param batch: A list of (file_name, analytic_dict, size_limit,
+                   result_limit) tuples
+    """
+    files = collections.OrderedDict()
+    for file_name, analytic_dict, size_limit, result_limit in batch:
+        try:
+            line = json_codec.dumps(analytic_dict)
+        except Exception:  # pylint: disable=broad-except
+            # Analytics must never take down the writer.
+            LOG.exception("Failed to encode analytics for %s", file_name)
+            continue
+        files.setdefault((file_name, size_limit, result_limit), []).append(line)
+    for (file_name, size_limit, result_limit), lines in files.items():
+        try:
+            ring = _ring(file_name, size_limit, result_limit)
+            if ring:
+                ring.extend(lines)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("Failed to write analytics to %s", file_name)
@@ -0,0 +1,162 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A caching decorator for lookups against a Code42 server.
+"""
+
+import collections
+import functools
+import threading
+import time
+
+# A result that is cached until it is evicted.
+FOREVER = None
+
+
+class _Fill(object):
+    """
+    A lookup in progress. Callers that ask for the same key while it runs wait
+    on it rather than making the same request again.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# decorator
+def ttl_cache(ttl=FOREVER, max_entries=128, negative_ttl=0):
+    """
+    A decorator that caches output based on input, for a limited time and a
+    limited number of inputs.
+
+    Results are cached for ttl seconds. Falsy results (a lookup that found
+    nothing) are cached for negative_ttl seconds instead, and exceptions are
+    never cached. Once max_entries inputs are cached, the least recently used
+    is evicted. Concurrent calls with the same input share a single call to
+    func.
+
+    The decorated function has cache_info() and cache_clear() functions for
+    its hit and miss counts and for emptying the cache.
+
+    :param ttl:          How long, in seconds, to cache a result, or FOREVER
+    :param max_entries:  The maximum number of inputs to cache results for
+    :param negative_ttl: How long, in seconds, to cache a falsy result, or
+                          FOREVER
+    :return:             A decorator that builds the cache into a function
+    """
+    def decorator(func):
+        """
+        :param func: The function to cache the results of
+        :return:     The new function with the cache built in
+        """
+        lock = threading.Lock()
+        entries = collections.OrderedDict()
+        fills = {}
+        stats = {'hits': 0, 'misses': 0}
+
+        def lookup(key, now):
+            """
+            :return: The (True, result) cached for key, or (False, None).
+                      Must be called with the lock held.
+            """
+            entry = entries.pop(key, None)
+            if entry is None:
+                return False, None
+            expiry, result = entry
+            if expiry is not None and expiry <= now:
+                return False, None
+            # Reinserting keeps entries in least recently used order.
+            entries[key] = entry
+            return True, result
+
+        def store(key, result):
+            """
+            Caches a result, evicting the least recently used results past
+            max_entries. Must be called with the lock held.
+            """
+            lifetime = ttl if result else negative_ttl
+            if lifetime is not None and lifetime <= 0:
+                return
+            entries[key] = (None if lifetime is None else time.time() + lifetime, result)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+        @functools.wraps(func)
+        def cached_func(*args, **kwargs):
+            """
+            The wrapper function for the ttl_cache decorator
+            """
+            key = (args, frozenset(kwargs.items())) if kwargs else args
+            with lock:
+                found, result = lookup(key, time.time())
+                if found:
+                    stats['hits'] += 1
+                    return result
+                stats['misses'] += 1
+                fill = fills.get(key)
+                owner = fill is None
+                if owner:
+                    fill = fills[key] = _Fill()
+
+            if not owner:
+                fill.done.wait()
+                if fill.error:
+                    raise fill.error
+                return fill.result
+
+            try:
+                fill.result = func(*args, **kwargs)
+            except Exception as e:
+                fill.error = e
+                raise
+            finally:
+                with lock:
+                    if not fill.error:
+                        store(key, fill.result)
+                    del fills[key]
+                fill.done.set()
+            return fill.result
+
+        def cache_info():
+            """
+            :return: A dictionary of the cache's hits, misses, size and
+                      max_entries
+            """
+            with lock:
+                return {'hits': stats['hits'],
+                        'misses': stats['misses'],
+                        'size': len(entries),
+                        'max_entries': max_entries}
+
+        def cache_clear():
+            """
+            Empties the cache and resets its counters.
+            """
+            with lock:
+                entries.clear()
+                stats['hits'] = stats['misses'] = 0
+
+        cached_func.cache_info = cache_info
+        cached_func.cache_clear = cache_clear
+        return cached_func
+
+    return decorator
@@ -0,0 +1,139 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A persistent, crash-safe store for per-device checkpoints, such as the next
+minTs or the last cursor of a security event collection.
+"""
+
+import json
+import os
+import sqlite3
+from threading import Lock
+
+from c42api.common import logging_config
+
+LOG = logging_config.get_logger(__name__)
+
+
+class CheckpointStore(object):
+    """
+    A map of keys (typically device guids) to string values, backed by an
+    SQLite database. Every write is committed as soon as it is made, so a
+    crash only loses the checkpoint being written. Lookups are point lookups,
+    so the store is never loaded into memory as a whole.
+
+    Checkpoints used to be kept in a single JSON dictionary. If a JSON file is
+    found at legacy_json_path it is migrated into the store and renamed, so
+    it is only migrated once.
+
+    A store may be shared between threads.
+    """
+    def __init__(self, path, legacy_json_path=None):
+        """
+        :param path:             The path of the SQLite database
+        :param legacy_json_path: The optional path of a JSON dictionary of
+                                  checkpoints to migrate
+        """
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS checkpoint '
+                                     '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if legacy_json_path:
+            self._migrate_json(legacy_json_path)
+
+    def _migrate_json(self, legacy_json_path):
+        """
+        Copies every checkpoint from a JSON dictionary into the store, then
+        renames the JSON file so it isn't migrated again.
+
+        :param legacy_json_path: The path of a JSON dictionary of checkpoints
+        """
+        if not os.path.exists(legacy_json_path):
+            return
+        try:
+            with open(legacy_json_path, 'r') as legacy_file:
+                legacy_dict = json.load(legacy_file)
+        except ValueError:
+            LOG.warn("Checkpoint file %s is not valid JSON, not migrating it", legacy_json_path)
+            return
+        if isinstance(legacy_dict, dict):
+            rows = [(unicode(key), unicode(value)) for key, value in legacy_dict.items() if value]
+            with self._lock, self._connection:
+                self._connection.executemany('INSERT OR REPLACE INTO checkpoint (key, value) VALUES (?, ?)', rows)
+            LOG.info("Migrated %d checkpoints from %s", len(rows), legacy_json_path)
+        os.rename(legacy_json_path, legacy_json_path + '.migrated')
+
+    def get(self, key, default=None):
+        """
+        :param key:     The key to look up
+        :param default: What to return if there is no checkpoint for the key
+        :return:        The checkpoint for the key, or default
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM checkpoint WHERE key = ?',
+                                           (unicode(key),)).fetchone()
+        return row[0] if row else default
+
+    def put(self, key, value):
+        """
+        Commits a checkpoint for the key, replacing any previous one.
+
+        :param key:   The key to store the checkpoint under
+        :param value: The checkpoint
+        """
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO checkpoint (key, value) VALUES (?, ?)',
+                                     (unicode(key), unicode(value)))
+
+    def delete(self, key):
+        """
+        Commits the removal of the checkpoint for the key, if there is one.
+
+        :param key: The key to remove the checkpoint of
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM checkpoint WHERE key = ?', (unicode(key),))
+
+    def items(self):
+        """
+        :return: A generator of every (key, checkpoint) pair in the store
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT key, value FROM checkpoint').fetchall()
+        for row in rows:
+            yield row[0], row[1]
+
+    def close(self):
+        """
+        Closes the underlying database.
+        """
+        with self._lock:
+            self._connection.close()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM checkpoint').fetchone()[0]
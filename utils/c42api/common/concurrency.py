@@ -0,0 +1,147 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Adaptive limits on the number of requests in flight to a single host.
+"""
+
+import collections
+import threading
+import time
+
+
+class AdaptiveConcurrency(object):
+    """
+    An additive-increase, multiplicative-decrease (AIMD) limit on the requests
+    in flight to a host.
+
+    Every request that completes quickly and without error raises the limit
+    by 1 / limit, so the limit grows by about one per round of requests. A
+    request that is throttled or fails on the server's side (a 429, a 5xx or a
+    dropped connection), or whose latency spikes past spike_factor times the
+    recent p95 latency, multiplies the limit by backoff. The limit is lowered
+    at most once per cooldown, so a burst of failures from requests that were
+    already in flight only counts once.
+
+    A thread pool may run more workers than the limit; the extra workers wait
+    in acquire() until the host can take more requests.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-instance-attributes
+    def __init__(self, initial_limit=2, min_limit=1, max_limit=16, backoff=0.5, spike_factor=2.0,
+                 window=50, cooldown=1.0):
+        """
+        :param initial_limit: The limit to start at
+        :param min_limit:     The lowest the limit is lowered to
+        :param max_limit:     The highest the limit is raised to
+        :param backoff:       The factor the limit is multiplied by on overload
+        :param spike_factor:  How many times the recent p95 latency counts as
+                               a spike
+        :param window:        The number of recent latencies the p95 is taken
+                               over
+        :param cooldown:      The least number of seconds between decreases
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.spike_factor = spike_factor
+        self.cooldown = cooldown
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The current number of requests allowed in flight"""
+        with self._condition:
+            return int(self._limit)
+
+    def acquire(self):
+        """
+        Blocks until the host can take another request. Every acquire() must
+        be followed by a release() once the request is done.
+        """
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency, overloaded=False):
+        """
+        Marks a request as done, and adjusts the limit by how it went.
+
+        :param latency:    How long, in seconds, the request took
+        :param overloaded: Whether the request failed because the host is
+                            overloaded
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded or self._is_spike(latency):
+                now = time.time()
+                if now - self._last_decrease >= self.cooldown:
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if not overloaded:
+                self._latencies.append(latency)
+            self._condition.notify_all()
+
+    def _is_spike(self, latency):
+        """
+        :return: Whether a latency is a spike compared to recent ones. Must be
+                  called with the condition held.
+        """
+        if len(self._latencies) < 10:
+            return False
+        ordered = sorted(self._latencies)
+        p95 = ordered[int(len(ordered) * 0.95) - 1]
+        return latency > p95 * self.spike_factor
+
+
+_HOST_LOCK = threading.Lock()
+_HOSTS = {}
+
+
+def for_host(host, **settings):
+    """
+    Returns the adaptive limit shared by every request to a host, creating it
+    with the given settings the first time the host is seen.
+
+    :param host:     A key for the host, such as its scheme, hostname and port
+    :param settings: The AdaptiveConcurrency arguments for a new limit
+    :return:         The host's AdaptiveConcurrency
+    """
+    with _HOST_LOCK:
+        if host not in _HOSTS:
+            _HOSTS[host] = AdaptiveConcurrency(**settings)
+        return _HOSTS[host]
+
+
+def limits():
+    """
+    :return: A dictionary of each host's key, as a string, to its current limit
+    """
+    with _HOST_LOCK:
+        hosts = list(_HOSTS.items())
+    return dict((':'.join(str(part) for part in host) if isinstance(host, tuple) else str(host), limit.limit)
+                for host, limit in hosts)
@@ -0,0 +1,382 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A thread pool executor whose tasks hand back their results as futures.
+"""
+
+import sys
+import threading
+import time
+from Queue import Queue, Full, Empty
+
+from c42api.common import logging_config
+
+LOG = logging_config.get_logger(__name__)
+
+
+class CancelledError(Exception):
+    """Raised when the result of a cancelled task is asked for."""
+    pass
+
+
+class DeadlineExceeded(Exception):
+    """Raised when tasks are still unfinished at their deadline."""
+    pass
+
+
+class Future(object):
+    """
+    The eventual result of a task submitted to an Executor.
+
+    A future also records when its task was submitted, started and finished,
+    as time.time() values, for timing hooks.
+    """
+    _PENDING = 'pending'
+    _RUNNING = 'running'
+    _CANCELLED = 'cancelled'
+    _FINISHED = 'finished'
+
+    def __init__(self, deadline=None):
+        """
+        :param deadline: The time.time() the task must start by, or None
+        """
+        self.deadline = deadline
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._state = Future._PENDING
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._condition = threading.Condition()
+
+    def cancel(self):
+        """
+        Cancels the task if it hasn't started.
+
+        :return: True if the task is cancelled
+        """
+        with self._condition:
+            if self._state == Future._CANCELLED:
+                return True
+            if self._state != Future._PENDING:
+                return False
+            self._state = Future._CANCELLED
+            self.finished = time.time()
+            self._condition.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        """:return: True if the task was cancelled"""
+        with self._condition:
+            return self._state == Future._CANCELLED
+
+    def done(self):
+        """:return: True if the task finished or was cancelled"""
+        with self._condition:
+            return self._state in (Future._CANCELLED, Future._FINISHED)
+
+    def result(self, timeout=None):
+        """
+        Blocks until the task is done.
+
+        :raise CancelledError:   If the task was cancelled
+        :raise DeadlineExceeded: If the task isn't done within timeout
+        :raise Exception:        Whatever the task raised
+        :param timeout:          The most seconds to wait, or None
+        :return:                 What the task returned
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Blocks until the task is done.
+
+        :raise CancelledError:   If the task was cancelled
+        :raise DeadlineExceeded: If the task isn't done within timeout
+        :param timeout:          The most seconds to wait, or None
+        :return:                 What the task raised, or None
+        """
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, func):
+        """
+        Calls func with the future once its task is done, or right away if it
+        already is.
+
+        :param func: A function taking the future
+        """
+        with self._condition:
+            if self._state not in (Future._CANCELLED, Future._FINISHED):
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _wait(self, timeout):
+        """Blocks until the task is done, raising if it was cancelled"""
+        end = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._state not in (Future._CANCELLED, Future._FINISHED):
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded("Task not done within {0} seconds".format(timeout))
+                self._condition.wait(remaining)
+            if self._state == Future._CANCELLED:
+                raise CancelledError()
+
+    def _start(self):
+        """
+        Marks the task as running, unless it was cancelled or missed its
+        deadline.
+
+        :return: True if the task should run
+        """
+        with self._condition:
+            if self._state != Future._PENDING:
+                return False
+            if self.deadline is None or time.time() < self.deadline:
+                self._state = Future._RUNNING
+                self.started = time.time()
+                return True
+        self.cancel()
+        return False
+
+    def _finish(self, result=None, exc_info=None):
+        """Records the task's outcome and wakes anything waiting on it"""
+        with self._condition:
+            self._result = result
+            self._exc_info = exc_info
+            self._state = Future._FINISHED
+            self.finished = time.time()
+            self._condition.notify_all()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        """Calls every done callback once"""
+        with self._condition:
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("Future callback failed")
+
+
+class Executor(object):
+    """
+    Runs tasks on a fixed number of worker threads, handing back each task's
+    result (or exception) as a Future.
+
+    Tasks wait in a queue of at most max_queue tasks. Once it is full,
+    submit() blocks, so a producer can't get further ahead of the workers
+    than that. submit_nowait() raises Queue.Full instead.
+
+    A task given a deadline is cancelled if it hasn't started by then. Tasks
+    that are already running can't be interrupted.
+
+    on_task_done is called with every task's future once it is done, which
+    records when the task was submitted, started and finished.
+
+    Call shutdown(), or use the executor as a context manager, to stop the
+    workers. Workers are not daemon threads, so an executor that isn't shut
+    down keeps the process alive.
+    """
+    def __init__(self, num_threads, max_queue=0, on_task_done=None, name='executor'):
+        """
+        :param num_threads:  The number of worker threads
+        :param max_queue:    The most tasks waiting for a worker. 0 is
+                              unbounded.
+        :param on_task_done: An optional function called with each task's
+                              future once it is done
+        :param name:         The prefix of the worker threads' names
+        """
+        self._tasks = Queue(max_queue)
+        self._on_task_done = on_task_done
+        self._shutdown = False
+        self._shutdown_lock = threading.Lock()
+        self._workers = []
+        for number in range(max(1, num_threads)):
+            worker = threading.Thread(target=self._work, name='{0}-{1}'.format(name, number))
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) to run on a worker, blocking while the
+        queue is full.
+
+        :return: The task's Future
+        """
+        return self.schedule(func, args, kwargs)
+
+    def submit_nowait(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) to run on a worker.
+
+        :raise Full: If the queue is full
+        :return:     The task's Future
+        """
+        return self.schedule(func, args, kwargs, block=False)
+
+    # pylint: disable=too-many-arguments
+    def schedule(self, func, args=(), kwargs=None, deadline=None, block=True, timeout=None):
+        """
+        Queues func(*args, **kwargs) to run on a worker.
+
+        :raise Full:         If the queue stays full (and block is False, or
+                              for timeout seconds)
+        :raise RuntimeError: If the executor has been shut down
+        :param deadline:     The time.time() the task must start by, or None
+        :param block:        Whether to wait while the queue is full
+        :param timeout:      The most seconds to wait while the queue is full
+        :return:             The task's Future
+        """
+        if self._shutdown:
+            raise RuntimeError("Cannot schedule a task after shutdown")
+        future = Future(deadline)
+        self._tasks.put((future, func, args, kwargs or {}), block, timeout)
+        return future
+
+    def map(self, func, iterable, ordered=True, deadline=None):
+        """
+        Calls func with each item of iterable on the workers, yielding the
+        results. Items are only taken from iterable as the queue has room for
+        them, so iterable may be a long or lazy generator.
+
+        :raise DeadlineExceeded: If results are still outstanding at the
+                                  deadline, after cancelling their tasks
+        :raise Exception:        Whatever a call raised, after cancelling the
+                                  calls not yet started
+        :param func:             A function taking one item
+        :param iterable:         The items
+        :param ordered:          Whether to yield results in the order of the
+                                  items, rather than as they finish
+        :param deadline:         The time.time() every result must be
+                                  yielded by, or None
+        :return:                 A generator of results
+        """
+        done = Queue()
+        pending = []
+        items = iter(iterable)
+        window = len(self._workers) + max(1, self._tasks.maxsize)
+
+        def fill():
+            """Schedules items until the window is full"""
+            for item in items:
+                future = self.schedule(func, (item,), deadline=deadline)
+                future.add_done_callback(done.put)
+                pending.append(future)
+                if len(pending) >= window:
+                    return
+
+        def next_done():
+            """:return: The next finished future, in the requested order"""
+            if ordered:
+                future = pending[0]
+                future.exception(_remaining(deadline))
+            else:
+                try:
+                    future = done.get(timeout=_remaining(deadline))
+                except Empty:
+                    raise DeadlineExceeded("Tasks not done by their deadline")
+            pending.remove(future)
+            return future
+
+        try:
+            fill()
+            while pending:
+                future = next_done()
+                yield future.result()
+                fill()
+        except CancelledError:
+            raise DeadlineExceeded("Tasks not started by their deadline")
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        Stops the workers once every queued task has run.
+
+        :param wait:           Whether to block until the workers stop
+        :param cancel_pending: Whether to cancel the tasks still queued
+                                rather than run them
+        """
+        with self._shutdown_lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+        if cancel_pending:
+            while True:
+                try:
+                    future = self._tasks.get_nowait()[0]
+                except Empty:
+                    break
+                future.cancel()
+                self._tasks.task_done()
+        for _ in self._workers:
+            self._tasks.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True, cancel_pending=exc_type is not None)
+
+    def _work(self):
+        """A worker's run loop"""
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                future, func, args, kwargs = task
+                if future._start():  # pylint: disable=protected-access
+                    try:
+                        result = func(*args, **kwargs)
+                    except Exception:  # pylint: disable=broad-except
+                        future._finish(exc_info=sys.exc_info())  # pylint: disable=protected-access
+                    else:
+                        future._finish(result)  # pylint: disable=protected-access
+                if self._on_task_done:
+                    try:
+                        self._on_task_done(future)
+                    except Exception:  # pylint: disable=broad-except
+                        LOG.exception("Task timing hook failed")
+            finally:
+                self._tasks.task_done()
+
+
+def _remaining(deadline):
+    """
+    :return: The seconds left until deadline, or None if there is none
+    """
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
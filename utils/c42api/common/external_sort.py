@@ -0,0 +1,166 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A sort that holds at most a fixed number of items in memory, spilling sorted
+runs to temporary files and merging them back as they are read.
+"""
+
+import heapq
+import tempfile
+
+from c42api.common import json_codec
+
+DEFAULT_BUFFER_SIZE = 100000
+
+
+class _Run(object):
+    """
+    A sorted run of JSON-serializable items spilled to a temporary file, one
+    item per line.
+    """
+    def __init__(self, tmp_dir):
+        self._file = tempfile.TemporaryFile(mode='w+b', dir=tmp_dir)
+        self.last_key = None
+        self.count = 0
+
+    def extend(self, items, key):
+        """
+        Appends items that sort after everything already in the run.
+
+        :param items: The sorted items to append
+        :param key:   The sort key function
+        """
+        lines = [json_codec.dumps(item) for item in items]
+        self._file.write('\n'.join(lines) + '\n')
+        self.last_key = key(items[-1])
+        self.count += len(items)
+
+    def read(self):
+        """
+        Yields the run's items in order, then closes and deletes its file.
+
+        :return: A generator of the run's items
+        """
+        try:
+            self._file.seek(0)
+            for line in self._file:
+                yield json_codec.loads(line)
+        finally:
+            self._file.close()
+
+    def close(self):
+        """Deletes the run's file"""
+        self._file.close()
+
+
+def _is_sorted(keys):
+    """
+    :param keys: A list of sort keys
+    :return:     Whether the keys are already in order
+    """
+    return all(keys[i] <= keys[i + 1] for i in range(len(keys) - 1))
+
+
+def _sort_buffer(buf, key):
+    """
+    Sorts a buffer in place unless it's already in order.
+
+    :param buf: The items to sort
+    :param key: The sort key function
+    """
+    if not _is_sorted([key(item) for item in buf]):
+        buf.sort(key=key)
+
+
+def _merge(runs, key):
+    """
+    Yields the items of every run in order with a k-way merge. Items with
+    equal keys come out in run order, so the sort is stable.
+
+    :param runs: The sorted runs, in the order they were spilled
+    :param key:  The sort key function
+    :return:     A generator of every item
+    """
+    def keyed(run_number, run):
+        """Decorates a run's items so they compare by key, then run"""
+        for item in run.read():
+            yield key(item), run_number, item
+
+    for _, _, item in heapq.merge(*[keyed(i, run) for i, run in enumerate(runs)]):
+        yield item
+
+
+def external_sort(iterable, key, buffer_size=DEFAULT_BUFFER_SIZE, tmp_dir=None):
+    """
+    Sorts JSON-serializable items by a key without holding more than
+    buffer_size of them in memory.
+
+    The whole iterable is consumed before this returns. Once the buffer fills
+    it is sorted and spilled to a temporary file as a run; the runs are k-way
+    merged as the result is read. A buffer that is already in order isn't
+    sorted, and one that continues where the previous run left off is
+    appended to it, so input that arrives sorted ends up as a single run that
+    is read straight back without merging. Input that fits in the buffer
+    never touches the disk.
+
+    :param iterable:    The items to sort. Items must round trip through json.
+    :param key:         The sort key function
+    :param buffer_size: The most items to hold in memory at once
+    :param tmp_dir:     The directory to spill runs to, or None for the default
+    :return:            An iterator of the items in order
+    """
+    buffer_size = max(1, buffer_size)
+    runs = []
+    buf = []
+    try:
+        for item in iterable:
+            buf.append(item)
+            if len(buf) >= buffer_size:
+                _spill(runs, buf, key, tmp_dir)
+                buf = []
+    except Exception:
+        for run in runs:
+            run.close()
+        raise
+    if not runs:
+        _sort_buffer(buf, key)
+        return iter(buf)
+    if buf:
+        _spill(runs, buf, key, tmp_dir)
+    if len(runs) == 1:
+        return runs[0].read()
+    return _merge(runs, key)
+
+
+def _spill(runs, buf, key, tmp_dir):
+    """
+    Sorts a full buffer and writes it out, extending the last run if the
+    buffer starts where it left off.
+
+    :param runs:    The runs spilled so far, appended to in place
+    :param buf:     The buffer to spill
+    :param key:     The sort key function
+    :param tmp_dir: The directory to spill runs to
+    """
+    _sort_buffer(buf, key)
+    if not runs or key(buf[0]) < runs[-1].last_key:
+        runs.append(_Run(tmp_dir))
+    runs[-1].extend(buf, key)
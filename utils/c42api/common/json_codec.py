@@ -0,0 +1,144 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The JSON encoder and decoder c42api reads and writes JSON with. The fastest
+backend that encodes exactly what the stdlib json module does is picked at
+import time, and every backend writes compact output with no spaces after
+separators.
+
+Set the C42_JSON_BACKEND environment variable, or call set_backend, to force
+a backend:
+
+    simplejson  simplejson, only when its C speedups are compiled
+    stdlib      the json module
+    ujson       ujson, never picked automatically since it formats floats
+                with less precision
+"""
+
+import json
+import os
+
+BACKEND_SETTING = 'C42_JSON_BACKEND'
+SEPARATORS = (',', ':')
+# The backends tried, in order, when none is forced.
+AUTO_BACKENDS = ('simplejson', 'stdlib')
+
+
+def _stdlib():
+    """:return: The stdlib json module's (dumps, loads)"""
+    return json.JSONEncoder(separators=SEPARATORS).encode, json.loads
+
+
+def _simplejson():
+    """
+    :raise ImportError: If simplejson or its C speedups aren't installed
+    :return:            simplejson's (dumps, loads)
+    """
+    # pylint: disable=import-error,unused-variable
+    import simplejson
+    from simplejson import _speedups
+    return simplejson.JSONEncoder(separators=SEPARATORS).encode, simplejson.loads
+
+
+def _ujson():
+    """
+    :raise ImportError: If ujson isn't installed
+    :return:            ujson's (dumps, loads)
+    """
+    # pylint: disable=import-error
+    import ujson
+
+    def dumps(obj):
+        """Encodes like the json module, which doesn't escape slashes"""
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return dumps, ujson.loads
+
+
+_BACKENDS = {'simplejson': _simplejson,
+             'stdlib': _stdlib,
+             'ujson': _ujson}
+_backend = None
+_dumps = None
+_loads = None
+
+
+def set_backend(name=None):
+    """
+    Switches every later dumps and loads to a backend.
+
+    :raise ValueError:  If there is no backend by that name
+    :raise ImportError: If the backend's library isn't installed
+    :param name:        The backend's name, or None to use the one named by
+                         the C42_JSON_BACKEND environment variable, or else
+                         the fastest one installed
+    """
+    # pylint: disable=global-statement
+    global _backend, _dumps, _loads
+    name = name or os.environ.get(BACKEND_SETTING)
+    if name:
+        if name not in _BACKENDS:
+            raise ValueError("Unknown JSON backend '{}', expected one of {}".format(name, sorted(_BACKENDS)))
+        _dumps, _loads = _BACKENDS[name]()
+        _backend = name
+        return
+    for candidate in AUTO_BACKENDS:
+        try:
+            _dumps, _loads = _BACKENDS[candidate]()
+        except ImportError:
+            continue
+        _backend = candidate
+        return
+
+
+def backend():
+    """:return: The name of the backend in use"""
+    return _backend
+
+
+def available_backends():
+    """:return: The names of every backend whose library is installed"""
+    available = []
+    for name in sorted(_BACKENDS):
+        try:
+            _BACKENDS[name]()
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def dumps(obj):
+    """
+    :param obj: Anything the json module can encode
+    :return:    Its compact JSON
+    """
+    return _dumps(obj)
+
+
+def loads(text):
+    """
+    :param text: A JSON document
+    :return:     What it decodes to
+    """
+    return _loads(text)
+
+
+set_backend()
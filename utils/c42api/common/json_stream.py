@@ -0,0 +1,172 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+An incremental JSON reader that yields the elements of one array in a
+document as the document arrives, so a response far larger than memory can be
+processed one element at a time.
+"""
+
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_STRUCTURE = re.compile(r'["\[\]{},:]')
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# The characters that can follow a complete array element. Anything else, or
+# the end of the buffer, may mean the element (e.g. a number) isn't finished.
+_ELEMENT_END = frozenset(u' \t\n\r,]')
+_DECODER = json.JSONDecoder()
+
+
+class _Frame(object):
+    """
+    An object or array the reader is currently inside of.
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('is_object', 'key', 'expecting_key')
+
+    def __init__(self, is_object):
+        self.is_object = is_object
+        self.key = None
+        self.expecting_key = is_object
+
+
+def _is_target(stack, path):
+    """
+    Whether an array opened inside the given frames sits at the path.
+
+    :param stack: The frames the array is opened inside of
+    :param path:  The object keys leading to the wanted array
+    :return:      True if the array is the wanted one
+    """
+    if len(stack) != len(path):
+        return False
+    return all(frame.is_object and frame.key == key for frame, key in zip(stack, path))
+
+
+def iter_array(chunks, path):
+    """
+    Yields the elements of the array found by following the path of object
+    keys from the top of a JSON document. Only the element being read is ever
+    held in memory, along with the chunk it is read from. If the path doesn't
+    lead to an array nothing is yielded.
+
+    The document is only scanned character by character until the array is
+    found. Each of its elements is then decoded in one go by the json module's
+    decoder, so reading the array costs little more than json.loads.
+
+    :raise ValueError: If an element is malformed, or the document ends
+                        inside the array
+    :param chunks:     An iterable of the document's bytes, UTF-8 encoded
+    :param path:       A sequence of object keys leading to the array. An
+                        empty path means the document is the array.
+    :return:           A generator of the decoded elements of the array
+    """
+    path = list(path)
+    stack = []
+    buf = u''
+    pos = 0
+    in_target = False
+    decode_utf8 = codecs.getincrementaldecoder('UTF-8')().decode
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buf = buf[pos:] + decode_utf8(chunk)
+        pos = 0
+        while True:
+            if in_target:
+                pos = _WHITESPACE.match(buf, pos).end()
+                if pos == len(buf):
+                    break
+                char = buf[pos]
+                if char == u',':
+                    pos += 1
+                elif char == u']':
+                    stack.pop()
+                    in_target = False
+                    pos += 1
+                else:
+                    try:
+                        element, end = _DECODER.raw_decode(buf, pos)
+                    except ValueError:
+                        # The element continues in the next chunk.
+                        break
+                    if end == len(buf) or buf[end] not in _ELEMENT_END:
+                        break
+                    yield element
+                    pos = end
+                continue
+            match = _STRUCTURE.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            char = match.group()
+            index = match.start()
+            frame = stack[-1] if stack else None
+            if char == u'"':
+                end = _STRING_END.match(buf, index + 1)
+                if not end:
+                    # The string continues in the next chunk.
+                    pos = index
+                    break
+                if frame is not None and frame.expecting_key:
+                    frame.key = json.loads(buf[index:end.end()])
+                pos = end.end()
+                continue
+            pos = index + 1
+            if char == u':':
+                frame.expecting_key = False
+            elif char == u',':
+                if frame.is_object:
+                    frame.expecting_key = True
+            elif char == u'{':
+                stack.append(_Frame(True))
+            elif char == u'[':
+                in_target = _is_target(stack, path)
+                stack.append(_Frame(False))
+            else:
+                stack.pop()
+    if in_target:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos < len(buf):
+            # Decoding what is left raises the error for a malformed element.
+            _DECODER.raw_decode(buf, pos)
+        raise ValueError("The JSON document ended inside the array")
+
+
+def iter_response_array(response, path, chunk_size=CHUNK_SIZE):
+    """
+    Yields the elements of an array in a streamed response's JSON body, then
+    closes the response so its connection goes back to the pool.
+
+    :param response:   A response requested with stream=True
+    :param path:       A sequence of object keys leading to the array
+    :param chunk_size: The number of bytes to read from the socket at a time
+    :return:           A generator of the decoded elements of the array
+    """
+    try:
+        for element in iter_array(response.iter_content(chunk_size), path):
+            yield element
+    finally:
+        response.close()
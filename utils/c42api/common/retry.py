@@ -0,0 +1,163 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A policy for retrying requests that failed for a transient reason.
+"""
+
+import email.utils
+import random
+import time
+
+import requests
+
+# Statuses a server sends when a request may succeed if made again later.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Exceptions raised when a connection fails, is reset, or times out.
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+# Exceptions raised before a request could have reached the server. Only
+# these are retried for a request that isn't idempotent. A ConnectionError
+# isn't one of them: requests raises it for a refused connection and for one
+# dropped after the request was sent alike.
+CONNECT_EXCEPTIONS = (requests.exceptions.ConnectTimeout,)
+# Methods that leave the server in the same state however many times they're made.
+IDEMPOTENT_METHODS = frozenset(['get', 'head', 'put', 'delete', 'options'])
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and after how long, a failed request is made again.
+
+    The delay before each retry grows exponentially from backoff up to
+    max_backoff, and is shortened by a random fraction (up to jitter) so
+    that clients failing together don't retry together. If the server sent
+    a Retry-After header, it is honoured instead, up to max_retry_after.
+
+    A request that isn't idempotent, e.g. a POST that creates a token, is
+    only retried if it failed before it could have reached the server, so
+    one the server already handled is never made twice.
+
+    This class is immutable.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30, jitter=0.5, max_retry_after=300,
+                 retry_statuses=RETRY_STATUSES, retry_exceptions=RETRY_EXCEPTIONS,
+                 connect_exceptions=CONNECT_EXCEPTIONS):
+        """
+        :param max_attempts:       The number of times a request is made before
+                                    giving up. 1 never retries.
+        :param backoff:            The delay in seconds before the first retry
+        :param max_backoff:        The longest delay in seconds between retries
+        :param jitter:             The largest fraction a delay is shortened by
+        :param max_retry_after:    The longest Retry-After in seconds honoured
+        :param retry_statuses:     The HTTP statuses worth retrying
+        :param retry_exceptions:   The exceptions worth retrying
+        :param connect_exceptions: The exceptions worth retrying for a
+                                    request that isn't idempotent
+        """
+        self._max_attempts = max(1, max_attempts)
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._jitter = jitter
+        self._max_retry_after = max_retry_after
+        self._retry_statuses = frozenset(retry_statuses)
+        self._retry_exceptions = tuple(retry_exceptions)
+        self._connect_exceptions = tuple(connect_exceptions)
+
+    @property
+    def max_attempts(self):
+        """Getter for the immutable max_attempts"""
+        return self._max_attempts
+
+    def is_retryable(self, error, idempotent=True):
+        """
+        :param error:      The exception a request raised
+        :param idempotent: Whether the request is safe to make again after
+                            it may have reached the server
+        :return:           True if the request may succeed if made again
+        """
+        if not idempotent:
+            return isinstance(error, self._connect_exceptions)
+        response = getattr(error, 'response', None)
+        if response is not None and response.status_code in self._retry_statuses:
+            return True
+        return isinstance(error, self._retry_exceptions)
+
+    def delay(self, attempt, error=None):
+        """
+        :param attempt: The number of the attempt that just failed, from 1
+        :param error:   The exception that attempt raised
+        :return:        How long to wait, in seconds, before the next attempt
+        """
+        retry_after = _retry_after(getattr(error, 'response', None))
+        if retry_after is not None:
+            return min(retry_after, self._max_retry_after)
+        delay = min(self._max_backoff, self._backoff * 2 ** (attempt - 1))
+        return delay * (1 - self._jitter * random.random())
+
+    def call(self, request, on_retry=None, idempotent=True):
+        """
+        Makes a request, retrying it for as long as the policy allows.
+
+        :raise RequestException: What the last attempt raised
+        :param request:          A function that makes the request
+        :param on_retry:         An optional function called with the attempt
+                                  number, the exception and the delay before
+                                  each retry
+        :param idempotent:       Whether the request is safe to make again
+                                  after it may have reached the server
+        :return:                 The request's result and how many times it
+                                  was retried
+        """
+        attempt = 1
+        while True:
+            try:
+                return request(), attempt - 1
+            except requests.RequestException as e:
+                if attempt >= self._max_attempts or not self.is_retryable(e, idempotent):
+                    e.retries = attempt - 1
+                    raise
+                delay = self.delay(attempt, e)
+                if on_retry:
+                    on_retry(attempt, e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+def _retry_after(response):
+    """
+    :param response: The response to a failed request, or None
+    :return:         The number of seconds its Retry-After header asks to
+                      wait, or None if it has none
+    """
+    if response is None or not getattr(response, 'headers', None):
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if not parsed:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
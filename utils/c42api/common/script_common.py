@@ -26,7 +26,8 @@ A collection of basic helper functions for several scripts.
 import sys
 import contextlib
 import os
-import functools
+
+from c42api.common.cache import ttl_cache, FOREVER
 
 
 @contextlib.contextmanager
@@ -57,22 +58,11 @@ def smart_open(filename, overwrite=False):
 # decorator
 def memoize(func):
     """
-    A decorator that caches output based on input.
+    A decorator that caches output based on input, for as long as the process
+    runs. Falsy results are not cached. Prefer cache.ttl_cache, which bounds
+    how long and how many results are kept.
 
     :param func: The function to cache the results of
     :return:     The new function with the cache built in
     """
-    memo = {}
-
-    @functools.wraps(func)
-    def memoized_func(*args, **kwargs):
-        """
-        The wrapper function for the memoize decorator
-        """
-        if args not in memo:
-            result = func(*args, **kwargs)
-            if result:
-                memo[args] = result
-        return memo[args]
-
-    return memoized_func
+    return ttl_cache(ttl=FOREVER, max_entries=sys.maxint)(func)
@@ -23,42 +23,194 @@ A collection of functions related to script output.
 """
 
 # pylint: disable=import-error
-import json
+import atexit
+import cPickle as pickle
+import itertools
+import os
+import signal
+import tempfile
+import time
+import weakref
+from threading import Lock, RLock
 
 from c42csv import c42_csv as csv
+from c42api.common import json_codec
 from c42api.common import logging_config
 
 LOG = logging_config.get_logger(__name__)
+# The number of items write_csv looks at to find the csv columns, and how
+# many bytes of them it holds in memory before spilling them to disk.
+SAMPLE_SIZE = 1000
+SAMPLE_MEMORY = 1024 * 1024
+# The default flush policy of a SplunkEventWriter. It writes out its buffer
+# once it holds this many bytes or events, or its oldest event is this many
+# seconds old.
+FLUSH_BYTES = 1024 * 1024
+FLUSH_EVENTS = 10000
+FLUSH_SECONDS = 5.0
+# The signals a SplunkEventWriter flushes on before the process dies.
+FATAL_SIGNALS = ('SIGTERM', 'SIGHUP')
+_OPEN_WRITERS = weakref.WeakSet()
+_HANDLERS_LOCK = Lock()
+_HANDLERS = []
 
-def write_csv(out, json_list, header=False, shallow=False, keyset=None):
+def write_csv(out, json_list, header=False, shallow=False, keyset=None, sample_size=SAMPLE_SIZE,
+              header_path=None):
     """
     Print a json list as csv. Rather than have to create an entire list in
     memory, this prints out each element of the list individually.
-    :param out:       The file in which to print (or stdout)
-    :param json_list: An iterable containing things that can be dumped by json
-                       (typically lists or dicts)
-    :param header:    Whether or not to include a csv header in the output
-    :param shallow:   Whether or not to shallow parse. If True, only parse the
-                       top level keys, and use the child value as the value,
-                       event if it is a dictionary or list. Default is False.
-    :param keyset:    A pre-populated KeySet object specifying how to write
-                       the items in json_list to the csv file. Ignore this
-                       if you want the KeySet to be generated for you.
+
+    Unless a KeySet is given, the columns are every key found in the first
+    sample_size items. Those items are held back, spilling to a temporary
+    file past SAMPLE_MEMORY bytes, until the columns are known. Keys that
+    first appear after the sample are left out, unless the header is written
+    to header_path instead of out. In that case a new top level key adds
+    columns after the existing ones from then on, and the header file is
+    replaced with the wider header.
+    :param out:         The file in which to print (or stdout)
+    :param json_list:   An iterable containing things that can be dumped by
+                         json (typically lists or dicts)
+    :param header:      Whether or not to include a csv header in the output
+    :param shallow:     Whether or not to shallow parse. If True, only parse
+                         the top level keys, and use the child value as the
+                         value, event if it is a dictionary or list. Default
+                         is False.
+    :param keyset:      A pre-populated KeySet object specifying how to write
+                         the items in json_list to the csv file. Ignore this
+                         if you want the KeySet to be generated for you.
+                         Freezing it lets repeated calls share one RowPlan.
+    :param sample_size: The number of items to find the columns from
+    :param header_path: A file to write the header to, widening it as new
+                         keys appear, rather than writing it to out
     """
-    if not keyset:
+    if keyset is None:
         keyset = csv.KeySet()
-    for item in json_list:
-        if not keyset:
-            for key, value in item.items():
-                json_key = csv.create_key(key, value, shallow)
-                keyset.add_key(json_key)
-            if header:
-                write_header_from_keyset(keyset, out)
-        values = []
-        for top_level_key in keyset.all_keys():
-            values = values + csv.dict_into_values(item, top_level_key, 0, shallow)
-        csv_string = csv.create_csv_string(values)
-        out.write(csv_string.encode('UTF-8') + '\n')
+    items = iter(json_list)
+    sampled = False
+    if not keyset:
+        sample = _Sample()
+        for item in itertools.islice(items, max(1, sample_size)):
+            _add_keys(keyset, item, shallow)
+            sample.append(item)
+        if not len(sample):
+            return
+        sampled = True
+        keyset.freeze()
+        items = itertools.chain(sample.replay(), items)
+
+    if header_path is not None:
+        _write_widening_csv(out, items, keyset, shallow, header_path)
+        return
+    if header and sampled:
+        write_header_from_keyset(keyset, out)
+    plan = keyset.plan(shallow)
+    for item in items:
+        out.write(plan.csv_string(item).encode('UTF-8') + '\n')
+
+
+def _add_keys(keyset, item, shallow):
+    """
+    Adds the keys of an item to a KeySet.
+    :param keyset:  The KeySet to add to
+    :param item:    The dictionary whose keys to add
+    :param shallow: Whether only to add the top level keys
+    """
+    for key, value in item.items():
+        keyset.add_key(csv.create_key(key, value, shallow))
+
+
+class _Sample(object):
+    """
+    The items write_csv holds back while it finds the columns, kept in
+    memory up to SAMPLE_MEMORY bytes and in a temporary file after that.
+    Items are pickled so they come back exactly as they went in.
+    """
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=SAMPLE_MEMORY)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, item):
+        """
+        Holds back an item.
+        :param item: The item
+        """
+        pickle.dump(item, self._file, pickle.HIGHEST_PROTOCOL)
+        self._count += 1
+
+    def replay(self):
+        """
+        Yields the held back items in order, then discards them.
+        :return: A generator of the items
+        """
+        try:
+            self._file.seek(0)
+            for _ in range(self._count):
+                yield pickle.load(self._file)
+        finally:
+            self._file.close()
+
+
+def _write_widening_csv(out, items, keyset, shallow, header_path):
+    """
+    Prints items as csv with the header in a separate file. An item with a
+    top level key that isn't a column yet adds its columns after the
+    existing ones, and the header file is replaced with the wider header.
+    Rows printed before then are simply shorter than the header.
+    :param out:         The file in which to print
+    :param items:       The items to print
+    :param keyset:      The KeySet of the columns so far
+    :param shallow:     Whether or not to shallow parse
+    :param header_path: The file to keep the header in
+    """
+    plan = keyset.plan(shallow)
+    _replace_header(header_path, plan.header)
+    top_level_keys = set(keyset.keys)
+    for item in items:
+        if not top_level_keys.issuperset(item):
+            wider = keyset.union(csv.KeySet())
+            _add_keys(wider, item, shallow)
+            wider_plan = csv.RowPlan(wider, shallow)
+            order = _column_order(plan.header, wider_plan.header)
+            plan = csv.RowPlan(wider, shallow, order)
+            keyset = wider
+            top_level_keys = set(keyset.keys)
+            LOG.debug("Widened csv header to %d columns", len(plan.header))
+            _replace_header(header_path, plan.header)
+        out.write(plan.csv_string(item).encode('UTF-8') + '\n')
+
+
+def _column_order(old_header, new_header):
+    """
+    Works out the order to write a wider header's columns in, so the old
+    columns keep their places and the new ones come after them.
+    :param old_header: The columns so far, in the order they're written
+    :param new_header: The wider header's columns, in sorted key order
+    :return:           The index in new_header of each column to write
+    """
+    positions = {}
+    for index, name in enumerate(new_header):
+        positions.setdefault(name, []).append(index)
+    order = [positions[name].pop(0) for name in old_header]
+    used = set(order)
+    return order + [index for index in range(len(new_header)) if index not in used]
+
+
+def _replace_header(header_path, columns):
+    """
+    Replaces a header file all at once, so it's never seen half written.
+    :param header_path: The header file
+    :param columns:     The header's columns
+    """
+    tmp_path = header_path + '.tmp'
+    with open(tmp_path, 'w') as header_file:
+        header_file.write(",".join(columns).encode('UTF-8') + "\n")
+    if os.name == 'nt' and os.path.exists(header_path):
+        # Windows won't rename over an existing file.
+        os.remove(header_path)
+    os.rename(tmp_path, header_path)
 
 
 def write_header_from_keyset(keyset, out):
@@ -67,10 +219,7 @@ def write_header_from_keyset(keyset, out):
     :param keyset: The KeySet used to generate the header
     :param out:    The opened file to print the header
     """
-    key_header = []
-    for top_level_key in keyset.all_keys():
-        key_header = csv.flattened_keys(top_level_key, key_header)
-    out.write(",".join(key_header).encode('UTF-8') + "\n")
+    out.write(keyset.plan().header_string().encode('UTF-8') + "\n")
 
 
 def write_json(out, json_list):
@@ -87,7 +236,7 @@ def write_json(out, json_list):
         if not first:
             out.write(',\n')
         first = False
-        line = json.dumps(item)
+        line = json_codec.dumps(item)
         out.write(line)
     out.write('\n]\n')
 
@@ -102,5 +251,148 @@ def write_json_splunk(out, json_list):
                        (typically lists or dicts)
     """
     for item in json_list:
-        line = json.dumps(item)
+        line = json_codec.dumps(item)
         out.write(line + "\n")
+
+
+class SplunkEventWriter(object):
+    """
+    Writes events to Splunk one per line, like write_json_splunk(), but
+    serializes them into a buffer and writes the whole buffer to out at once,
+    rather than making a write for every event.
+
+    The buffer is written out whenever the flush policy is met after a call to
+    write_events(), so a page of events always goes out in one write. The
+    policy is only checked then: there is no timer, so events buffered before
+    a stream stalls wait for the next write, flush() or close(). Every open
+    writer is also flushed when the process exits, or is killed by one of
+    FATAL_SIGNALS.
+    """
+    def __init__(self, out, max_bytes=FLUSH_BYTES, max_events=FLUSH_EVENTS, max_seconds=FLUSH_SECONDS):
+        """
+        :param out:         The file in which to print (or stdout)
+        :param max_bytes:   Flush once the buffer holds this many bytes
+        :param max_events:  Flush once the buffer holds this many events. 1
+                             writes out every call to write_events().
+        :param max_seconds: Flush on the next write once the oldest buffered
+                             event was written this many seconds ago
+        """
+        self.out = out
+        self.max_bytes = max_bytes
+        self.max_events = max_events
+        self.max_seconds = max_seconds
+        self._lock = RLock()
+        self._buffer = []
+        self._bytes = 0
+        self._events = 0
+        self._oldest = None
+        _install_handlers()
+        _OPEN_WRITERS.add(self)
+
+    def write_events(self, json_list):
+        """
+        Buffers a list of events, flushing if that meets the flush policy.
+        :param json_list: An iterable containing things that can be dumped by
+                           json (typically dicts)
+        """
+        self.write_lines([json_codec.dumps(item) for item in json_list])
+
+    def write_lines(self, lines):
+        """
+        Buffers a list of events that are already encoded, flushing if that
+        meets the flush policy.
+        :param lines: A list of JSON strings, without newlines
+        """
+        if not lines:
+            return
+        chunk = '\n'.join(lines) + '\n'
+        with self._lock:
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._buffer.append(chunk)
+            self._bytes += len(chunk)
+            self._events += len(lines)
+            if (self._bytes >= self.max_bytes or self._events >= self.max_events or
+                    time.time() - self._oldest >= self.max_seconds):
+                self.flush()
+
+    def flush(self):
+        """
+        Writes out everything buffered, then flushes out. If the write fails,
+        the events stay buffered.
+        """
+        with self._lock:
+            # Write before clearing the buffer, so a signal handler flushing in
+            # the middle of this writes the events again rather than losing them.
+            if self._buffer:
+                self.out.write(''.join(self._buffer))
+                self.discard()
+            self.out.flush()
+
+    def discard(self):
+        """
+        Drops everything buffered without writing it.
+        """
+        with self._lock:
+            self._buffer = []
+            self._bytes = 0
+            self._events = 0
+            self._oldest = None
+
+    def close(self):
+        """
+        Flushes the writer. out is left open.
+        """
+        self.flush()
+        _OPEN_WRITERS.discard(self)
+
+
+def _flush_open_writers():
+    """
+    Flushes every open SplunkEventWriter.
+    """
+    for writer in list(_OPEN_WRITERS):
+        try:
+            writer.flush()
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("Failed to flush Splunk events")
+
+
+def _install_handlers():
+    """
+    Flushes the open SplunkEventWriters at exit and on FATAL_SIGNALS, the
+    first time a writer is created. Signal handlers can only be set from the
+    main thread, so from any other thread only the exit handler is installed.
+    """
+    with _HANDLERS_LOCK:
+        if _HANDLERS:
+            return
+        _HANDLERS.append(atexit.register(_flush_open_writers))
+        for name in FATAL_SIGNALS:
+            signum = getattr(signal, name, None)
+            if signum is None:
+                continue
+            previous = signal.getsignal(signum)
+            if previous == signal.SIG_IGN:
+                continue
+            try:
+                signal.signal(signum, _fatal_signal_handler(previous))
+            except ValueError:
+                return
+
+
+def _fatal_signal_handler(previous):
+    """
+    :param previous: The handler that was set for the signal before
+    :return:         A signal handler that flushes the open writers, then
+                      hands the signal on to previous, or dies of it
+    """
+    def handler(signum, frame):
+        """Flushes the open writers, then passes the signal on"""
+        _flush_open_writers()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+    return handler
@@ -24,12 +24,20 @@ run its tests.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import base64
-import json
+import copy
 import functools
+import collections
+import sys
+import threading
+import time
 from datetime import datetime
 from c42api.common import logging_config
 from c42api.common import analytics
+from c42api.common import json_codec
+from c42api.common import json_stream
+from c42api.common.retry import IDEMPOTENT_METHODS, RetryPolicy
 
 LOG = logging_config.get_logger(__name__)
 
@@ -37,33 +45,114 @@ LOG = logging_config.get_logger(__name__)
 # decorator
 def monitor_network(func):
     """
-    Decorator that gets the size of the returned response object
+    Decorator that gets the size of the returned response object. The
+    analytic is queued for the background analytics writer, so requests are
+    never serialized behind analytics file I/O.
 
     :param func: A function that returns an http response
     :return:     The wrapped function
     """
 
     @functools.wraps(func)
-    @analytics.with_lock
     def wrapper_func(*args, **kwargs):
         """
         The wrapper function that grabs analytics from REST calls
         """
-        analytic = kwargs.copy()
+        analytic = copy.deepcopy(kwargs)
+        # The analytic is written later, on another thread, so it mustn't share
+        # anything the caller might change in the meantime.
+        resource = copy.deepcopy(list(args)[1:])
         analytic['start_time'] = datetime.now().isoformat()
-        result = func(*args, **kwargs)
+        try:
+            result = func(*args, **kwargs)
+        except requests.RequestException as e:
+            if getattr(e, 'retries', 0):
+                analytic['end_time'] = datetime.now().isoformat()
+                analytic['retries'] = e.retries
+                analytic['throttle_wait'] = round(getattr(e, 'throttle_wait', 0), 3)
+                analytic['func_call'] = func.__name__
+                analytic['resource'] = resource
+                analytics.enqueue_json_analytics('network', analytic, size_limit=1024 * 1024)
+            raise
         analytic['end_time'] = datetime.now().isoformat()
 
-        analytic['response_size'] = len(result.content)
+        analytic['retries'] = getattr(result, 'retries', 0)
+        if getattr(args[0], 'concurrency', None):
+            analytic['concurrency_limit'] = args[0].concurrency.limit
+        analytic['throttle_wait'] = round(getattr(result, 'throttle_wait', 0), 3)
+        if kwargs.get('stream'):
+            # Reading the content here would defeat streaming it.
+            analytic['response_size'] = int(result.headers.get('Content-Length') or 0)
+        else:
+            analytic['response_size'] = len(result.content)
         analytic['func_call'] = func.__name__
-        analytic['resource'] = list(args)[1:]
-        analytics.write_json_analytics('network', analytic, size_limit=1024 * 1024)
+        analytic['resource'] = resource
+        analytics.enqueue_json_analytics('network', analytic, size_limit=1024 * 1024)
 
         return result
 
     return wrapper_func
 
 
+def _create_session(pool_size, verify_ssl):
+    """
+    Creates a keep-alive HTTP session with a connection pool for both http and
+    https.
+
+    :param pool_size:  The number of connections kept alive per host
+    :param verify_ssl: Whether to verify SSL certificates
+    :return:           The configured requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.verify = verify_ssl
+    return session
+
+
+class _PageRequest(object):
+    """
+    A single page request running on its own thread. The response content, or
+    the exception raised while requesting it, is handed back by result().
+    """
+    def __init__(self, request, page_number):
+        """
+        Starts the request immediately.
+
+        :param request:     A function taking a page number and returning content
+        :param page_number: The page to request
+        """
+        self._content = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(request, page_number))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, request, page_number):
+        """The body of the request thread"""
+        try:
+            self._content = request(page_number)
+        except Exception:  # pylint: disable=broad-except
+            self._exc_info = sys.exc_info()
+
+    def wait(self):
+        """Blocks until the request finishes, ignoring its outcome."""
+        self._thread.join()
+
+    def result(self):
+        """
+        Blocks until the request finishes.
+
+        :raise Exception: Whatever the request raised
+        :return:          The page's content
+        """
+        self.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._content
+
+
 class Server(object):
     """
     Class representing a server object and a REST client. Once instantiated it
@@ -72,12 +161,24 @@ class Server(object):
     differing pieces of information between them.
 
     This class is immutable. Do not even try to mutate it.
+
+    Every request made through a Server goes through its own pooled, keep-alive
+    HTTP session, so consecutive requests against the same host reuse open
+    TCP/TLS connections instead of handshaking again. Requests that fail for a
+    transient reason (a 5xx, a 429 or a dropped connection) are retried as
+    its RetryPolicy allows, and every request waits on its Throttle and
+    AdaptiveConcurrency limit, if it has them.
     """
     MAX_PAGE_SIZE = 250
+    # Storage node Servers share the authority's session, so its pool keeps
+    # enough connections alive for the most requests allowed in flight to a
+    # node (storage_server.NODE_MAX_IN_FLIGHT).
+    DEFAULT_POOL_SIZE = 16
 
     # pylint: disable=too-many-arguments
     def __init__(self, server_address, port=None, username=None, password=None, protocol=None, authorization=None,
-                 verify_ssl=True):
+                 verify_ssl=True, pool_size=DEFAULT_POOL_SIZE, session=None, retry_policy=None,
+                 throttle=None, concurrency=None):
         """
         :param server_address: The address of the server
                                 (ex. code42.com -or- 10.10.32.128)
@@ -86,6 +187,20 @@ class Server(object):
         :param password:       The password for that username
         :param protocol:       Either http or https, default is to calculate this
                                  based on port & server_address fields.
+        :param verify_ssl:     Whether to verify SSL certificates
+        :param pool_size:      The number of connections kept alive per host.
+                                Ignored if a session is supplied.
+        :param session:        An optional requests.Session to share with
+                                another Server (ex. a storage node sharing the
+                                authority's connection pool)
+        :param retry_policy:   The RetryPolicy for failed requests. Defaults
+                                to retrying transient failures a few times.
+        :param throttle:       An optional Throttle limiting the requests made
+                                to the server, typically shared by every
+                                Server for the same host
+        :param concurrency:    An optional AdaptiveConcurrency limiting the
+                                requests in flight to the server, typically
+                                shared by every Server for the same host
         """
         server_address = server_address.rstrip('/')
         try:
@@ -131,6 +246,10 @@ class Server(object):
         self._username = username
         self._password = password
         self._verify_ssl = verify_ssl
+        self._session = session or _create_session(pool_size, verify_ssl)
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._throttle = throttle
+        self._concurrency = concurrency
         self.authorization = authorization
 
     @property
@@ -148,6 +267,26 @@ class Server(object):
         """Getter for the immutable verify_ssl"""
         return self._verify_ssl
 
+    @property
+    def session(self):
+        """Getter for the immutable session"""
+        return self._session
+
+    @property
+    def retry_policy(self):
+        """Getter for the immutable retry_policy"""
+        return self._retry_policy
+
+    @property
+    def throttle(self):
+        """Getter for the immutable throttle"""
+        return self._throttle
+
+    @property
+    def concurrency(self):
+        """Getter for the immutable concurrency"""
+        return self._concurrency
+
     @property
     def username(self):
         """Getter for the immutable username"""
@@ -202,8 +341,65 @@ class Server(object):
 
         return header, url
 
+    def _send(self, method, url, idempotent=None, **kwargs):
+        """
+        Sends a request through the session, retrying it as the retry policy
+        allows. Unless the caller says otherwise, only requests with an
+        idempotent method are retried once they may have reached the server.
+        Every attempt waits on the throttle, if there is one. The number of
+        retries and the time spent waiting on the throttle are recorded on the
+        response, or on the exception if every attempt failed.
+
+        :raise HTTPError: If the last attempt had a non-2xx response value
+        :param method:     The name of the session function to send it with
+        :param url:        The url to hit
+        :param idempotent: Whether the request is safe to make again after it
+                            may have reached the server. Defaults to whether
+                            the method is idempotent.
+        :return:           The response from the request
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        throttle_wait = [0.0]
+
+        def request():
+            """Makes a single attempt"""
+            if self.concurrency:
+                self.concurrency.acquire()
+            if self.throttle:
+                throttle_wait[0] += self.throttle.acquire()
+            start = time.time()
+            overloaded = False
+            try:
+                response = getattr(self.session, method)(url, verify=self.verify_ssl, **kwargs)
+                response.raise_for_status()
+                return response
+            except requests.RequestException as e:
+                # The same failures that are worth retrying mean the server is overloaded.
+                overloaded = self.retry_policy.is_retryable(e)
+                raise
+            finally:
+                if self.throttle:
+                    self.throttle.release()
+                if self.concurrency:
+                    self.concurrency.release(time.time() - start, overloaded)
+
+        def on_retry(attempt, error, delay):
+            """Logs each retry"""
+            LOG.info("Attempt %d of %s %s failed (%s), retrying in %.1f seconds",
+                     attempt, method.upper(), url, str(error), delay)
+
+        try:
+            response, retries = self.retry_policy.call(request, on_retry, idempotent)
+        except requests.RequestException as e:
+            e.throttle_wait = throttle_wait[0]
+            raise
+        response.retries = retries
+        response.throttle_wait = throttle_wait[0]
+        return response
+
     @monitor_network
-    def get(self, resource, params=None, login_token=None):
+    def get(self, resource, params=None, login_token=None, stream=False):
         """
         Executes a GET request based on the supplied parameters.
 
@@ -211,28 +407,30 @@ class Server(object):
         :param resource:  The API resource to hit, or a list that will be
                            joined by '/'
         :param params:    The parameters to include in the request
+        :param stream:    Whether to leave the body on the socket until it's
+                           read, e.g. with iter_json_array
         :return:          The response from the request
         """
         header, url = self._prep_request(resource, login_token)
-        response = requests.get(url, params=params, headers=header, verify=self.verify_ssl)
-        response.raise_for_status()
-        return response
+        return self._send('get', url, params=params, headers=header, stream=stream)
 
     @monitor_network
-    def post(self, resource, params=None, payload=None, login_token=None):
+    def post(self, resource, params=None, payload=None, login_token=None, idempotent=False):
         """
-        Executes a POST request based on the supplied parameters.
-
-        :raise HTTPError: If non-2xx response value
-        :param resource:  The API resource to hit, or a list that will be
-                           joined by '/'
-        :param params:    The parameters to include in the request
-        :return:          The response from the request
+        Executes a POST request based on the supplied parameters. It is only
+        retried if it failed before reaching the server, unless idempotent.
+
+        :raise HTTPError:  If non-2xx response value
+        :param resource:   The API resource to hit, or a list that will be
+                            joined by '/'
+        :param params:     The parameters to include in the request
+        :param idempotent: Whether the request is safe to make again after it
+                            may have reached the server, e.g. a search
+        :return:           The response from the request
         """
         header, url = self._prep_request(resource, login_token)
-        response = requests.post(url, params=params, data=json.dumps(payload), headers=header, verify=self.verify_ssl)
-        response.raise_for_status()
-        return response
+        return self._send('post', url, idempotent=idempotent, params=params,
+                          data=json_codec.dumps(payload), headers=header)
 
     @monitor_network
     def put(self, resource, params=None, login_token=None):
@@ -248,9 +446,7 @@ class Server(object):
         print('put is unused at the moment, and this isn\'t a real implementation. '
               'If you need a real implementation, please update this and add a test.')
         header, url = self._prep_request(resource, login_token)
-        response = requests.put(url, params=params, headers=header, verify=self.verify_ssl)
-        response.raise_for_status()
-        return response
+        return self._send('put', url, params=params, headers=header)
 
     @monitor_network
     def delete(self, resource, params=None, login_token=None):
@@ -266,9 +462,14 @@ class Server(object):
         print('delete is unused at the moment, and this isn\'t a real implementation. '
               'If you need a real implementation, please update this and add a test.')
         header, url = self._prep_request(resource, login_token)
-        response = requests.delete(url, params=params, headers=header, verify=self.verify_ssl)
-        response.raise_for_status()
-        return response
+        return self._send('delete', url, params=params, headers=header)
+
+    def close(self):
+        """
+        Closes every pooled connection held by this Server's session. Any
+        Server sharing the session is closed as well.
+        """
+        self.session.close()
 
     def url_name(self):
         """
@@ -291,27 +492,144 @@ class Server(object):
         :param response: The HTTP response that needs json extracted from it
         :return:         The dictionary the json represents.
         """
-        return json.loads(response.content.decode('UTF-8'))
+        return json_codec.loads(response.content.decode('UTF-8'))
 
-    def fetch_all_paged(self, resource_name, params, key):
-        """Yields items from a paged request."""
+    @staticmethod
+    def iter_json_array(response, path):
+        """
+        Yields the elements of an array in a streamed response's json one at a
+        time as they come off the socket, so the whole body is never in memory.
+
+        :param response: A response from get(..., stream=True)
+        :param path:     The keys leading to the array, e.g. ('data', 'users')
+        :return:         A generator of the array's elements
+        """
+        return json_stream.iter_response_array(response, path)
+
+    def fetch_all_paged(self, resource_name, params, key, prefetch=0, stream=False):
+        """
+        Yields items from a paged request, in page order.
+
+        By default pages are requested one after another until an empty page
+        comes back. With a prefetch window, up to that many pages are in flight
+        at once. If the first page reports a totalCount, no page past the last
+        one is requested; otherwise pages are requested speculatively and
+        anything after the first empty page is discarded.
+
+        :param resource_name: The API resource to hit
+        :param params:        The parameters to include in every request
+        :param key:           The key under 'data' holding each page's items
+        :param prefetch:      The maximum number of pages in flight at once.
+                               0 or 1 fetches pages sequentially.
+        :param stream:        Whether to parse each page's items off the socket
+                               as they arrive. Only used when fetching pages
+                               sequentially.
+        :return:              A generator of the items on every page
+        """
         def request(current_page):
-            """Executes a request for the next page of results and returns them"""
-            params['pgNum'] = str(current_page)
-            response = self.get(resource_name, params)
-            content = self.json_from_response(response)
+            """Executes a request for a page of results and returns its content"""
+            page_params = dict(params)
+            page_params['pgNum'] = str(current_page)
+            response = self.get(resource_name, page_params)
+            return self.json_from_response(response)
+
+        def items(content):
+            """Pulls the items out of a page's content"""
             try:
                 return content['data'][key]
-            except KeyError:
+            except (KeyError, TypeError):
                 return []
 
+        if prefetch > 1:
+            for result in self._fetch_pages_concurrently(request, items, params, prefetch):
+                yield result
+            return
+
+        if stream:
+            for result in self._fetch_pages_streamed(resource_name, params, key):
+                yield result
+            return
+
         page_number = 1
         results = True
         while results:
-            results = request(page_number)
+            results = items(request(page_number))
             page_number += 1
             for result in results:
                 yield result
 
+    def _fetch_pages_streamed(self, resource_name, params, key):
+        """
+        Requests pages one after another, yielding each page's items as they
+        are parsed off the socket, until a page has no items.
+
+        :param resource_name: The API resource to hit
+        :param params:        The parameters to include in every request
+        :param key:           The key under 'data' holding each page's items
+        :return:              A generator of the items on every page
+        """
+        page_number = 1
+        while True:
+            page_params = dict(params)
+            page_params['pgNum'] = str(page_number)
+            response = self.get(resource_name, page_params, stream=True)
+            count = 0
+            for result in self.iter_json_array(response, ('data', key)):
+                count += 1
+                yield result
+            if not count:
+                return
+            page_number += 1
+
+    @staticmethod
+    def _fetch_pages_concurrently(request, items, params, prefetch):
+        """
+        Keeps a window of page requests in flight and yields their items in
+        page order.
+
+        :param request:  A function taking a page number and returning content
+        :param items:    A function taking content and returning its items
+        :param params:   The request parameters, used to read pgSize
+        :param prefetch: The maximum number of pages in flight at once
+        :return:         A generator of the items on every page
+        """
+        first_page = request(1)
+        results = items(first_page)
+        for result in results:
+            yield result
+        if not results:
+            return
+
+        last_page = None
+        try:
+            total_count = int(first_page['data']['totalCount'])
+            page_size = int(params.get('pgSize', Server.MAX_PAGE_SIZE))
+            last_page = (total_count + page_size - 1) // page_size
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        window = collections.deque()
+        next_page = [2]
+
+        def schedule():
+            """Starts requests until the window is full or the last page is in flight"""
+            while len(window) < prefetch and (last_page is None or next_page[0] <= last_page):
+                window.append(_PageRequest(request, next_page[0]))
+                next_page[0] += 1
+
+        schedule()
+        try:
+            while window:
+                results = items(window.popleft().result())
+                if not results:
+                    break
+                for result in results:
+                    yield result
+                schedule()
+        finally:
+            # Don't leave speculative requests running once the caller is done.
+            for pending in window:
+                pending.wait()
+
     def __str__(self):
         return "Server:{0}".format(self.url_name())
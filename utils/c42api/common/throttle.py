@@ -0,0 +1,127 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Client-side limits on how hard a single host is hit.
+"""
+
+import threading
+import time
+
+
+class Throttle(object):
+    """
+    Limits the requests made to a host, with a token bucket allowing rate
+    requests per second (after an initial burst), and a bulkhead allowing at
+    most max_in_flight requests at once. Either limit may be left out.
+
+    The time callers spend waiting on either limit is counted, and reported by
+    stats().
+
+    A throttle is shared by every thread, and every Server, making requests to
+    its host.
+    """
+    def __init__(self, rate=None, burst=1, max_in_flight=None):
+        """
+        :param rate:          The sustained requests per second, or None
+        :param burst:         The requests that may be made at once before
+                               the rate applies
+        :param max_in_flight: The most requests in flight at once, or None
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last_refill = time.time()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._requests = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def _reserve_token(self):
+        """
+        Takes a token from the bucket, going into debt if it is empty.
+
+        :return: How long, in seconds, to wait until the token is available
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a request may be made. Every acquire() must be followed
+        by a release() once the request is done.
+
+        :return: How long, in seconds, the caller waited
+        """
+        start = time.time()
+        if self._in_flight:
+            self._in_flight.acquire()
+        if self.rate:
+            delay = self._reserve_token()
+            if delay:
+                time.sleep(delay)
+        waited = time.time() - start
+        with self._lock:
+            self._requests += 1
+            if waited > 0.001:
+                self._waits += 1
+                self._wait_time += waited
+        return waited
+
+    def release(self):
+        """
+        Marks a request made after acquire() as done.
+        """
+        if self._in_flight:
+            self._in_flight.release()
+
+    def stats(self):
+        """
+        :return: A dictionary of the number of requests made, how many of
+                  them waited, and the total seconds spent waiting
+        """
+        with self._lock:
+            return {'requests': self._requests,
+                    'waits': self._waits,
+                    'wait_time': round(self._wait_time, 3)}
+
+
+_HOST_LOCK = threading.Lock()
+_HOSTS = {}
+
+
+def for_host(host, rate=None, burst=1, max_in_flight=None):
+    """
+    Returns the throttle shared by every request to a host, creating it with
+    the given limits the first time the host is seen.
+
+    :param host: A key for the host, such as its scheme, hostname and port
+    :return:     The host's Throttle
+    """
+    with _HOST_LOCK:
+        if host not in _HOSTS:
+            _HOSTS[host] = Throttle(rate, burst, max_in_flight)
+        return _HOSTS[host]
@@ -42,7 +42,7 @@ def log_analytics(**kwargs):
     analytics.write_json_analytics(__name__, kwargs, result_limit=1)
 
 
-def fetch_computers(server, params=None, insert_schema_version=False):
+def fetch_computers(server, params=None, insert_schema_version=False, prefetch=0):
     """
     Returns an iterable (specifically a generator) containing json objects
     that represent devices.
@@ -51,6 +51,8 @@ def fetch_computers(server, params=None, insert_schema_version=False):
     :param params:                Params to make the API call with
     :param insert_schema_version: Modify the returned dicts to include the
                                   'schema_version' key.
+    :param prefetch:              The number of pages to request concurrently.
+                                  See Server.fetch_all_paged.
     """
     start_time = datetime.now().isoformat()
     device_count = 0
@@ -60,7 +62,7 @@ def fetch_computers(server, params=None, insert_schema_version=False):
     params = params or {}
     if 'pgSize' not in params:
         params['pgSize'] = str(Server.MAX_PAGE_SIZE)
-    devices = server.fetch_all_paged(resources.COMPUTER, params, 'computers')
+    devices = server.fetch_all_paged(resources.COMPUTER, params, 'computers', prefetch=prefetch)
     for device in devices:
         device_count += 1
         if insert_schema_version:
@@ -22,12 +22,16 @@
 
 from c42api.common import logging_config
 from c42api.common import resources
+from c42api.common.cache import ttl_cache
 from c42api import computers
 
 
 LOG = logging_config.get_logger(__name__)
+# How long, in seconds, an organization is cached before it is looked up again.
+ORG_TTL = 10 * 60
 
 
+@ttl_cache(ttl=ORG_TTL, max_entries=64)
 def organization(server, org_name=None):
     """
     Get a single organization that matches a query string.
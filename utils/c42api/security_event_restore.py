@@ -26,22 +26,48 @@ A script for fetching security detection events
 
 import re
 import sys
-import os
-import json
 from Queue import Queue
-from datetime import datetime
+from threading import Thread
+from datetime import datetime, timedelta
 import c42api
 
-from c42api.common.thread_pool import ThreadPool
-from c42api.common.atomic_counter import AtomicCounter
+from c42api.common.executor import Executor
 from c42api.common import resources
 from c42api.common import logging_config
+from c42api.common.cache import ttl_cache
+from c42api.common import concurrency
+from c42api.common import json_codec
+from c42api.common.checkpoint import CheckpointStore
 import c42api.storage_server as fetch_storage
 from c42api.common import analytics
 from requests import HTTPError, RequestException
 
 LOG = logging_config.get_logger(__name__)
 SCHEMA_VERSION = 1
+# The number of pages each worker may have waiting on the writer thread.
+PAGES_PER_WORKER = 2
+_PAGE = 'page'
+_RESULT = 'result'
+_ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+# Backfills are split into windows of a day. Past BACKFILL_MAX_WINDOWS days,
+# the newest half of the windows are a day long and the older half split the
+# rest of the range evenly.
+BACKFILL_WINDOW = timedelta(days=1)
+BACKFILL_MAX_WINDOWS = 90
+# The smallest step between detection event timestamps.
+_MILLISECOND = timedelta(milliseconds=1)
+# The fields a batched event's unbatched events share. The keynames were taken
+# directly from the possible outputs of SecurityDetectionEventResource.
+_SHARED_FIELDS = ("deviceAddress", "deviceGuid", "deviceRemoteAddress", "eventType", "eventUid",
+                  "formattedTimestamp", "ruleName", "schema_version", "userUid", "version", "detectionDevice",
+                  "cloudStorageProvider", "processName", "processOwner", "restoreId", "restoreType", "status",
+                  "requestingUserId", "sourceGuid", "targetGuid", "nodeGuid", "completedDate",
+                  "formattedCompletedDate", "startDate", "formattedStartDate", "totalBytes", "totalFiles",
+                  "problemCount", "failedChecksumCount")
+# Stand-ins for the file and timestamp while a batched event's shared fields
+# are encoded. Numbers are encoded the same by every JSON backend.
+_FILE_PLACEHOLDER = 4207611533285092719
+_TIMESTAMP_PLACEHOLDER = 4207611533285092720
 
 
 @analytics.with_lock
@@ -72,10 +98,12 @@ def _fetch_detection_events(server, plan_uid, event_filter):
     params['incFiles'] = True
     try:
         response = server.json_from_response(server.get(resources.SECURITY_DETECTION_EVENTS, params=params))
-    except RequestException:
+    except RequestException as e:
+        fetch_storage.invalidate_storage_server(server, e)
         # If we fail to get the page of events successfully, return empty cursor, events, and False.
         LOG.exception(
-            "Failed to get detection events from server %s for planUid %s with eventFilter %s. Please ensure the server is online",
+            "Failed to get detection events from server %s for planUid %s with eventFilter %s. "
+            "Please ensure the server is online",
             str(server),
             str(plan_uid),
             str(event_filter))
@@ -87,6 +115,7 @@ def _fetch_detection_events(server, plan_uid, event_filter):
         return None, None, False
 
 
+@ttl_cache(ttl=fetch_storage.TOPOLOGY_TTL, max_entries=4096, negative_ttl=fetch_storage.NEGATIVE_TTL)
 def _fetch_security_plan(server, device_guid):
     """
     Get plan with planType == 'SECURITY' for a device.
@@ -118,8 +147,8 @@ def _append_schema_version(detection_event):
 
 def _unbatch_files_in_events(detection_events):
     """
-    Convert a list of batched detection events into a list of single-file
-    detection events.
+    Convert a list of batched detection events into the JSON lines of
+    single-file detection events.
 
     Detection events can be batched, wherein a single event (for example,
     a PERSONAL_CLOUD_FILE_ACTIVITY event) may have an array of multiple file
@@ -127,76 +156,93 @@ def _unbatch_files_in_events(detection_events):
     another program or directly to a user. Hence, we will send individual
     events for each file.
 
+    Every file in a batch shares the rest of the event's fields, so rather
+    than copying and encoding them again for each file, they are encoded once
+    around the file and timestamp, and only those are encoded for each file.
+    The lines are byte for byte what encoding each event on its own would give.
+
     :param detection_events: A list of detection event dictionaries that may
                               or may not have a files list in them.
-    :return:                 A list of detection events each containing
-                              information about at most one file. (There may
-                              be no file information.)
+    :return:                 A list of JSON lines of detection events, each
+                              containing information about at most one file.
+                              (There may be no file information.)
     """
-    unbatched_events = []
+    unbatched_lines = []
     for detection_event in detection_events:
         try:
             files_list = detection_event["files"]
+            template = None
             for file_dict in files_list:
-                unbatched_event = _copy_detection_event(detection_event)
-                unbatched_event["file"] = file_dict
-                unbatched_event["timestamp"] = file_dict["detectionTimestamp"]
-                unbatched_events.append(unbatched_event)
+                timestamp = file_dict["detectionTimestamp"]
+                if template is None:
+                    # Encoding a template costs more than a single event, so it is only worth it for batches.
+                    template = len(files_list) > 1 and _unbatched_event_template(detection_event)
+                if template:
+                    before, between, after, file_first = template
+                    first, second = (file_dict, timestamp) if file_first else (timestamp, file_dict)
+                    unbatched_lines.append(before + json_codec.dumps(first) + between +
+                                           json_codec.dumps(second) + after)
+                else:
+                    unbatched_event = _copy_detection_event(detection_event)
+                    unbatched_event["file"] = file_dict
+                    unbatched_event["timestamp"] = timestamp
+                    unbatched_lines.append(json_codec.dumps(unbatched_event))
         except (KeyError, TypeError):
-            unbatched_events.append(detection_event)
+            unbatched_lines.append(json_codec.dumps(detection_event))
 
     LOG.debug("UNBATCHING DONE:")
-    return unbatched_events
+    return unbatched_lines
 
 
-# Manual implementation of copy.deepCopy(detectionEvent) to improve efficiency of the unbatching algorithm.
-# The keynames were taken directly from the possible outputs of SecurityDetectionEventResource
-# notice that fileStats, files, timestamp are omitted. This is intentional, as they are not needed by Splunk / are overridden.
-def _copy_detection_event(originalDetectionEvent):
-    try:
-        newEvent = {}
-        _put_if_exists("deviceAddress", newEvent, originalDetectionEvent)
-        _put_if_exists("deviceGuid", newEvent, originalDetectionEvent)
-        _put_if_exists("deviceRemoteAddress", newEvent, originalDetectionEvent)
-        _put_if_exists("eventType", newEvent, originalDetectionEvent)
-        _put_if_exists("eventUid", newEvent, originalDetectionEvent)
-        _put_if_exists("formattedTimestamp", newEvent, originalDetectionEvent)
-        _put_if_exists("ruleName", newEvent, originalDetectionEvent)
-        _put_if_exists("schema_version", newEvent, originalDetectionEvent)
-        _put_if_exists("userUid", newEvent, originalDetectionEvent)
-        _put_if_exists("version", newEvent, originalDetectionEvent)
-        _put_if_exists("detectionDevice", newEvent, originalDetectionEvent)
-        _put_if_exists("cloudStorageProvider", newEvent, originalDetectionEvent)
-        _put_if_exists("processName", newEvent, originalDetectionEvent)
-        _put_if_exists("processOwner", newEvent, originalDetectionEvent)
-        _put_if_exists("restoreId", newEvent, originalDetectionEvent)
-        _put_if_exists("restoreType", newEvent, originalDetectionEvent)
-        _put_if_exists("status", newEvent, originalDetectionEvent)
-        _put_if_exists("requestingUserId", newEvent, originalDetectionEvent)
-        _put_if_exists("sourceGuid", newEvent, originalDetectionEvent)
-        _put_if_exists("targetGuid", newEvent, originalDetectionEvent)
-        _put_if_exists("nodeGuid", newEvent, originalDetectionEvent)
-        _put_if_exists("completedDate", newEvent, originalDetectionEvent)
-        _put_if_exists("formattedCompletedDate", newEvent, originalDetectionEvent)
-        _put_if_exists("startDate", newEvent, originalDetectionEvent)
-        _put_if_exists("formattedStartDate", newEvent, originalDetectionEvent)
-        _put_if_exists("totalBytes", newEvent, originalDetectionEvent)
-        _put_if_exists("totalFiles", newEvent, originalDetectionEvent)
-        _put_if_exists("problemCount", newEvent, originalDetectionEvent)
-        _put_if_exists("failedChecksumCount", newEvent, originalDetectionEvent)
-
-        return newEvent
-    except Exception as e:
-        LOG.exception("Manual KeyMapping has failed")
-
-
-def _put_if_exists(fieldName, newEvent, oldEvent):
-    if oldEvent.get(fieldName) != None: newEvent[fieldName] = oldEvent.get(fieldName)
-    return None
+def _unbatched_event_template(detection_event):
+    """
+    Encodes a batched event's shared fields once, with placeholders for the
+    file and timestamp. The fields are added in the same order as every
+    unbatched event's, so the dictionary, and so its JSON, is laid out the
+    same.
+
+    :param detection_event: A batched detection event
+    :return:                The JSON (before, between, after) the file and
+                             timestamp, and whether the file comes first, or
+                             None if a placeholder also turns up in the
+                             event's own fields
+    """
+    template = _copy_detection_event(detection_event)
+    template["file"] = _FILE_PLACEHOLDER
+    template["timestamp"] = _TIMESTAMP_PLACEHOLDER
+    encoded = json_codec.dumps(template)
+    file_placeholder = str(_FILE_PLACEHOLDER)
+    timestamp_placeholder = str(_TIMESTAMP_PLACEHOLDER)
+    if encoded.count(file_placeholder) != 1 or encoded.count(timestamp_placeholder) != 1:
+        return None
+    file_first = encoded.index(file_placeholder) < encoded.index(timestamp_placeholder)
+    first, second = (file_placeholder, timestamp_placeholder) if file_first else \
+        (timestamp_placeholder, file_placeholder)
+    before, rest = encoded.split(first)
+    between, after = rest.split(second)
+    return before, between, after, file_first
+
+
+def _copy_detection_event(detection_event):
+    """
+    Copies the fields that every one of a batched event's unbatched events
+    shares. fileStats, files and timestamp are left out, as Splunk doesn't
+    need them or they are replaced. Fields that are None are left out too.
+
+    :param detection_event: A batched detection event
+    :return:                A new dictionary of its shared fields
+    """
+    new_event = {}
+    for field in _SHARED_FIELDS:
+        value = detection_event.get(field)
+        if value is not None:
+            new_event[field] = value
+    return new_event
 
 
 # pylint: disable=invalid-name
-def _fetch_detection_events_for_device(authority, device_guid, detection_event_filter, cursor_dict):
+def _fetch_detection_events_for_device(authority, device_guid, detection_event_filter, cursor_dict,
+                                       write_page=None):
     """
     Returns unbatched detection events and the corresponding min_timestamp string (ISO format)
     for the target device. 
@@ -210,15 +256,21 @@ def _fetch_detection_events_for_device(authority, device_guid, detection_event_f
                                     to store the latest cursor returned before failing to retrieve the
                                     next page of events. This allows us to restart from the proper place
                                     next time the script runs (in the event a server goes down part way through).
+    :param write_page:              A function that takes each page of unbatched events, as a list of JSON
+                                    lines, as it is retrieved. Defaults to writing each page to stdout in a
+                                    single write.
     :return:                        returns a tuple of the nextMinTimestamp and the list of
                                      detection events -> (next_min_timestamp, detection_events)
     """
+    if not write_page:
+        write_page = c42api.SplunkEventWriter(sys.stdout, max_events=1).write_lines
     event_count_for_device = 0
     try:
         security_plan = _fetch_security_plan(authority, device_guid)
     except RequestException:
         LOG.exception(
-            "Unable to retrieve securityPlan for deviceGuid %s, from authority %s. Please ensure the authority is online",
+            "Unable to retrieve securityPlan for deviceGuid %s, from authority %s. "
+            "Please ensure the authority is online",
             str(device_guid),
             str(authority))
         security_plan = None
@@ -233,57 +285,60 @@ def _fetch_detection_events_for_device(authority, device_guid, detection_event_f
             LOG.info("No storage servers found were found for plan %s", str(plan_uid))
             return None, event_count_for_device, cursor_dict
 
-        # Finding a cursor in the dictionary implies that the last time the script ran, this device was only able to get
-        # some of its pages of events, due to issues talking to the Code42 server(s). Start with the cursor form the last
-        # successful request. Also, remove the cursor from dictionary. If this request fails, it will be re-added later on.
+        # Finding a cursor in the dictionary implies that the last time the script ran, this device was only
+        # able to get some of its pages of events, due to issues talking to the Code42 server(s). Start with the
+        # cursor form the last successful request. Also, remove the cursor from dictionary. If this request
+        # fails, it will be re-added later on.
         cursor_from_interrupt_file = cursor_dict.pop(device_guid, None)
         if cursor_from_interrupt_file:
             detection_event_filter['cursor'] = cursor_from_interrupt_file
             LOG.info(
-                "Using cursor from security-interrupted-lastCursor to get page that previously failed to be retrieved. Cursor: %s deviceGuid: %s",
+                "Using cursor from security-interrupted-lastCursor to get page that previously failed to be "
+                "retrieved. Cursor: %s deviceGuid: %s",
                 str(cursor_from_interrupt_file), str(device_guid))
 
-        # Retrieve pages of events until an empty cursor is returned, signifying we have gotten the last page of events,
-        # or a request for a page fails.
+        # Retrieve pages of events until an empty cursor is returned, signifying we have gotten the last page
+        # of events, or a request for a page fails.
         while True:
-            next_cursor, unbatched_event_page, request_successful = _get_page_of_events_from_server(storage_server,
-                                                                                                    plan_uid,
-                                                                                                    detection_event_filter)
+            next_cursor, unbatched_event_page, request_successful = _get_page_of_events_from_server(
+                storage_server, plan_uid, detection_event_filter)
             event_count_for_device += len(unbatched_event_page)
             page_count = page_count + 1
 
-            # If the previous request was NOT successful, we need to store the cursor used in that request to the cursor_file.
-            # Otherwise, we will not be able to re-try getting the page of events next time the script runs. If no cursor was used
-            # we must have failed while requesting the first page. Do not store a cursor, as next time we will attempt to get the
-            # first page again.
+            # If the previous request was NOT successful, we need to store the cursor used in that request to the
+            # cursor_file. Otherwise, we will not be able to re-try getting the page of events next time the script
+            # runs. If no cursor was used we must have failed while requesting the first page. Do not store a
+            # cursor, as next time we will attempt to get the first page again.
             if not request_successful and detection_event_filter.get('cursor'):
                 cursor = detection_event_filter.get('cursor')
                 cursor_dict[device_guid] = cursor
 
                 LOG.debug(
-                    "Page %d was not retrieved successfully. Storing cursor: %s in security-interrupted-lastCursor for deviceGuid: %s",
+                    "Page %d was not retrieved successfully. Storing cursor: %s in "
+                    "security-interrupted-lastCursor for deviceGuid: %s",
                     page_count, str(cursor), str(device_guid))
 
-            # Stdout here so that we don't need to save all of the detection events for a single device.
-            # After this point this page of events is 'in the splunk app'
-            # NOTE: this must be done single-threaded
-            c42api.write_json_splunk(sys.stdout, unbatched_event_page)
+            # Hand the page off here so that we don't need to save all of the detection events for a single
+            # device. Once the page is written to stdout it is 'in the splunk app'.
+            write_page(unbatched_event_page)
 
             if not next_cursor and request_successful:
                 LOG.info("All pages of events retrieved for plan: %s, from server %s, total pages retrieved: %d",
                          plan_uid, storage_server, page_count)
-                # This value will be used as the event_filter['minTs'] value the next time Splunk retrieves events for this device.
-                # the value will be stored in a local cache until then.
+                # This value will be used as the event_filter['minTs'] value the next time Splunk retrieves events
+                # for this device. the value will be stored in a local cache until then.
                 next_min_ISO_timestamp = detection_event_filter['maxTs']
 
                 return next_min_ISO_timestamp, event_count_for_device, cursor_dict
             elif not next_cursor:
                 LOG.info(
-                    "Unable to get all pages of events for plan: %s, from server %s. The next time script runs, we will try to retrieve page %d again.",
+                    "Unable to get all pages of events for plan: %s, from server %s. "
+                    "The next time script runs, we will try to retrieve page %d again.",
                     plan_uid, str(storage_server), page_count)
                 return None, event_count_for_device, cursor_dict
 
-            # Replacing the previous cursor with the next_cursor allows us to get the next page of events with our next request.
+            # Replacing the previous cursor with the next_cursor allows us to get the next page of events with
+            # our next request.
             detection_event_filter['cursor'] = next_cursor
 
     return detection_event_filter['minTs'], event_count_for_device, cursor_dict
@@ -303,6 +358,14 @@ def _get_page_of_events_from_server(storage_server, plan_uid, detection_event_fi
     return None, [], request_successful
 
 
+def _format_utc_datetime(value):
+    """
+    :param value: A utc datetime
+    :return:      It as a minTs or maxTs, to the millisecond
+    """
+    return '{}.{:03d}Z'.format(value.strftime("%Y-%m-%dT%H:%M:%S"), value.microsecond // 1000)
+
+
 def create_filter_by_utc_datetime(min_datetime, max_datetime):
     """
     Create a minTs, maxTs filter. Datetime object must be in utc time. API contract requires it.
@@ -315,8 +378,8 @@ def create_filter_by_utc_datetime(min_datetime, max_datetime):
         # Basic Datetime object does not create the correctly formatted timestamp
         # necessary when making SecurityDetectionEvents API calls. That is why we
         # have the custum time formatter.
-        return {'minTs': min_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-                'maxTs': max_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")}
+        return {'minTs': _format_utc_datetime(min_datetime),
+                'maxTs': _format_utc_datetime(max_datetime)}
     except ValueError:
         LOG.error("Failed to create event_filter")
         return None
@@ -357,84 +420,345 @@ def create_filter_by_cursor(cursor):
     return {'cursor': cursor}
 
 
-def _try_read_cursor(cursor_file_path):
+def _write_event_pages(page_queue, result_queue, cursor_store, event_writer):
     """
-    If timestamp exists at path, read it and return the value. Otherwise do nothing.
-
-    :param timestamp_path: Path to find timestamp
-    :return: dictionary (of {guid-> "<planUid>:<eventUid>") read from
-             cursor file
+    The single writer stage of _collect_detection_events(). Writing to stdout
+    must be done single-threaded, so every worker hands its pages to this
+    function through page_queue.
+
+    A worker queues its task's result only after all of that task's pages, so
+    the task's cursor is committed, and its result passed on to result_queue,
+    only once those pages have been written. Pages are buffered by
+    event_writer, which is flushed before each cursor is committed. A None on
+    page_queue stops the writer.
+
+    If any of a task's pages fail to be written, or the buffer holding them
+    fails to be flushed, its cursor isn't committed and its result is passed
+    on with no next_min_ISO_timestamp, so the task is fetched again from its
+    last committed cursor next time.
+
+    :param page_queue:   The queue of (_PAGE, (task_key, events)) and
+                          (_RESULT, result) items written by the workers
+    :param result_queue: The queue to pass each task's result on to
+    :param cursor_store: The CheckpointStore of task key -> cursor
+    :param event_writer: The SplunkEventWriter to print events with
     """
-    if not os.path.exists(cursor_file_path):
-        return None
-    with open(cursor_file_path, 'r') as cursor_file:
-        return json.load(cursor_file)
-
-
-def _write_cursor(cursor_file_path, cursor_dict):
+    # The tasks with pages buffered since the last successful flush, and the
+    # tasks that have lost events.
+    unflushed = set()
+    failed = set()
+    while True:
+        item = page_queue.get()
+        if item is None:
+            return
+        kind, payload = item
+        task_key = payload[0]
+        try:
+            if kind == _PAGE:
+                unflushed.add(task_key)
+                event_writer.write_lines(payload[1])
+            else:
+                event_writer.flush()
+                unflushed.clear()
+                if task_key not in failed:
+                    cursor = payload[3]
+                    if cursor:
+                        cursor_store.put(task_key, cursor)
+                    else:
+                        cursor_store.delete(task_key)
+        except Exception:  # pylint: disable=broad-except
+            # The writer must keep draining, or every worker would block on a full queue.
+            LOG.exception("Failed to write detection events")
+            # The failed tasks are fetched again next time, so their buffered events are dropped rather than
+            # failing every flush after this one.
+            event_writer.discard()
+            failed.update(unflushed)
+            failed.add(task_key)
+        if kind == _RESULT:
+            if task_key in failed:
+                failed.discard(task_key)
+                LOG.error("Detection events for %s were not all written, so its cursor wasn't saved", str(task_key))
+                result_queue.put((task_key, None, payload[2]))
+            else:
+                result_queue.put(payload[:3])
+
+
+def _collect_detection_events(authority, tasks, cursor_store, num_threads, out):
     """
-    Write value to timestamp file, even if it doesn't exist.
-
-    :param cursor_file_path:  Where to find/create cursor file
-    :param cursor_dict: Value to write to cursor file. This value is a dict of deviceGuid -> cursor
+    Fetches the detection events for a list of tasks concurrently with
+    num_threads workers, while a single writer thread prints their events.
+
+    Each task is a cursor chain of its own: a device and an event filter, plus
+    the key its cursor is stored under in cursor_store. A task's result is only
+    yielded once all of its events have been written, in the order tasks
+    finish.
+
+    :param authority:    A Server object to make the API call to
+    :param tasks:        A list of (task_key, device_guid, event_filter)
+    :param cursor_store: The CheckpointStore of task key -> cursor
+    :param num_threads:  The number of tasks to fetch events for at once
+    :param out:          The file in which to print events
+    :return:             A generator of (task_key, next_min_ISO_timestamp,
+                          detection_event_count)
     """
-    with open(cursor_file_path, 'w+') as cursor_file:
-        json.dump(cursor_dict, cursor_file)
-
+    num_threads = max(1, num_threads)
+    page_queue = Queue(num_threads * PAGES_PER_WORKER)
+    result_queue = Queue()
+    event_writer = c42api.SplunkEventWriter(out)
+    writer = Thread(target=_write_event_pages, name='detection-event-writer',
+                    args=(page_queue, result_queue, cursor_store, event_writer))
+    writer.daemon = True
+    writer.start()
+
+    def fetch_task(task_key, device_guid, detection_event_filter):
+        """
+        Get detection events for a single task.
+
+        The _fetch_detection_events_for_device() call could return nothing but our exit condition
+        expects that every task will return some result so no matter what, we have to output
+        a result to the page_queue. The task's cursor is tracked in a dictionary of its own and
+        handed to the writer with the result, which commits it once the task's pages are written.
+        """
+        LOG.info("Fetching detection events for %s", str(task_key))
+
+        def write_page(page):
+            """Hands a page of the task's events to the writer thread"""
+            page_queue.put((_PAGE, (task_key, page)))
 
-def fetch_detection_events(authority, guid_and_filter_list, cursor_file_path):
+        next_min_ISO_timestamp = None
+        detection_event_count = 0
+        cursor_dict = {}
+        try:
+            stored_cursor = cursor_store.get(task_key)
+            if stored_cursor:
+                cursor_dict[device_guid] = stored_cursor
+            # Every task gets its own copy of the filter, as it is updated with each page's cursor.
+            next_min_ISO_timestamp, detection_event_count, cursor_dict = _fetch_detection_events_for_device(
+                authority, device_guid, dict(detection_event_filter), cursor_dict, write_page)
+            LOG.info("Got %d detection events for %s", detection_event_count, str(task_key))
+        except RequestException:
+            LOG.exception("Failure when fetching detection events for %s", str(task_key))
+        finally:
+            page_queue.put((_RESULT, (task_key, next_min_ISO_timestamp, detection_event_count,
+                                      cursor_dict.get(device_guid))))
+
+    def on_task_done(future):
+        """Logs how long each task waited and ran, and anything it raised"""
+        if future.cancelled():
+            return
+        LOG.debug("Detection event task waited %.3fs and ran %.3fs",
+                  future.started - future.submitted, future.finished - future.started)
+        if future.exception() is not None:
+            try:
+                future.result()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("Detection event task failed")
+
+    # The task queue is unbounded, so every task is handed over without blocking the generator.
+    executor = Executor(num_threads, on_task_done=on_task_done, name='detection-event-worker')
+    try:
+        for task in tasks:
+            executor.submit(fetch_task, *task)
+        for _ in tasks:
+            yield result_queue.get()
+    finally:
+        # Running tasks still hand pages to the writer, so it must outlive the executor.
+        executor.shutdown(wait=True, cancel_pending=True)
+        page_queue.put(None)
+        writer.join()
+        event_writer.close()
+
+
+def fetch_detection_events(authority, guid_and_filter_list, cursor_file_path, num_threads=1, out=None):
     """
     Returns an iterable (specifically a generator) containing json objects
     that represent all security detection events for a specific device guid.
     (all pages of events for the deviceGuid)
 
+    Devices are fetched concurrently by num_threads workers, while a single
+    writer thread prints their events. A device's result is only yielded once
+    all of its events have been written, in the order devices finish.
+
     :param authority:             A Server object to make the API call to
     :param guid_and_filter_list:  A pre-zipped list of (device_guid,
                                   event_filter)
     :param cursor_file_path:      The path to the file where we will save currentCursor in 
                                   case of loosing connection to server during page retrieval.
-    :return:                      returns a tuple of the device_guid, the next_min_ISO_timestamp
-                                  string and a count of how many detection events were found.
-                                  (device_guid, next_min_ISO_timestamp, detection_event_count)
+                                  The cursors are kept in a CheckpointStore at this path with
+                                  '.db' appended, and a JSON file at this path is migrated into it.
+    :param num_threads:           The number of devices to fetch events for at once.
+    :param out:                   The file in which to print events. Defaults to stdout.
+    :return:                      returns a tuple of the device_guid and the next_min_ISO_timestamp
+                                  string -> (device_guid, next_min_ISO_timestamp)
     """
 
     start_time = datetime.now().isoformat()
     device_guids = [item[0] for item in guid_and_filter_list]
     LOG.info("Begin fetching detection events devices:%s", str(device_guids))
 
-    cursor_dict = _try_read_cursor(cursor_file_path)
-    cursor_dict = cursor_dict if cursor_dict else {}
+    cursor_store = CheckpointStore(cursor_file_path + '.db', legacy_json_path=cursor_file_path)
+    tasks = [(device_guid, device_guid, detection_event_filter)
+             for device_guid, detection_event_filter in guid_and_filter_list]
 
     total_event_count = 0
-    for device_guid, detection_event_filter in guid_and_filter_list:
-        # Get detection events for device guid and add to
-        # list of all detection events
-        #
-        # The _fetch_detection_events_for_device() call could return nothing but our exit condition
-        # expects that every task will return some result so no matter what, we have to output
-        # a result to the result_queue.
-
-        LOG.info("Fetching detection events for %s", str(device_guid))
-        next_min_ISO_timestamp = None
-        detection_event_count = 0
-        try:
-            next_min_ISO_timestamp, detection_event_count, cursor_dict = _fetch_detection_events_for_device(authority,
-                                                                                                            device_guid,
-                                                                                                            detection_event_filter,
-                                                                                                            cursor_dict)
-            LOG.info("Got %d detection events for computerGuid %s", detection_event_count, str(device_guid))
-        except RequestException:
-            LOG.exception("Failure when fetching detection events for device %s", str(device_guid))
-
-        total_event_count += detection_event_count
-        yield (device_guid, next_min_ISO_timestamp)
+    try:
+        for device_guid, next_min_ISO_timestamp, detection_event_count in _collect_detection_events(
+                authority, tasks, cursor_store, num_threads, out or sys.stdout):
+            total_event_count += detection_event_count
+            yield (device_guid, next_min_ISO_timestamp)
+    finally:
+        cursor_store.close()
 
     LOG.info("Finished fetching detection events for devices. Got %d events total, for the Devices: %s",
              total_event_count,
              str(device_guids))
-    _write_cursor(cursor_file_path, cursor_dict)
 
     end_time = datetime.now().isoformat()
     log_analytics(start_time=start_time,
                   end_time=end_time,
-                  event_count=total_event_count)
+                  event_count=total_event_count,
+                  thread_count=num_threads,
+                  concurrency_limits=concurrency.limits())
+
+
+def _backfill_windows(min_datetime, max_datetime, window, max_windows):
+    """
+    Splits a time range into windows, newest first. The windows are each
+    `window` long, unless that takes more than max_windows. Then only the
+    newest half are `window` long, and the rest of the range is split evenly
+    across the other half, as older events are sparse.
+
+    An event filter includes events at both its minTs and maxTs, so each
+    window ends a millisecond before the newer one starts, and an event on a
+    boundary is only fetched once.
+
+    :param min_datetime: The start of the range (utc datetime)
+    :param max_datetime: The end of the range (utc datetime)
+    :param window:       The length of each window (timedelta)
+    :param max_windows:  The maximum number of windows to split the range into
+    :return:             A list of (window_min, window_max) utc datetimes
+    """
+    windows = []
+    window_max = max_datetime
+    fixed_windows = max_windows if max_datetime - min_datetime <= window * max_windows else max_windows // 2
+    while window_max > min_datetime and len(windows) < fixed_windows:
+        window_min = max(window_max - window, min_datetime)
+        windows.append((window_min, window_max))
+        window_max = window_min
+    if window_max > min_datetime:
+        even_windows = max_windows - len(windows)
+        step = (window_max - min_datetime) // even_windows
+        for i in range(even_windows):
+            window_min = min_datetime if i == even_windows - 1 else window_max - step
+            windows.append((window_min, window_max))
+            window_max = window_min
+    return windows[:1] + [(window_min, window_max - _MILLISECOND) for window_min, window_max in windows[1:]]
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+def backfill_detection_events(authority, device_guids, cursor_file_path, progress_file_path,
+                              min_datetime=None, window=BACKFILL_WINDOW, max_windows=BACKFILL_MAX_WINDOWS,
+                              num_threads=1, out=None):
+    """
+    Fetches every security detection event up until now for devices that have
+    never been fetched before.
+
+    Rather than paging through years of events as a single cursor chain, each
+    device's range is split into windows that are fetched concurrently, each
+    with a cursor chain of its own. The end of a device's range is fixed the
+    first time it is backfilled, and every finished window is recorded in the
+    CheckpointStore at progress_file_path, so an interrupted backfill only
+    fetches the windows that are missing the next time it runs.
+
+    :param authority:          A Server object to make the API call to
+    :param device_guids:       The devices to backfill
+    :param cursor_file_path:   The path to the cursor file, as for
+                                fetch_detection_events()
+    :param progress_file_path: The path of the CheckpointStore to record
+                                backfill progress in
+    :param min_datetime:       The utc datetime to backfill from. Defaults to
+                                the epoch.
+    :param window:             The length of each window (timedelta)
+    :param max_windows:        The maximum number of windows per device
+    :param num_threads:        The number of windows to fetch events for at once
+    :param out:                The file in which to print events. Defaults to
+                                stdout.
+    :return:                   A generator of (device_guid,
+                                next_min_ISO_timestamp) for each device once
+                                all of its windows have been fetched. The
+                                timestamp is None if any window failed.
+    """
+    start_time = datetime.now().isoformat()
+    min_datetime = min_datetime or datetime.utcfromtimestamp(0)
+    cursor_store = CheckpointStore(cursor_file_path + '.db', legacy_json_path=cursor_file_path)
+    progress_store = CheckpointStore(progress_file_path)
+
+    tasks = []
+    remaining = {}
+    failed = set()
+    for device_guid in device_guids:
+        max_ts = progress_store.get(device_guid)
+        if not max_ts:
+            max_ts = datetime.utcnow().strftime(_ISO_FORMAT)
+            progress_store.put(device_guid, max_ts)
+        max_datetime = datetime.strptime(max_ts, _ISO_FORMAT)
+        remaining[device_guid] = (max_ts, [])
+        for window_min, window_max in _backfill_windows(min_datetime, max_datetime, window, max_windows):
+            window_key = _window_key(device_guid, window_min)
+            remaining[device_guid][1].append(window_key)
+            if progress_store.get(window_key):
+                continue
+            tasks.append((window_key, device_guid, create_filter_by_utc_datetime(window_min, window_max)))
+    window_devices = dict((task[0], task[1]) for task in tasks)
+    LOG.info("Backfilling %d windows of detection events for devices: %s", len(tasks), str(device_guids))
+
+    def finish(device_guid):
+        """
+        Reports a device whose windows have all been fetched, clearing its
+        progress if every window succeeded.
+        """
+        max_ts, window_keys = remaining.pop(device_guid)
+        if device_guid in failed:
+            return device_guid, None
+        for window_key in window_keys:
+            progress_store.delete(window_key)
+        progress_store.delete(device_guid)
+        return device_guid, max_ts
+
+    total_event_count = 0
+    try:
+        # Devices whose windows all finished in an earlier run have nothing left to fetch.
+        for device_guid in [guid for guid in device_guids if not any(
+                window_key in window_devices for window_key in remaining[guid][1])]:
+            yield finish(device_guid)
+        pending = dict((guid, len([key for key in keys if key in window_devices]))
+                       for guid, (_, keys) in remaining.items())
+        for window_key, next_min_ISO_timestamp, detection_event_count in _collect_detection_events(
+                authority, tasks, cursor_store, num_threads, out or sys.stdout):
+            total_event_count += detection_event_count
+            device_guid = window_devices[window_key]
+            if next_min_ISO_timestamp:
+                progress_store.put(window_key, 'done')
+            else:
+                failed.add(device_guid)
+            pending[device_guid] -= 1
+            if not pending[device_guid]:
+                yield finish(device_guid)
+    finally:
+        cursor_store.close()
+        progress_store.close()
+
+    end_time = datetime.now().isoformat()
+    log_analytics(start_time=start_time,
+                  end_time=end_time,
+                  event_count=total_event_count,
+                  window_count=len(tasks),
+                  thread_count=num_threads,
+                  concurrency_limits=concurrency.limits())
+
+
+def _window_key(device_guid, window_min):
+    """
+    :return: The key a backfill window's cursor and progress are stored under
+    """
+    return '{0}@{1}'.format(device_guid, window_min.strftime(_ISO_FORMAT))
@@ -25,15 +25,117 @@ associated with a single device guid.
 """
 
 import itertools
+import threading
+import time
 import urlparse
 import requests
 
 from c42api.common import resources
 from c42api.common.server import Server
-from c42api.common.script_common import memoize
+from c42api.common.cache import ttl_cache
+from c42api.common import concurrency
+from c42api.common import throttle
 from c42api.common import logging_config
 
 LOG = logging_config.get_logger(__name__)
+# How long, in seconds, destinations, servers and plans are cached before they are looked up again,
+# and how long a lookup that found nothing is cached.
+TOPOLOGY_TTL = 10 * 60
+NEGATIVE_TTL = 60
+# The limits on the requests made to each storage node, shared by every device that uses it. Within
+# NODE_MAX_IN_FLIGHT, the requests in flight to a node adapt to its latency and errors.
+NODE_REQUESTS_PER_SECOND = 20
+NODE_BURST = 10
+NODE_MAX_IN_FLIGHT = 16
+# How long, in seconds, a node's ping result is trusted before it is pinged again. A failed ping is
+# only trusted briefly, so a blip doesn't keep a working node out of routing for long.
+PING_TTL = 5 * 60
+FAILED_PING_TTL = 15
+# How long, in seconds, an auth'd node Server is reused before authenticating again.
+AUTH_TOKEN_TTL = 20 * 60
+
+
+class _RouteCache(object):
+    """
+    The storage routes shared by every device whose plans back up to the same
+    nodes, keyed by (authority, destination guid, node url). Each entry holds a
+    ping result and, once authenticated, the node's Server object, each with
+    the time it expires.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pings = {}
+        self._servers = {}
+
+    def ping(self, key):
+        """
+        :param key: The (authority, destination guid, node url) of the route
+        :return:    True or False for a fresh ping result, otherwise None
+        """
+        with self._lock:
+            return self._fresh(self._pings, key)
+
+    def put_ping(self, key, reachable):
+        """
+        :param key:       The (authority, destination guid, node url) of the route
+        :param reachable: Whether the node answered the ping
+        """
+        with self._lock:
+            self._pings[key] = (time.time() + (PING_TTL if reachable else FAILED_PING_TTL), reachable)
+
+    def server(self, key):
+        """
+        :param key: The (authority, destination guid, node url) of the route
+        :return:    The auth'd Server object for the route, or None
+        """
+        with self._lock:
+            return self._fresh(self._servers, key)
+
+    def put_server(self, key, server):
+        """
+        :param key:    The (authority, destination guid, node url) of the route
+        :param server: The auth'd Server object for the route
+        """
+        with self._lock:
+            self._servers[key] = (time.time() + AUTH_TOKEN_TTL, server)
+
+    def invalidate(self, server):
+        """
+        Forgets every route that leads to a Server object, so the next device
+        to use it pings and authenticates again.
+
+        :param server: The Server object that failed
+        :return:       Whether any route led to the server
+        """
+        with self._lock:
+            keys = [key for key, (_, cached) in self._servers.items() if cached is server]
+            for key in keys:
+                del self._servers[key]
+                self._pings.pop(key, None)
+            return bool(keys)
+
+    def clear(self):
+        """
+        Forgets every route.
+        """
+        with self._lock:
+            self._pings.clear()
+            self._servers.clear()
+
+    @staticmethod
+    def _fresh(entries, key):
+        """
+        :return: The value for key if it has not expired, otherwise None
+        """
+        expiry, value = entries.get(key, (0, None))
+        if expiry < time.time():
+            entries.pop(key, None)
+            return None
+        return value
+
+
+_ROUTE_CACHE = _RouteCache()
 
 
 def _fetch_storage_destinations(authority, plan_uid):
@@ -53,7 +155,7 @@ def _fetch_storage_destinations(authority, plan_uid):
         return None
 
 
-@memoize
+@ttl_cache(ttl=TOPOLOGY_TTL, max_entries=16, negative_ttl=NEGATIVE_TTL)
 def _fetch_all_destinations(authority):
     """
     Fetches all destinations from the authority.
@@ -69,7 +171,7 @@ def _fetch_all_destinations(authority):
         return None
 
 
-@memoize
+@ttl_cache(ttl=TOPOLOGY_TTL, max_entries=256, negative_ttl=NEGATIVE_TTL)
 def _fetch_servers(authority, destination_id):
     """
     Fetches all servers associated with the destination id
@@ -104,18 +206,36 @@ def _request_auth_token(server, login_token):
         return None
 
 
-def _network_ping(node_url, **kwargs):
+def _network_ping(node_url, session, **kwargs):
     """
     Sends a network ping request to a URL.
 
     :raise HTTPError: If the verification fails
     :param node_url:  The address address to be verified
+    :param session:   The requests.Session whose connection pool to use
     """
     ping_url = "{0}/api/ping".format(node_url)
-    response = requests.get(ping_url, timeout=8, **kwargs)
+    response = session.get(ping_url, timeout=8, **kwargs)
     response.raise_for_status()
 
 
+def invalidate_storage_server(server, error):
+    """
+    Drops the cached routes to a storage server after a request to it failed
+    with a 401 or a connection error, as its auth token has expired or the node
+    went away. Other errors leave the routes alone.
+
+    :param server: The Server object the request was made to
+    :param error:  The RequestException the request raised
+    """
+    response = getattr(error, 'response', None)
+    unauthorized = response is not None and response.status_code == 401
+    if not unauthorized and not isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return
+    if _ROUTE_CACHE.invalidate(server):
+        LOG.info("Dropped cached routes to storage server %s after %s", str(server), str(error))
+
+
 def _grouped_dict_by_key(list_of_dict, key):
     """
     Returns a dictionary of keys mapping to dictionaries that have that key as
@@ -134,6 +254,26 @@ def _grouped_dict_by_key(list_of_dict, key):
     return result
 
 
+@ttl_cache(ttl=TOPOLOGY_TTL, max_entries=4096, negative_ttl=NEGATIVE_TTL)
+def _fetch_backup_plan_uids(authority, device_guid):
+    """
+    Fetches the backup plan uids for a device from the authority.
+
+    :raise HTTPError:   If the request fails
+    :param authority:   The Server object that points to the authority
+    :param device_guid: The device guid to fetch the plan uids for
+    :return:            A list of plan uids
+    """
+    params = {'sourceComputerGuid': device_guid,
+              'planTypes': 'BACKUP'}
+    response = authority.get(resources.PLAN, params)
+    response = authority.json_from_response(response)
+    try:
+        return [info['planUid'] for info in response['data']]
+    except KeyError:
+        return None
+
+
 def _fetch_storage_servers(authority, plan_uid):
     """
     Fetches all viable storage servers for a plan uid.
@@ -189,29 +329,48 @@ def _server_object_for_destination(authority, plan_uid, destination_guid, storag
         # possible location
         try:
             url, login_token = url_and_storage_login_token()
+            node_key = (url.scheme, url.hostname, url.port)
+            node_throttle = throttle.for_host(node_key, rate=NODE_REQUESTS_PER_SECOND, burst=NODE_BURST,
+                                              max_in_flight=NODE_MAX_IN_FLIGHT)
             result_server = Server(url.hostname, url.port, protocol=url.scheme,
-                                   verify_ssl=authority.verify_ssl)
+                                   verify_ssl=authority.verify_ssl, session=authority.session,
+                                   retry_policy=authority.retry_policy, throttle=node_throttle,
+                                   concurrency=concurrency.for_host(node_key, max_limit=NODE_MAX_IN_FLIGHT))
             auth_token = _request_auth_token(result_server, login_token)
         except requests.RequestException as e:
             LOG.debug("Failed to auth with location. %e", str(e))
             return None
 
         result_server.authorization = auth_token
+        if auth_token:
+            _ROUTE_CACHE.put_server(route_key, result_server)
         return result_server
 
     LOG.debug("Attempting to auth with storage location (destination_guid:{0}, url:{1})".format(destination_guid,
                                                                                                 storage_dict['url']))
 
     node_url = storage_dict['url']
-    try:
-        # network test resource only wants hostname, no scheme or port
-        LOG.info("Determining readability for server %s, planUid = %s", str(node_url), str(plan_uid))
-        _network_ping(node_url, verify=authority.verify_ssl)
-    except requests.RequestException as e:
-        # The server ping was not successful
-        LOG.info("Network ping determined location unreachable, %s", str(e))
+    route_key = (authority, destination_guid, node_url)
+    reachable = _ROUTE_CACHE.ping(route_key)
+    if reachable is None:
+        try:
+            # network test resource only wants hostname, no scheme or port
+            LOG.info("Determining readability for server %s, planUid = %s", str(node_url), str(plan_uid))
+            _network_ping(node_url, authority.session, verify=authority.verify_ssl)
+            reachable = True
+        except requests.RequestException as e:
+            # The server ping was not successful
+            LOG.info("Network ping determined location unreachable, %s", str(e))
+            reachable = False
+        _ROUTE_CACHE.put_ping(route_key, reachable)
+    if not reachable:
         return None
 
+    cached_server = _ROUTE_CACHE.server(route_key)
+    if cached_server:
+        LOG.debug("Reusing auth'd storage location %s", str(cached_server))
+        return cached_server
+
     destinations_by_guid = _grouped_dict_by_key(_fetch_all_destinations(authority), 'guid')
     target_destination = destinations_by_guid[destination_guid][0]
     if target_destination['type'] == 'PROVIDER':
@@ -278,25 +437,9 @@ def storage_servers(authority, plan_uids=None, device_guid=None):
     :return:            A generator of destinations that are all online
     """
 
-    def fetch_plan_uids():
-        """
-        Fetches plan uids for the device guid, or just the ones passed in.
-
-        :return: A list of plan uids
-        """
-        if plan_uids:
-            return plan_uids
-        params = {'sourceComputerGuid': device_guid,
-                  'planTypes': 'BACKUP'}
-        response = authority.get(resources.PLAN, params)
-        response = authority.json_from_response(response)
-        try:
-            return [info['planUid'] for info in response['data']]
-        except KeyError:
-            return None
-
     LOG.debug("Fetching storage server(s) for device {0} and plans {1}".format(device_guid, plan_uids))
-    plan_uids = fetch_plan_uids()
+    if not plan_uids:
+        plan_uids = _fetch_backup_plan_uids(authority, device_guid)
     for plan_uid in plan_uids:
         for possible_destination in _fetch_storage_servers(authority, plan_uid):
             yield possible_destination, plan_uid
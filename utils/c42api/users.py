@@ -42,12 +42,14 @@ def log_analytics(**kwargs):
     analytics.write_json_analytics(__name__, kwargs, result_limit=1)
 
 
-def fetch_users(server):
+def fetch_users(server, prefetch=0):
     """
     Returns an iterable (specifically a generator) containing json objects
     that represent users.
 
-    :param server: A Server object to make the API call to
+    :param server:   A Server object to make the API call to
+    :param prefetch: The number of pages to request concurrently. See
+                      Server.fetch_all_paged.
     """
     start_time = datetime.now().isoformat()
     user_count = 0
@@ -56,7 +58,7 @@ def fetch_users(server):
     params = {'pgSize': str(Server.MAX_PAGE_SIZE),
               'active': 'true',
               'incRoles': 'true'}
-    results = server.fetch_all_paged(resources.USER, params, 'users')
+    results = server.fetch_all_paged(resources.USER, params, 'users', prefetch=prefetch)
     for user in results:
         user['schema_version'] = SCHEMA_VERSION
         user_count += 1
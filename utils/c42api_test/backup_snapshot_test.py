@@ -0,0 +1,117 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the backup_snapshot module in the c42api module
+"""
+
+import os
+import shutil
+import tempfile
+from hypothesis import given, Settings
+import hypothesis.strategies as strat
+
+from c42api import backup_snapshot
+from c42api_test import test_lib
+
+
+def _row(seed):
+    """
+    :return: A (version time, checksum, length) row made from a number
+    """
+    return seed, backup_snapshot.checksum_bytes('%032x' % seed), seed * 10
+
+
+@given(strat.lists(strat.dictionaries(strat.text(min_size=1), strat.integers(0, 2 ** 40))),
+       settings=Settings(max_examples=50))
+def test_merged_matches_dict(batches):
+    """Test that merging batches of updates behaves like updating a dict"""
+    snapshot = backup_snapshot.Snapshot()
+    expected = {}
+    for batch in batches:
+        updates = dict((backup_snapshot.path_hash(path), _row(seed)) for path, seed in batch.items())
+        snapshot = snapshot.merged(updates, max(batch.values() or [0]))
+        expected.update(updates)
+    assert len(snapshot) == len(expected)
+    for key, row in expected.items():
+        assert snapshot.lookup(key) == row
+    missing = backup_snapshot.path_hash('')
+    assert missing in expected or snapshot.lookup(missing) is None
+    assert snapshot.high_water_mark == max([0] + [seed for batch in batches for seed in batch.values()])
+
+
+def test_merger_requires_ascending_keys():
+    """Test that a merger only takes updates in order of path hash"""
+    keys = sorted(backup_snapshot.path_hash(path) for path in ('/a', '/b'))
+    merger = backup_snapshot.Snapshot().merger()
+    merger.update(keys[1], *_row(1))
+    try:
+        merger.update(keys[0], *_row(2))
+        assert False
+    except ValueError:
+        pass
+    snapshot = merger.snapshot(1)
+    assert snapshot.lookup(keys[1]) == _row(1)
+    assert snapshot.lookup(keys[0]) is None
+
+
+def test_save_and_load():
+    """Test that a snapshot survives a round trip to disk, replacing the old file"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, '1234.snapshot')
+        assert len(backup_snapshot.load(path)) == 0
+        first = backup_snapshot.Snapshot().merged({backup_snapshot.path_hash('/a'): _row(1)}, 1)
+        first.save(path)
+        second = first.merged({backup_snapshot.path_hash('/b'): _row(2)}, 2)
+        second.save(path)
+        loaded = backup_snapshot.load(path)
+        assert len(loaded) == 2
+        assert loaded.high_water_mark == 2
+        assert loaded.lookup(backup_snapshot.path_hash('/a')) == _row(1)
+        assert loaded.lookup(backup_snapshot.path_hash('/b')) == _row(2)
+        assert os.listdir(tmp_dir) == ['1234.snapshot']
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_load_truncated():
+    """Test that a partial snapshot isn't mistaken for a complete one"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, '1234.snapshot')
+        backup_snapshot.Snapshot().merged({backup_snapshot.path_hash('/a'): _row(1)}, 1).save(path)
+        with open(path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        # Cut short in the rows, in the header, and before anything was written.
+        for length in (len(data) - 1, 10, 0):
+            with open(path, 'wb') as snapshot_file:
+                snapshot_file.write(data[:length])
+            try:
+                backup_snapshot.load(path)
+                assert False
+            except ValueError:
+                pass
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
@@ -0,0 +1,212 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the analytics functions
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from c42api.common import analytics
+from c42api_test import test_lib
+
+
+def test_enqueue_disabled():
+    """Test that nothing is queued when analytics are turned off"""
+    analytics.OUTPUT_DIRECTORY = None
+    analytics.enqueue_json_analytics('test', {'value': 1}, result_limit=10)
+    assert analytics._QUEUE.empty()  # pylint: disable=protected-access
+
+
+def test_enqueue_written_by_writer():
+    """Test that queued analytics are written out by the background writer"""
+    output_dir = tempfile.mkdtemp()
+    analytics.OUTPUT_DIRECTORY = output_dir
+    try:
+        for value in range(5):
+            analytics.enqueue_json_analytics('test', {'value': value}, result_limit=10)
+        analytics.flush()
+        values = [json.loads(line)['value'] for line in analytics.read_json_analytics('test')]
+        assert values == list(range(5))
+    finally:
+        analytics.OUTPUT_DIRECTORY = None
+        shutil.rmtree(output_dir)
+
+
+def test_enqueue_does_not_wait_for_lock():
+    """Test that queueing an analytic doesn't block on the analytics lock"""
+    output_dir = tempfile.mkdtemp()
+    analytics.OUTPUT_DIRECTORY = output_dir
+    try:
+        with analytics._LOCK:  # pylint: disable=protected-access
+            enqueued = threading.Event()
+
+            def enqueue():
+                """Queues an analytic while the lock is held"""
+                analytics.enqueue_json_analytics('test', {'value': 1}, result_limit=10)
+                enqueued.set()
+            threading.Thread(target=enqueue).start()
+            enqueued.wait(5)
+            assert enqueued.is_set()
+        analytics.flush()
+    finally:
+        analytics.OUTPUT_DIRECTORY = None
+        shutil.rmtree(output_dir)
+
+
+def test_writer_survives_errors():
+    """Test that analytics that fail to be written don't stop the writer"""
+    output_dir = tempfile.mkdtemp()
+    analytics.OUTPUT_DIRECTORY = output_dir
+    extend = analytics._RingFile.extend  # pylint: disable=protected-access
+
+    def failing_extend(ring, lines):
+        """Fails to write to the broken file"""
+        if 'broken' in ring.path:
+            raise RuntimeError()
+        extend(ring, lines)
+    analytics._RingFile.extend = failing_extend  # pylint: disable=protected-access
+    try:
+        for value in range(3):
+            analytics.enqueue_json_analytics('broken', {'value': value}, result_limit=10)
+            analytics.enqueue_json_analytics('test', {'value': value}, result_limit=10)
+        flushed = threading.Thread(target=analytics.flush)
+        flushed.daemon = True
+        flushed.start()
+        flushed.join(5)
+        assert not flushed.is_alive()
+        values = [json.loads(line)['value'] for line in analytics.read_json_analytics('test')]
+        assert values == [0, 1, 2]
+    finally:
+        analytics._RingFile.extend = extend  # pylint: disable=protected-access
+        analytics.OUTPUT_DIRECTORY = None
+        shutil.rmtree(output_dir)
+
+
+def test_ring_evicts_oldest():
+    """Test that an analytics file keeps the newest results within its limits"""
+    output_dir = tempfile.mkdtemp()
+    analytics.OUTPUT_DIRECTORY = output_dir
+    try:
+        for value in range(20):
+            analytics.write_json_analytics('count', {'value': value}, result_limit=7)
+        values = [json.loads(line)['value'] for line in analytics.read_json_analytics('count')]
+        assert values == list(range(13, 20))
+        # Each of the segments holds a third of the limit, rounded up.
+        ring_path = os.path.join(output_dir, 'count' + analytics.RING_SUFFIX)
+        segment_lines = 0
+        for segment in range(analytics.SEGMENTS):
+            with open(os.path.join(ring_path, str(segment))) as segment_file:
+                segment_lines += len(segment_file.readlines())
+        assert segment_lines <= analytics.SEGMENTS * 3
+        # The head is replaced through a temporary file, which doesn't linger.
+        assert sorted(os.listdir(ring_path)) == sorted(['head'] + [str(s) for s in range(analytics.SEGMENTS)])
+
+        for value in range(50):
+            analytics.write_json_analytics('size', {'value': '{0:08d}'.format(value)}, size_limit=200)
+        lines = analytics.read_json_analytics('size')
+        assert sum(len(line) + 1 for line in lines) <= 200
+        assert [json.loads(line)['value'] for line in lines][-1] == '{0:08d}'.format(49)
+        assert len(lines) == 200 // (len(lines[0]) + 1)
+
+        # The newest line is kept even if it alone is over the size limit.
+        analytics.write_json_analytics('size', {'value': 'x' * 300}, size_limit=200)
+        assert [json.loads(line)['value'] for line in analytics.read_json_analytics('size')] == ['x' * 300]
+    finally:
+        analytics.OUTPUT_DIRECTORY = None
+        shutil.rmtree(output_dir)
+
+
+def test_ring_extend_matches_append():
+    """Test that appending lines together leaves a ring as appending them one at a time does"""
+    output_dir = tempfile.mkdtemp()
+    try:
+        lines = [json.dumps({'value': value}) for value in range(20)]
+        appended = analytics._RingFile(os.path.join(output_dir, 'appended'), 100, 7)  # pylint: disable=protected-access
+        for line in lines:
+            appended.append(line)
+        extended = analytics._RingFile(os.path.join(output_dir, 'extended'), 100, 7)  # pylint: disable=protected-access
+        extended.extend(lines[:3])
+        extended.extend(lines[3:])
+        assert extended.lines() == appended.lines()
+        for segment in range(analytics.SEGMENTS):
+            with open(os.path.join(appended.path, str(segment))) as appended_segment:
+                with open(os.path.join(extended.path, str(segment))) as extended_segment:
+                    assert extended_segment.read() == appended_segment.read()
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_ring_shared_by_writers():
+    """Test that writers that don't share a lock, like separate processes, can write the same ring"""
+    output_dir = tempfile.mkdtemp()
+    ring_path = os.path.join(output_dir, 'shared' + analytics.RING_SUFFIX)
+    errors = []
+
+    def append():
+        """Appends to the ring through a ring object of its own"""
+        ring = analytics._RingFile(ring_path, sys.maxint, 1000)  # pylint: disable=protected-access
+        try:
+            for value in range(100):
+                ring.append(json.dumps({'value': value}))
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+    try:
+        threads = [threading.Thread(target=append) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert analytics._RingFile.open(ring_path)  # pylint: disable=protected-access
+        assert [name for name in os.listdir(ring_path) if name.endswith('.tmp')] == []
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_export_json_lines():
+    """Test that every analytics file is exported as json lines"""
+    output_dir = tempfile.mkdtemp()
+    export_dir = tempfile.mkdtemp()
+    analytics.OUTPUT_DIRECTORY = output_dir
+    try:
+        analytics.write_json_analytics('one', {'value': 1}, result_limit=1)
+        analytics.write_json_analytics('one', {'value': 2}, result_limit=1)
+        for value in range(3):
+            analytics.enqueue_json_analytics('two', {'value': value}, result_limit=10)
+        paths = analytics.export_json_lines(export_dir)
+        assert paths == [os.path.join(export_dir, 'one.json'), os.path.join(export_dir, 'two.json')]
+        with open(paths[0]) as exported:
+            assert exported.read() == '{"value":2}'
+        with open(paths[1]) as exported:
+            assert [json.loads(line)['value'] for line in exported] == [0, 1, 2]
+    finally:
+        analytics.OUTPUT_DIRECTORY = None
+        shutil.rmtree(output_dir)
+        shutil.rmtree(export_dir)
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
@@ -0,0 +1,140 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the ttl_cache decorator
+"""
+
+import threading
+import time
+
+from c42api.common.cache import ttl_cache
+from c42api.common.script_common import memoize
+from c42api_test import test_lib
+
+
+def test_ttl_and_negative_ttl():
+    """Test that results expire after ttl, and falsy results after negative_ttl"""
+    calls = []
+
+    @ttl_cache(ttl=0.2, negative_ttl=0.05)
+    def lookup(value):
+        """Records each call"""
+        calls.append(value)
+        return value
+
+    assert lookup(1) == 1
+    assert lookup(1) == 1
+    assert lookup(0) == 0
+    assert lookup(0) == 0
+    assert calls == [1, 0]
+    time.sleep(0.1)
+    lookup(1)
+    lookup(0)
+    assert calls == [1, 0, 0]
+    time.sleep(0.15)
+    lookup(1)
+    assert calls == [1, 0, 0, 1]
+    assert lookup.cache_info()['hits'] == 3
+    assert lookup.cache_info()['misses'] == 4
+
+
+def test_lru_eviction():
+    """Test that the least recently used result is evicted past max_entries"""
+    calls = []
+
+    @ttl_cache(max_entries=2)
+    def lookup(value):
+        """Records each call"""
+        calls.append(value)
+        return value
+
+    lookup(1)
+    lookup(2)
+    lookup(1)
+    lookup(3)
+    assert lookup.cache_info()['size'] == 2
+    lookup(1)
+    lookup(2)
+    assert calls == [1, 2, 3, 2]
+    lookup.cache_clear()
+    assert lookup.cache_info() == {'hits': 0, 'misses': 0, 'size': 0, 'max_entries': 2}
+
+
+def test_exceptions_not_cached():
+    """Test that a failed lookup is retried on the next call"""
+    calls = []
+
+    @ttl_cache()
+    def lookup(value):
+        """Fails the first call"""
+        calls.append(value)
+        if len(calls) == 1:
+            raise ValueError()
+        return value
+
+    try:
+        lookup(1)
+        assert False
+    except ValueError:
+        pass
+    assert lookup(1) == 1
+    assert lookup(1) == 1
+    assert calls == [1, 1]
+
+
+def test_single_flight():
+    """Test that concurrent callers with the same input share one call"""
+    calls = []
+    release = threading.Event()
+
+    @ttl_cache()
+    def lookup(value):
+        """Blocks until released"""
+        calls.append(value)
+        release.wait()
+        return value
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(lookup(7))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while lookup.cache_info()['misses'] < 5:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [7] * 5
+    assert calls == [7]
+
+
+def test_memoize_falsy():
+    """Test that memoize no longer fails on a second falsy lookup"""
+    @memoize
+    def lookup(value):
+        """Returns its input"""
+        return value
+
+    assert lookup(None) is None
+    assert lookup(None) is None
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
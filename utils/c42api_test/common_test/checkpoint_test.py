@@ -0,0 +1,94 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the checkpoint store
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from c42api.common.checkpoint import CheckpointStore
+from c42api_test import test_lib
+
+
+def test_put_get_delete():
+    """Test that checkpoints can be written, read, replaced and removed"""
+    store_dir = tempfile.mkdtemp()
+    store = CheckpointStore(os.path.join(store_dir, 'store.db'))
+    try:
+        assert store.get('1234') is None
+        assert store.get('1234', 'default') == 'default'
+        store.put('1234', '2017-04-11T19:11:40.000Z')
+        store.put(5678, '1:2')
+        assert store.get('1234') == '2017-04-11T19:11:40.000Z'
+        assert store.get('5678') == '1:2'
+        assert '5678' in store
+        store.put('1234', '2017-04-12T19:11:40.000Z')
+        assert store.get('1234') == '2017-04-12T19:11:40.000Z'
+        store.delete('1234')
+        store.delete('1234')
+        assert '1234' not in store
+        assert len(store) == 1
+    finally:
+        store.close()
+        shutil.rmtree(store_dir)
+
+
+def test_persists_across_stores():
+    """Test that a committed checkpoint is seen by the next store opened"""
+    store_dir = tempfile.mkdtemp()
+    path = os.path.join(store_dir, 'store.db')
+    try:
+        store = CheckpointStore(path)
+        store.put('1234', '1:2')
+        store.close()
+        store = CheckpointStore(path)
+        assert dict(store.items()) == {'1234': '1:2'}
+        store.close()
+    finally:
+        shutil.rmtree(store_dir)
+
+
+def test_migrate_legacy_json():
+    """Test that a legacy JSON dictionary is migrated into the store once"""
+    store_dir = tempfile.mkdtemp()
+    legacy_path = os.path.join(store_dir, 'security-lastRun')
+    with open(legacy_path, 'w') as legacy_file:
+        json.dump({'1234': '2017-04-11T19:11:40.000Z', '5678': None}, legacy_file)
+    try:
+        store = CheckpointStore(legacy_path + '.db', legacy_json_path=legacy_path)
+        assert dict(store.items()) == {'1234': '2017-04-11T19:11:40.000Z'}
+        assert not os.path.exists(legacy_path)
+        assert os.path.exists(legacy_path + '.migrated')
+        store.put('1234', '2017-04-12T19:11:40.000Z')
+        store.close()
+
+        store = CheckpointStore(legacy_path + '.db', legacy_json_path=legacy_path)
+        assert store.get('1234') == '2017-04-12T19:11:40.000Z'
+        store.close()
+    finally:
+        shutil.rmtree(store_dir)
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
@@ -0,0 +1,99 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the AdaptiveConcurrency class
+"""
+
+import threading
+import time
+
+from c42api.common import concurrency
+from c42api.common.concurrency import AdaptiveConcurrency
+from c42api_test import test_lib
+
+
+def _complete(limit, count, latency=0.01, overloaded=False):
+    """Runs count requests through the limit one after another"""
+    for _ in range(count):
+        limit.acquire()
+        limit.release(latency, overloaded)
+
+
+def test_additive_increase():
+    """Test that fast, successful requests raise the limit up to max_limit"""
+    limit = AdaptiveConcurrency(initial_limit=1, max_limit=4)
+    _complete(limit, 2)
+    assert limit.limit == 2
+    _complete(limit, 3)
+    assert limit.limit == 3
+    _complete(limit, 50)
+    assert limit.limit == 4
+
+
+def test_multiplicative_decrease():
+    """Test that overload and latency spikes lower the limit once per cooldown"""
+    limit = AdaptiveConcurrency(initial_limit=8, max_limit=16, cooldown=60)
+    _complete(limit, 1, overloaded=True)
+    assert limit.limit == 4
+    _complete(limit, 3, overloaded=True)
+    assert limit.limit == 4
+
+    limit = AdaptiveConcurrency(initial_limit=16, max_limit=16, cooldown=0)
+    _complete(limit, 20, latency=0.01)
+    _complete(limit, 1, latency=1)
+    assert limit.limit == 8
+    _complete(limit, 10, overloaded=True)
+    assert limit.limit == 1
+
+
+def test_limits_requests_in_flight():
+    """Test that no more requests than the limit run at once"""
+    limit = AdaptiveConcurrency(initial_limit=2, max_limit=2)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def request():
+        """Records how many requests are in flight"""
+        limit.acquire()
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        limit.release(0.02)
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert in_flight[1] == 2
+
+
+def test_for_host():
+    """Test that every request to a host shares its limit, and that limits are reported"""
+    first = concurrency.for_host(('https', 'node.test.com', 4285), initial_limit=3)
+    assert concurrency.for_host(('https', 'node.test.com', 4285)) is first
+    assert concurrency.limits()['https:node.test.com:4285'] == 3
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
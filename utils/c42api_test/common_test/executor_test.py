@@ -0,0 +1,129 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the Executor class
+"""
+
+import threading
+import time
+from Queue import Full
+
+from c42api.common.executor import Executor, CancelledError, DeadlineExceeded
+from c42api_test import test_lib
+
+
+def test_submit():
+    """Test that futures hand back results and exceptions"""
+    with Executor(2) as executor:
+        future = executor.submit(lambda x, y=1: x + y, 1, y=2)
+        failed = executor.submit(lambda: 1 / 0)
+        assert future.result(5) == 3
+        assert isinstance(failed.exception(5), ZeroDivisionError)
+        try:
+            failed.result()
+            assert False
+        except ZeroDivisionError:
+            pass
+        assert future.submitted <= future.started <= future.finished
+
+
+def test_map_ordered_and_unordered():
+    """Test that map yields every result, in order if asked to"""
+    def slow_square(value):
+        """Sleeps longer for smaller values"""
+        time.sleep((5 - value) * 0.01)
+        return value * value
+    with Executor(5, max_queue=1) as executor:
+        assert list(executor.map(slow_square, range(5))) == [0, 1, 4, 9, 16]
+        unordered = list(executor.map(slow_square, range(5), ordered=False))
+        assert sorted(unordered) == [0, 1, 4, 9, 16]
+        assert unordered != [0, 1, 4, 9, 16]
+
+
+def test_backpressure():
+    """Test that a full queue pushes back on the producer"""
+    release = threading.Event()
+    executor = Executor(1, max_queue=1)
+    try:
+        executor.submit(release.wait)
+        time.sleep(0.05)
+        executor.submit(release.wait)
+        try:
+            executor.submit_nowait(release.wait)
+            assert False
+        except Full:
+            pass
+        try:
+            executor.schedule(release.wait, timeout=0.05)
+            assert False
+        except Full:
+            pass
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_deadline_and_shutdown():
+    """Test that tasks not started by their deadline, or at shutdown, are cancelled"""
+    release = threading.Event()
+    done = []
+    executor = Executor(1, on_task_done=done.append)
+    blocker = executor.submit(release.wait)
+    late = executor.schedule(lambda: 'late', deadline=time.time() + 0.01)
+    queued = executor.submit(lambda: 'queued')
+    time.sleep(0.05)
+    release.set()
+    try:
+        late.result(5)
+        assert False
+    except CancelledError:
+        pass
+    assert queued.result(5) == 'queued'
+
+    release.clear()
+    blocker = executor.submit(release.wait)
+    pending = executor.submit(lambda: 'pending')
+    while not blocker.started:
+        time.sleep(0.01)
+    executor.shutdown(wait=False, cancel_pending=True)
+    release.set()
+    blocker.result(5)
+    assert pending.cancelled()
+    assert late in done
+    try:
+        executor.submit(lambda: None)
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_map_deadline():
+    """Test that map gives up on results outstanding at its deadline"""
+    with Executor(1) as executor:
+        try:
+            list(executor.map(time.sleep, [0.2, 0.2, 0.2], deadline=time.time() + 0.1))
+            assert False
+        except DeadlineExceeded:
+            pass
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
@@ -0,0 +1,79 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the bounded-memory external sort
+"""
+
+from hypothesis import given
+import hypothesis.strategies as strat
+
+from c42api.common import external_sort
+from c42api_test import test_lib
+
+
+def _key(item):
+    """Sorts by path, then timestamp"""
+    return item['path'], item['ts']
+
+
+_ITEMS = strat.lists(strat.fixed_dictionaries({'path': strat.sampled_from([u'a', u'b', u'c']),
+                                               'ts': strat.integers(0, 5),
+                                               'n': strat.integers()}))
+
+
+@given(_ITEMS, strat.integers(1, 8))
+def test_external_sort_matches_sorted(items, buffer_size):
+    """Test that spilled, merged runs come back the same as a stable in-memory sort"""
+    result = list(external_sort.external_sort(iter(items), _key, buffer_size=buffer_size))
+    assert result == sorted(items, key=_key)
+
+
+def test_external_sort_sorted_input_one_run():
+    """Test that input that arrives in order is spilled as a single run without sorting"""
+    items = [{'path': u'p', 'ts': i} for i in range(100)]
+    runs = []
+    original_run = external_sort._Run  # pylint: disable=protected-access
+
+    def recording_run(tmp_dir):
+        """Records every run that gets created"""
+        run = original_run(tmp_dir)
+        runs.append(run)
+        return run
+    external_sort._Run = recording_run  # pylint: disable=protected-access
+    try:
+        result = list(external_sort.external_sort(items, _key, buffer_size=10))
+    finally:
+        external_sort._Run = original_run  # pylint: disable=protected-access
+    assert result == items
+    assert len(runs) == 1
+    assert runs[0].count == 100
+
+
+def test_external_sort_in_memory():
+    """Test that input that fits in the buffer is sorted without spilling"""
+    items = [{'path': u'b', 'ts': 1}, {'path': u'a', 'ts': 2}]
+    result = external_sort.external_sort(items, _key, buffer_size=10)
+    assert isinstance(result, type(iter([])))
+    assert list(result) == [items[1], items[0]]
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
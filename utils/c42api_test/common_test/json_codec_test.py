@@ -0,0 +1,85 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the JSON codec
+"""
+
+import json
+import os
+
+from c42api.common import json_codec
+from c42api_test import test_lib
+
+_EVENT = {u'eventType': u'PERSONAL_CLOUD_FILE_ACTIVITY', u'deviceGuid': 42, u'ratio': 0.1,
+          u'path': u'C:/Users/\u00e9t\u00e9/"q"', u'files': [{u'size': None, u'ok': True}]}
+
+
+@test_lib.reload_modules_post_execution(json_codec)
+def test_stdlib_compact():
+    """Test that the stdlib backend writes compact json"""
+    json_codec.set_backend('stdlib')
+    assert json_codec.backend() == 'stdlib'
+    assert json_codec.dumps({'a': [1, 2]}) == '{"a":[1,2]}'
+    assert json_codec.dumps(_EVENT) == json.dumps(_EVENT, separators=(',', ':'))
+    assert json_codec.loads(json_codec.dumps(_EVENT)) == _EVENT
+
+
+@test_lib.reload_modules_post_execution(json_codec)
+def test_every_backend_matches_stdlib():
+    """Test that every installed backend encodes and decodes like the json module"""
+    assert 'stdlib' in json_codec.available_backends()
+    for name in json_codec.available_backends():
+        json_codec.set_backend(name)
+        assert json_codec.dumps(_EVENT) == json.dumps(_EVENT, separators=(',', ':'))
+        assert json_codec.loads(json.dumps(_EVENT)) == _EVENT
+
+
+@test_lib.reload_modules_post_execution(json_codec)
+def test_forced_backend():
+    """Test that the environment setting forces a backend"""
+    os.environ[json_codec.BACKEND_SETTING] = 'stdlib'
+    try:
+        json_codec.set_backend()
+        assert json_codec.backend() == 'stdlib'
+        os.environ[json_codec.BACKEND_SETTING] = 'nope'
+        try:
+            json_codec.set_backend()
+            assert False
+        except ValueError:
+            pass
+    finally:
+        del os.environ[json_codec.BACKEND_SETTING]
+
+
+@test_lib.reload_modules_post_execution(json_codec)
+def test_missing_backend():
+    """Test that forcing a backend that isn't installed fails loudly"""
+    if 'ujson' in json_codec.available_backends():
+        return
+    try:
+        json_codec.set_backend('ujson')
+        assert False
+    except ImportError:
+        pass
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
@@ -0,0 +1,108 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the incremental JSON reader
+"""
+
+import json
+from hypothesis import given
+import hypothesis.strategies as strat
+
+from c42api.common import json_stream
+from c42api_test import test_lib
+
+
+def _chunks(text, size):
+    """
+    :return: The text split into chunks of the given size
+    """
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+_JSON_VALUES = strat.recursive(
+    strat.none() | strat.booleans() | strat.integers() | strat.text(),
+    lambda children: strat.lists(children, average_size=3) |
+    strat.dictionaries(strat.text(), children, average_size=3),
+    max_leaves=10)
+
+
+@given(strat.lists(_JSON_VALUES), strat.integers(1, 17))
+def test_iter_array_any_chunking(elements, chunk_size):
+    """Test that every element comes back whatever the chunk boundaries"""
+    document = json.dumps({'metadata': {'data': 'x'}, 'data': {'items': elements}, 'after': [1]})
+    result = list(json_stream.iter_array(_chunks(document, chunk_size), ('data', 'items')))
+    assert result == elements
+
+
+def test_iter_array_top_level():
+    """Test that an empty path reads a top level array"""
+    document = b'[1, "two", {"three": [3]}, [], null]'
+    assert list(json_stream.iter_array(_chunks(document, 2), ())) == [1, u'two', {u'three': [3]}, [], None]
+
+
+def test_iter_array_missing_path():
+    """Test that nothing comes back when the path doesn't lead to an array"""
+    assert list(json_stream.iter_array([b'{}'], ('data',))) == []
+    assert list(json_stream.iter_array([b'{"data": {"items": 1}}'], ('data', 'items'))) == []
+    assert list(json_stream.iter_array([b'{"data": []}'], ('data',))) == []
+
+
+def test_iter_array_ignores_nested_lookalikes():
+    """Test that arrays under the same key deeper in the document are skipped"""
+    document = b'{"other": {"data": [1]}, "data": [{"data": [2]}, "a,]\\"b"]}'
+    assert list(json_stream.iter_array(_chunks(document, 3), ('data',))) == [{u'data': [2]}, u'a,]"b']
+
+
+def test_iter_array_split_numbers():
+    """Test that numbers split across chunks aren't read before they end"""
+    document = b'[1e5, -12.5E-3, 100, true, 7]'
+    for chunk_size in range(1, len(document)):
+        assert list(json_stream.iter_array(_chunks(document, chunk_size), ())) == [1e5, -12.5E-3, 100, True, 7]
+
+
+def test_iter_array_malformed():
+    """Test that a malformed element or an unterminated array raises ValueError"""
+    for document in [b'{"data": [1, {"a": }]}', b'{"data": [1, 2', b'{"data": [1, {"a": 1']:
+        try:
+            list(json_stream.iter_array(_chunks(document, 4), ('data',)))
+            assert False
+        except ValueError:
+            pass
+
+
+def test_iter_array_bounded_buffer():
+    """Test that elements are yielded before the rest of the document is read"""
+    read = []
+
+    def chunks():
+        """Yields one element per chunk, recording how far it has got"""
+        yield b'{"data": ['
+        for i in range(1000):
+            read.append(i)
+            yield b'{"i": %d},' % i if i < 999 else b'{"i": %d}' % i
+        yield b']}'
+
+    for element in json_stream.iter_array(chunks(), ('data',)):
+        assert read[-1] - element['i'] <= 1
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
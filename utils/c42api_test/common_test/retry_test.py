@@ -0,0 +1,149 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the RetryPolicy class
+"""
+
+import json
+import httpretty
+import requests
+
+from c42api.common.retry import RetryPolicy
+from c42api.common.server import Server
+from c42api_test import test_lib
+
+
+def _http_error(status_code, headers=None):
+    """
+    :return: An HTTPError for a response with the status code and headers
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+def test_is_retryable():
+    """Test that only transient failures are retried"""
+    policy = RetryPolicy()
+    assert policy.is_retryable(_http_error(503))
+    assert policy.is_retryable(_http_error(429))
+    assert policy.is_retryable(requests.ConnectionError())
+    assert policy.is_retryable(requests.Timeout())
+    assert not policy.is_retryable(_http_error(404))
+    assert not policy.is_retryable(_http_error(401))
+    assert not policy.is_retryable(ValueError())
+
+
+def test_is_retryable_not_idempotent():
+    """Test that a request that isn't idempotent is only retried if it never reached the server"""
+    policy = RetryPolicy()
+    assert policy.is_retryable(requests.exceptions.ConnectTimeout(), idempotent=False)
+    assert not policy.is_retryable(requests.exceptions.ReadTimeout(), idempotent=False)
+    assert not policy.is_retryable(requests.ConnectionError(), idempotent=False)
+    assert not policy.is_retryable(_http_error(503), idempotent=False)
+
+
+def test_delay():
+    """Test that delays back off exponentially with jitter, and honour Retry-After"""
+    policy = RetryPolicy(backoff=1, max_backoff=5, jitter=0.5, max_retry_after=60)
+    for attempt, full_delay in [(1, 1), (2, 2), (3, 4), (4, 5), (10, 5)]:
+        delay = policy.delay(attempt)
+        assert full_delay * 0.5 <= delay <= full_delay
+    assert policy.delay(1, _http_error(429, {'Retry-After': '7'})) == 7
+    assert policy.delay(1, _http_error(429, {'Retry-After': '600'})) == 60
+    assert policy.delay(1, _http_error(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0
+
+
+def test_call():
+    """Test that transient failures are retried until the attempts run out"""
+    policy = RetryPolicy(max_attempts=3, backoff=0)
+    failures = [_http_error(503), requests.ConnectionError()]
+
+    def flaky():
+        """Fails until the failures run out"""
+        if failures:
+            raise failures.pop(0)
+        return 'result'
+    retried = []
+    assert policy.call(flaky, lambda attempt, error, delay: retried.append(attempt)) == ('result', 2)
+    assert retried == [1, 2]
+
+    failures = [_http_error(503)] * 3
+    try:
+        policy.call(flaky)
+        assert False
+    except requests.HTTPError as e:
+        assert e.retries == 2
+    assert not failures
+
+    failures = [_http_error(404), _http_error(503)]
+    try:
+        policy.call(flaky)
+        assert False
+    except requests.HTTPError as e:
+        assert e.retries == 0
+    assert len(failures) == 1
+
+
+@test_lib.warning_to_null
+@httpretty.activate
+def test_server_retries():
+    """Test that a Server retries a transient failure"""
+    httpretty.register_uri(httpretty.GET, 'http://test.com:7777/api/Test',
+                           responses=[
+                               httpretty.Response(body='', status=503),
+                               httpretty.Response(body=json.dumps({'result': 'test'}), status=200),
+                           ])
+    server = Server('test.com', '7777', 'testname', 'testword', retry_policy=RetryPolicy(backoff=0))
+    response = server.get('Test')
+    assert Server.json_from_response(response)['result'] == 'test'
+    assert response.retries == 1
+
+
+@test_lib.warning_to_null
+@httpretty.activate
+def test_server_post_retries():
+    """Test that a Server only retries a failed POST if the caller says it's idempotent"""
+    def register():
+        """Registers a failure followed by a success"""
+        httpretty.reset()
+        httpretty.register_uri(httpretty.POST, 'http://test.com:7777/api/Test',
+                               responses=[
+                                   httpretty.Response(body='', status=503),
+                                   httpretty.Response(body=json.dumps({'result': 'test'}), status=200),
+                               ])
+    server = Server('test.com', '7777', 'testname', 'testword', retry_policy=RetryPolicy(backoff=0))
+    register()
+    try:
+        server.post('Test', payload={})
+        assert False
+    except requests.HTTPError as e:
+        assert e.retries == 0
+
+    register()
+    response = server.post('Test', payload={}, idempotent=True)
+    assert Server.json_from_response(response)['result'] == 'test'
+    assert response.retries == 1
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
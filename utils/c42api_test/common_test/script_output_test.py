@@ -22,8 +22,12 @@
 Tests for the script output functions
 """
 
+import datetime
 import json
+import os
+import shutil
 import string
+import tempfile
 from hypothesis import given, assume, Settings
 import hypothesis.strategies as strat
 
@@ -95,6 +99,121 @@ def test_output_no_json_splunk():
     assert len(lines) == 0
 
 
+def test_splunk_event_writer_matches_write_json_splunk():
+    """Test that buffered events come out exactly as write_json_splunk writes them"""
+    pages = [[{'page': page, 'event': event, 'name': u'caf\xe9'} for event in range(page)] for page in range(6)]
+    expected = WriteTester()
+    for page in pages:
+        script_output.write_json_splunk(expected, page)
+    output_file = WriteTester()
+    writer = script_output.SplunkEventWriter(output_file)
+    for page in pages:
+        writer.write_events(page)
+    assert output_file.line_list == []
+    writer.close()
+    assert ''.join(output_file.line_list) == ''.join(expected.line_list)
+    assert len(output_file.line_list) == 1
+
+
+def test_splunk_event_writer_flush_policy():
+    """Test that each limit of the flush policy writes out the whole buffer"""
+    page = [{'event': event} for event in range(3)]
+
+    output_file = WriteTester()
+    writer = script_output.SplunkEventWriter(output_file, max_events=5)
+    writer.write_events(page)
+    assert output_file.line_list == []
+    writer.write_events(page)
+    assert len(output_file.line_list) == 1
+    assert len(''.join(output_file.lines()).splitlines()) == 6
+
+    output_file = WriteTester()
+    writer = script_output.SplunkEventWriter(output_file, max_bytes=1)
+    writer.write_events(page[:1])
+    assert len(''.join(output_file.lines()).splitlines()) == 1
+
+    output_file = WriteTester()
+    writer = script_output.SplunkEventWriter(output_file, max_seconds=0)
+    writer.write_events(page)
+    assert len(''.join(output_file.lines()).splitlines()) == 3
+    writer.write_events([])
+    assert len(output_file.line_list) == 1
+
+
+def test_splunk_event_writer_flushed_at_exit():
+    """Test that open writers are flushed by the exit handler"""
+    output_file = WriteTester()
+    writer = script_output.SplunkEventWriter(output_file)
+    writer.write_events([{'event': 1}])
+    script_output._flush_open_writers()  # pylint: disable=protected-access
+    assert output_file.lines() == ['{"event":1}\n']
+    writer.close()
+    assert writer not in script_output._OPEN_WRITERS  # pylint: disable=protected-access
+
+
+class _KilledMidWrite(WriteTester):
+    """
+    Flushes the open writers from the first write, as the signal handler
+    does, then dies before that write is made.
+    """
+    def __init__(self):
+        super(_KilledMidWrite, self).__init__()
+        self.killed = False
+
+    def write(self, data):
+        if not self.killed:
+            self.killed = True
+            script_output._flush_open_writers()  # pylint: disable=protected-access
+            raise SystemExit()
+        super(_KilledMidWrite, self).write(data)
+
+
+class _FailingWriteTester(WriteTester):
+    """A WriteTester whose writes fail until it's fixed"""
+    def __init__(self):
+        super(_FailingWriteTester, self).__init__()
+        self.broken = True
+
+    def write(self, data):
+        if self.broken:
+            raise IOError("No space left on device")
+        super(_FailingWriteTester, self).write(data)
+
+
+def test_splunk_event_writer_keeps_events_on_failed_write():
+    """Test that events stay buffered when writing them out fails"""
+    output_file = _FailingWriteTester()
+    writer = script_output.SplunkEventWriter(output_file)
+    writer.write_events([{'event': 1}])
+    try:
+        writer.flush()
+        assert False
+    except IOError:
+        pass
+    output_file.broken = False
+    writer.write_events([{'event': 2}])
+    writer.flush()
+    assert output_file.lines() == ['{"event":1}\n{"event":2}\n']
+    writer.write_events([{'event': 3}])
+    writer.discard()
+    writer.close()
+    assert output_file.lines() == ['{"event":1}\n{"event":2}\n']
+
+
+def test_splunk_event_writer_killed_mid_flush():
+    """Test that events being flushed when a fatal signal arrives are written by the handler"""
+    output_file = _KilledMidWrite()
+    writer = script_output.SplunkEventWriter(output_file)
+    writer.write_events([{'event': 1}])
+    try:
+        writer.flush()
+        assert False
+    except SystemExit:
+        pass
+    assert output_file.lines() == ['{"event":1}\n']
+    writer.close()
+
+
 @given(strat.text(), strat.text(), settings=Settings(max_examples=50))
 def test_output_csv(random1, random2):
     """Test to make sure CSV is written out correctly"""
@@ -205,5 +324,103 @@ def test_output_csv_no_data():
     assert len(lines) == 0
 
 
+def _walked_values(keyset, item):
+    """The values for a row found by walking the KeySet, without a plan"""
+    values = []
+    for top_level_key in keyset.all_keys():
+        values = values + csv.dict_into_values(item, top_level_key, 0, False)
+    return values
+
+
+_COMPUTERS = strat.lists(strat.fixed_dictionaries({
+    'guid': strat.integers(),
+    'name': strat.text(),
+    'backupUsage': strat.lists(strat.fixed_dictionaries({'targetComputerName': strat.text(),
+                                                         'percentComplete': strat.floats(0, 100)}),
+                               min_size=1),
+    'settings': strat.fixed_dictionaries({'cpu': strat.integers(), 'paths': strat.lists(strat.text(), min_size=1)}),
+}), min_size=1)
+
+
+@given(_COMPUTERS, settings=Settings(max_examples=50))
+def test_row_plan_matches_walk(computers):
+    """Test that a compiled plan finds the same values as walking the KeySet"""
+    keyset = csv.KeySet()
+    for key, value in computers[0].items():
+        keyset.add_key(csv.create_key(key, value))
+    plan = keyset.freeze().plan()
+    assert keyset.plan() is plan
+    assert len(plan.header) == len(_walked_values(keyset, computers[0]))
+    for computer in computers:
+        assert plan.values(computer) == _walked_values(keyset, computer)
+        assert plan.csv_string(computer) == csv.create_csv_string(_walked_values(keyset, computer))
+
+
+def test_row_plan_keeps_columns_aligned():
+    """Test that rows shaped unlike the first still have one value per column"""
+    data = [{'file': {'path': 'a', 'size': 1}, 'tags': [{'name': 'x'}]},
+            {'file': 'not a dict', 'tags': []},
+            {'file': {'path': {'deep': 1}}}]
+    output_file = WriteTester()
+    script_output.write_csv(output_file, data, header=True, sample_size=1)
+    lines = output_file.lines()
+    assert lines[0] == 'file_path,file_size,tags_name\n'
+    assert lines[1] == 'a,1,x\n'
+    assert lines[2] == ',,\n'
+    assert lines[3] == '"{""deep"": 1}",,\n'
+
+
+def test_frozen_keyset():
+    """Test that a frozen KeySet refuses new keys"""
+    keyset = csv.KeySet()
+    keyset.add_key(csv.create_key('a', 1))
+    keyset.freeze()
+    try:
+        keyset.add_key(csv.create_key('b', 1))
+        assert False
+    except ValueError:
+        pass
+    assert [key.key for key in keyset.all_keys()] == ['a']
+
+
+def test_output_csv_sampled_columns():
+    """Test that keys first seen after the first item still get columns"""
+    data = [{'eventType': 'FILE', 'fileName': 'a'},
+            {'eventType': 'RESTORE', 'restoreId': 7},
+            {'eventType': 'FILE', 'cloudStorageProvider': 'box'}]
+    output_file = WriteTester()
+    script_output.write_csv(output_file, data, header=True, sample_size=2)
+    lines = output_file.lines()
+    assert lines == ['eventType,fileName,restoreId\n', 'FILE,a,\n', 'RESTORE,,7\n', 'FILE,,\n']
+
+
+@test_lib.reload_modules_post_execution(script_output)
+def test_output_csv_sample_spills():
+    """Test that a sample too big for memory comes back whole and in order"""
+    script_output.SAMPLE_MEMORY = 100
+    data = [{'n': i, 'when': datetime.datetime(2016, 1, 1)} for i in range(50)]
+    output_file = WriteTester()
+    script_output.write_csv(output_file, data, header=True)
+    lines = output_file.lines()
+    assert lines[0] == 'n,when\n'
+    assert lines[1:] == ['{},2016-01-01 00:00:00\n'.format(i) for i in range(50)]
+
+
+def test_output_csv_widening_header():
+    """Test that new keys widen a sidecar header without moving old columns"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        header_path = os.path.join(tmp_dir, 'header.csv')
+        data = [{'b': 1, 'd': {'x': 2}}, {'b': 3, 'a': 4}, {'c': 5, 'd': {'x': 6}}]
+        output_file = WriteTester()
+        script_output.write_csv(output_file, data, header=True, sample_size=1, header_path=header_path)
+        assert output_file.lines() == ['1,2\n', '3,,4\n', ',6,,5\n']
+        with open(header_path) as header_file:
+            assert header_file.read() == 'b,d_x,a,c\n'
+        assert os.listdir(tmp_dir) == ['header.csv']
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 if __name__ == '__main__':
     test_lib.run_all_tests()
@@ -29,6 +29,7 @@ import hypothesis.strategies as strat
 import httpretty
 
 from c42api.common.server import Server
+from c42api.common.throttle import Throttle
 import c42api_test.test_lib as test_lib
 
 
@@ -138,6 +139,24 @@ def test_server_ssl_setting():
     except AttributeError:
         pass
 
+def test_session_pool():
+    """Test to make sure each server owns a pooled session unless given one"""
+    server = Server("code42.com", protocol="https", verify_ssl=False, pool_size=4)
+    adapter = server.session.get_adapter('https://code42.com')
+    assert adapter._pool_maxsize == 4  # pylint: disable=protected-access
+    assert server.session.verify == False
+    assert basic_server().session is not basic_server().session
+
+    node = Server("node.code42.com", protocol="https", session=server.session)
+    assert node.session is server.session
+
+    try:
+        server.session = None
+        assert False
+    except AttributeError:
+        pass
+
+
 def test_server_address():
     """Test to make sure server_address is immutable"""
     server = basic_server()
@@ -217,6 +236,39 @@ def test_get():
     assert Server.json_from_response(resp)['result'] == 'test'
 
 
+@test_lib.warning_to_null
+@httpretty.activate
+def test_get_reuses_session():
+    """Test to make sure every request goes through the server's session"""
+    httpretty.register_uri(httpretty.GET, 'http://test.com:7777/api/Test',
+                           body=json.dumps({'result': 'test'}), content_type='application/json')
+    server = basic_server()
+    calls = []
+    original_get = server.session.get
+
+    def counting_get(*args, **kwargs):
+        """Records each call made through the session"""
+        calls.append(args)
+        return original_get(*args, **kwargs)
+    server.session.get = counting_get
+    server.get('Test')
+    server.get('Test')
+    assert len(calls) == 2
+
+
+@test_lib.warning_to_null
+@httpretty.activate
+def test_get_throttled():
+    """Test to make sure requests wait on the server's throttle"""
+    httpretty.register_uri(httpretty.GET, 'http://test.com:7777/api/Test',
+                           body=json.dumps({'result': 'test'}), content_type='application/json')
+    server = Server('test.com', '7777', 'testname', 'testword', throttle=Throttle(rate=20, burst=1))
+    server.get('Test')
+    response = server.get('Test')
+    assert response.throttle_wait > 0
+    assert server.throttle.stats()['requests'] == 2
+
+
 @test_lib.warning_to_null
 @httpretty.activate
 def test_post():
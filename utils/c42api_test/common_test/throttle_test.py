@@ -0,0 +1,82 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the Throttle class
+"""
+
+import threading
+import time
+
+from c42api.common import throttle
+from c42api.common.throttle import Throttle
+from c42api_test import test_lib
+
+
+def test_rate_limit():
+    """Test that requests past the burst are spaced out by the rate"""
+    limiter = Throttle(rate=50, burst=2)
+    start = time.time()
+    for _ in range(7):
+        limiter.acquire()
+        limiter.release()
+    elapsed = time.time() - start
+    assert 0.09 <= elapsed < 1
+    stats = limiter.stats()
+    assert stats['requests'] == 7
+    assert stats['waits'] == 5
+    assert stats['wait_time'] >= 0.09
+
+
+def test_max_in_flight():
+    """Test that no more than max_in_flight requests run at once"""
+    bulkhead = Throttle(max_in_flight=2)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def request():
+        """Records how many requests are in flight"""
+        bulkhead.acquire()
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        bulkhead.release()
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert in_flight[1] == 2
+    assert bulkhead.stats()['waits'] >= 1
+
+
+def test_for_host():
+    """Test that every request to a host shares its throttle"""
+    first = throttle.for_host(('https', 'node.test.com', 4285), rate=5)
+    assert throttle.for_host(('https', 'node.test.com', 4285), rate=10) is first
+    assert first.rate == 5
+    assert throttle.for_host(('https', 'other.test.com', 4285)) is not first
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
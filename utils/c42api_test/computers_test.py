@@ -70,6 +70,47 @@ def test_fetch_all_devicess(osname1, osname2):
     assert computer_id == 3
 
 
+class _PagedServer(c42api.Server):
+    """
+    A Server that answers Computer requests by pgNum without touching the
+    network, so pages can be requested concurrently and in any order.
+    """
+    def __init__(self, page_count, page_size, total_count=None):
+        c42api.Server.__init__(self, 'test.com', '7777', 'testname', 'testword')
+        self.page_count = page_count
+        self.page_size = page_size
+        self.total_count = total_count
+        self.requested = []
+
+    def get(self, resource, params=None, login_token=None):
+        """Answers a page request with page_size computers"""
+        page = int(params['pgNum'])
+        self.requested.append(page)
+        computers = []
+        if page <= self.page_count:
+            computers = [{'computerId': (page - 1) * self.page_size + i} for i in range(self.page_size)]
+        data = {'computers': computers}
+        if self.total_count is not None:
+            data['totalCount'] = self.total_count
+        return FakeResponse(json.dumps({'data': data}))
+
+
+def test_fetch_devices_prefetch_total_count():
+    """Test that prefetched pages come back in order and stop at totalCount"""
+    server = _PagedServer(7, 3, total_count=21)
+    computers = list(c42api.fetch_computers(server, {'pgSize': '3'}, prefetch=3))
+    assert [x['computerId'] for x in computers] == list(range(21))
+    assert sorted(server.requested) == list(range(1, 8))
+
+
+def test_fetch_devices_prefetch_no_total_count():
+    """Test that prefetched pages come back in order without a totalCount"""
+    server = _PagedServer(5, 2)
+    computers = list(c42api.fetch_computers(server, {'pgSize': '2'}, prefetch=4))
+    assert [x['computerId'] for x in computers] == list(range(10))
+    assert 6 in server.requested
+
+
 @test_lib.warning_to_null
 @httpretty.activate
 def test_fetch_no_devices():
@@ -84,5 +125,12 @@ def test_fetch_no_devices():
         assert False
 
 
+# pylint: disable=too-few-public-methods
+class FakeResponse(object):
+    """A dummy response object that has relevant instance variables"""
+    def __init__(self, content):
+        self.content = content
+
+
 if __name__ == '__main__':
     test_lib.run_all_tests()
@@ -24,8 +24,14 @@ Test aspects of the security event restore script
 # Disabling 'unused-argument' because of all the mock functions
 # Disabling 'invalid-name' because of the length of the test functions' names
 # pylint: disable=protected-access, import-error, unused-argument, invalid-name
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import shutil
+import tempfile
 import c42api
+from c42api.common import json_codec
 from c42api_test import test_lib
 import random
 import sys
@@ -64,6 +70,9 @@ def create_event_filter_by_datetime_test():
     event_filter = c42api.create_filter_by_utc_datetime(min_datetime, max_datetime)
     assert event_filter == {'minTs':expected_min_ts_result, 'maxTs':expected_max_ts_result}
 
+    event_filter = c42api.create_filter_by_utc_datetime(datetime(2016, 1, 1), datetime(2016, 1, 1, 0, 0, 1, 234567))
+    assert event_filter == {'minTs': '2016-01-01T00:00:00.000Z', 'maxTs': '2016-01-01T00:00:01.234Z'}
+
     try:
         c42api.create_filter_by_utc_datetime(max_datetime, min_datetime)
         assert False
@@ -97,50 +106,299 @@ def create_event_filter_by_cursor_test():
         except ValueError:
             pass
 
-@test_lib.reload_modules_post_execution(c42api)
-def fetch_detection_events_test():
+def _fetch_detection_events_with_mock(num_threads, output_file=None, broken_device=None):
     """
-    Test we fetch detection events in an expected way
+    Run fetch_detection_events with the per-device fetch mocked out.
+
+    :param output_file:   The file to write events to, a WriteTester by default
+    :param broken_device: A device whose fetch raises a KeyError
+    :return: The yielded results along with the number of lines written when
+              each was yielded, the written lines and the expected results
     """
-    cursor_string = generate_cursor()
-    device_guids = [1, 2, 3]
-    event_filters = ['word'] * 3
+    device_guids = [str(guid) for guid in range(1, 10)]
+    event_filters = [c42api.create_filter_by_utc_datetime(datetime.fromtimestamp(0), datetime.now())] * 9
     guids_and_filters = zip(device_guids, event_filters)
     expected_results = {}
     for device_guid in device_guids:
-        expected_results[str(device_guid)] = [
-            'word',
-            generate_detection_events(random.randint(1, 20))
+        expected_results[device_guid] = [
+            'minTs' + device_guid,
+            [generate_detection_events(random.randint(1, 20)) for _ in range(3)]
         ]
 
-    event_filter = c42api.create_filter_by_cursor(cursor_string)
-
-    def mock_fetch_detection_events_for_device(server, device_guid, event_filter):
+    def mock_fetch_detection_events_for_device(server, device_guid, event_filter, cursor_dict, write_page):
         """
         Mock Func
         """
-        return expected_results[str(device_guid)][0], expected_results[str(device_guid)][1]
+        assert event_filter is not event_filters[0]
+        if device_guid == broken_device:
+            raise KeyError('planUid')
+        event_filter['cursor'] = device_guid
+        count = 0
+        for page in expected_results[device_guid][1]:
+            write_page([json_codec.dumps({'deviceGuid': device_guid, 'event': event}) for event in page])
+            count += len(page)
+        return expected_results[device_guid][0], count, cursor_dict
+
+    original = c42api.security_event_restore._fetch_detection_events_for_device
+    c42api.security_event_restore._fetch_detection_events_for_device = mock_fetch_detection_events_for_device
+    cursor_dir = tempfile.mkdtemp()
+    cursor_path = os.path.join(cursor_dir, 'cursor')
+    output_file = output_file or test_lib.WriteTester()
+    try:
+        # Record how many lines were written by the time each device was reported.
+        results = [(device_guid, next_min_ts, len(''.join(output_file.lines()).splitlines()))
+                   for device_guid, next_min_ts in c42api.fetch_detection_events(
+                       basic_server(), guids_and_filters, cursor_path,
+                       num_threads=num_threads, out=output_file)]
+    finally:
+        c42api.security_event_restore._fetch_detection_events_for_device = original
+        shutil.rmtree(cursor_dir)
+    assert 'cursor' not in event_filters[0]
+    return results, ''.join(output_file.lines()).splitlines(), expected_results
+
+
+@test_lib.reload_modules_post_execution(c42api)
+def fetch_detection_events_test():
+    """
+    Test we fetch detection events in an expected way
+    """
+    results, lines, expected_results = _fetch_detection_events_with_mock(1)
+
+    assert [device_guid for device_guid, _, _ in results] == sorted(expected_results, key=int)
+    for device_guid, next_min_ts, _ in results:
+        assert next_min_ts == expected_results[device_guid][0]
+    written = [(event['deviceGuid'], event['event']) for event in (json.loads(line) for line in lines)]
+    expected = [(device_guid, event)
+                for device_guid in sorted(expected_results, key=int)
+                for page in expected_results[device_guid][1]
+                for event in page]
+    assert written == expected
+
+
+@test_lib.reload_modules_post_execution(c42api)
+def fetch_detection_events_threaded_test():
+    """
+    Test that fetching devices concurrently writes every device's events in
+    page order, and only reports a device once its events are written
+    """
+    results, lines, expected_results = _fetch_detection_events_with_mock(4)
+
+    assert sorted(device_guid for device_guid, _, _ in results) == sorted(expected_results)
+    for device_guid, next_min_ts, written_count in results:
+        assert next_min_ts == expected_results[device_guid][0]
+        written = [event['event'] for event in (json.loads(line) for line in lines[:written_count])
+                   if event['deviceGuid'] == device_guid]
+        expected = [event for page in expected_results[device_guid][1] for event in page]
+        assert written == expected
+
+
+class _FailingWriter(test_lib.WriteTester):
+    """A WriteTester that fails to write one device's events"""
+    def __init__(self, device_guid):
+        test_lib.WriteTester.__init__(self)
+        self.device_guid = device_guid
+
+    def write(self, text):
+        if '"deviceGuid":"{}"'.format(self.device_guid) in text:
+            raise IOError("Broken pipe")
+        test_lib.WriteTester.write(self, text)
+
+
+@test_lib.reload_modules_post_execution(c42api)
+def fetch_detection_events_write_failure_test():
+    """
+    Test that a device whose events fail to be written is reported as failed,
+    while the other devices still succeed
+    """
+    results, lines, expected_results = _fetch_detection_events_with_mock(1, _FailingWriter('4'))
+
+    for device_guid, next_min_ts, _ in results:
+        if device_guid == '4':
+            assert next_min_ts is None
+        else:
+            assert next_min_ts == expected_results[device_guid][0]
+    assert len(results) == len(expected_results)
+    assert '4' not in set(json.loads(line)['deviceGuid'] for line in lines)
+
+
+class _RecordingHandler(logging.Handler):
+    """A logging handler that keeps every record"""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
 
-    def mock_fetch_security_plan(server, device_guid):
+
+@test_lib.reload_modules_post_execution(c42api)
+def fetch_detection_events_task_failure_test():
+    """
+    Test that a task that raises something other than a RequestException is
+    logged with its traceback and reported as failed
+    """
+    handler = _RecordingHandler()
+    logger = c42api.security_event_restore.LOG
+    logger.addHandler(handler)
+    try:
+        results, lines, expected_results = _fetch_detection_events_with_mock(2, broken_device='6')
+    finally:
+        logger.removeHandler(handler)
+
+    assert len(results) == len(expected_results)
+    for device_guid, next_min_ts, _ in results:
+        if device_guid == '6':
+            assert next_min_ts is None
+        else:
+            assert next_min_ts == expected_results[device_guid][0]
+    failures = [record for record in handler.records if record.exc_info]
+    assert len(failures) == 1
+    assert failures[0].exc_info[0] is KeyError
+
+
+def _reference_unbatched_lines(detection_events):
+    """
+    :return: The JSON lines of the detection events unbatched one dictionary
+              per file
+    """
+    lines = []
+    for detection_event in detection_events:
+        try:
+            for file_dict in detection_event["files"]:
+                unbatched_event = {}
+                for field in c42api.security_event_restore._SHARED_FIELDS:
+                    if detection_event.get(field) is not None:
+                        unbatched_event[field] = detection_event[field]
+                unbatched_event["file"] = file_dict
+                unbatched_event["timestamp"] = file_dict["detectionTimestamp"]
+                lines.append(json_codec.dumps(unbatched_event))
+        except (KeyError, TypeError):
+            lines.append(json_codec.dumps(detection_event))
+    return lines
+
+
+def unbatch_files_in_events_test():
+    """
+    Test that unbatched events are encoded byte for byte as they would be
+    one dictionary at a time, whichever of the shared fields are set
+    """
+    rand = random.Random(42)
+    fields = c42api.security_event_restore._SHARED_FIELDS
+    events = []
+    for i in range(200):
+        event = dict((field, rand.choice([None, i, u'value\u00e9 "{}"'.format(i), {'file': i}]))
+                     for field in rand.sample(fields, rand.randint(0, len(fields))))
+        event['fileStats'] = {'count': i}
+        event['files'] = [{'fileName': u'file{}'.format(j), 'detectionTimestamp': u'2016-01-0{}'.format(j % 9 + 1)}
+                          for j in range(rand.randint(0, 4))]
+        events.append(event)
+    events.append({'eventType': 'NO_FILES'})
+    events.append({'eventType': 'NULL_FILES', 'files': None})
+    events.append({'eventType': 'NO_TIMESTAMP', 'files': [{'detectionTimestamp': 'ts'}, {'fileName': 'f'}]})
+    events.append({'eventType': c42api.security_event_restore._FILE_PLACEHOLDER,
+                   'files': [{'detectionTimestamp': 'ts'}, {'detectionTimestamp': 'ts'}]})
+
+    lines = c42api.security_event_restore._unbatch_files_in_events(events)
+    assert lines == _reference_unbatched_lines(events)
+    assert json.loads(lines[-1])['eventType'] == c42api.security_event_restore._FILE_PLACEHOLDER
+    assert [json.loads(line)['eventType'] for line in lines[-6:-2]] == \
+        ['NO_FILES', 'NULL_FILES', 'NO_TIMESTAMP', 'NO_TIMESTAMP']
+
+
+def backfill_windows_test():
+    """
+    Test that a backfill range is split into windows, newest first, with the
+    older half of the windows splitting the rest of the range evenly
+    """
+    min_datetime = datetime(2016, 1, 1)
+    max_datetime = datetime(2016, 1, 10, 12)
+    windows = c42api.security_event_restore._backfill_windows(min_datetime, max_datetime, timedelta(days=1), 4)
+    millisecond = timedelta(milliseconds=1)
+    assert windows == [(datetime(2016, 1, 9, 12), max_datetime),
+                       (datetime(2016, 1, 8, 12), datetime(2016, 1, 9, 12) - millisecond),
+                       (datetime(2016, 1, 4, 18), datetime(2016, 1, 8, 12) - millisecond),
+                       (min_datetime, datetime(2016, 1, 4, 18) - millisecond)]
+
+    windows = c42api.security_event_restore._backfill_windows(datetime(1970, 1, 1), max_datetime,
+                                                              timedelta(days=1), 90)
+    assert len(windows) == 90
+    assert windows[44][0] == max_datetime - timedelta(days=45)
+    assert windows[-1][0] == datetime(1970, 1, 1)
+    assert all(newer[0] - millisecond == older[1] for newer, older in zip(windows, windows[1:]))
+    assert max(window_max - window_min for window_min, window_max in windows) < timedelta(days=400)
+
+    windows = c42api.security_event_restore._backfill_windows(min_datetime, max_datetime, timedelta(days=7), 4)
+    assert windows == [(datetime(2016, 1, 3, 12), max_datetime),
+                       (min_datetime, datetime(2016, 1, 3, 12) - millisecond)]
+    # Neighbouring windows' filters don't share a timestamp.
+    filters = [c42api.create_filter_by_utc_datetime(*window) for window in windows]
+    assert filters[0]['minTs'] == '2016-01-03T12:00:00.000Z'
+    assert filters[1]['maxTs'] == '2016-01-03T11:59:59.999Z'
+    assert c42api.security_event_restore._backfill_windows(min_datetime, min_datetime, timedelta(days=1), 4) == []
+
+
+@test_lib.reload_modules_post_execution(c42api)
+def backfill_detection_events_resume_test():
+    """
+    Test that a backfill fetches each window once, resumes after a failed
+    window, and only reports a device once all of its windows are fetched
+    """
+    fetched = []
+    failing = []
+
+    def mock_fetch_detection_events_for_device(server, device_guid, event_filter, cursor_dict, write_page):
         """
         Mock Func
         """
-        return {'planUid':12312123}
+        if event_filter['minTs'] in failing:
+            raise c42api.security_event_restore.RequestException()
+        fetched.append((device_guid, event_filter['minTs'], event_filter['maxTs']))
+        write_page([json_codec.dumps({'deviceGuid': device_guid, 'event': event_filter['minTs']})])
+        return event_filter['maxTs'], 1, cursor_dict
+
+    original = c42api.security_event_restore._fetch_detection_events_for_device
+    c42api.security_event_restore._fetch_detection_events_for_device = mock_fetch_detection_events_for_device
+    backfill_dir = tempfile.mkdtemp()
+    cursor_path = os.path.join(backfill_dir, 'cursor')
+    progress_path = os.path.join(backfill_dir, 'progress.db')
+    min_datetime = datetime.utcnow() - timedelta(days=5, hours=1)
+    min_ts = c42api.create_filter_by_utc_datetime(min_datetime, min_datetime)['minTs']
 
-    def mock_storage_servers(authority, plan_uids=None, device_guid=None):
+    def backfill():
         """
-        Mock Func
+        Runs a backfill of two devices, checking that an event was written
+        for every window fetched, and returns its results
         """
-        return basic_server(), 1232
+        output_file = test_lib.WriteTester()
+        results = list(c42api.backfill_detection_events(basic_server(), ['1', '2'], cursor_path, progress_path,
+                                                        min_datetime=min_datetime, window=timedelta(days=1),
+                                                        max_windows=3, num_threads=3, out=output_file))
+        written = [json.loads(line) for line in ''.join(output_file.lines()).splitlines()]
+        assert sorted((event['deviceGuid'], event['event']) for event in written) == \
+            sorted((device_guid, min_ts) for device_guid, min_ts, _ in fetched)
+        return results
+    try:
+        failing.append(min_ts)
+        results = dict(backfill())
+        assert results == {'1': None, '2': None}
+        assert len(fetched) == 4
+        first_run = set(fetched)
 
-    c42api.security_event_restore._fetch_detection_events_for_device = mock_fetch_detection_events_for_device
-    c42api.security_event_restore._fetch_security_plan = mock_fetch_security_plan
-    c42api.security_event_restore.fetch_storage.storage_servers = mock_storage_servers
+        del failing[:]
+        del fetched[:]
+        results = dict(backfill())
+        assert len(fetched) == 2
+        assert not first_run.intersection(fetched)
+        assert all(minTs == min_ts for _, minTs, _ in fetched)
+        assert results['1'] and results['1'] == results['2']
+        assert max(max_ts for _, _, max_ts in first_run) == results['1']
 
-    for device_guid, cursor, detection_events in c42api.fetch_detection_events(basic_server(), guids_and_filters):
-        assert (device_guid in device_guids
-                and cursor == expected_results[str(device_guid)][0]
-                and detection_events == expected_results[str(device_guid)][1])
+        del fetched[:]
+        backfill()
+        assert len(fetched) == 6
+    finally:
+        c42api.security_event_restore._fetch_detection_events_for_device = original
+        shutil.rmtree(backfill_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+# Copyright (c) 2015 - 2016 Code42 Software, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tests for the storage_server module in the c42api module
+"""
+# pylint: disable=protected-access, unused-argument
+import json
+import time
+import requests
+
+import c42api
+from c42api import storage_server
+from c42api_test import test_lib
+
+
+class _Authority(c42api.Server):
+    """
+    An authority that hands out storage login tokens without touching the
+    network, and counts how often it is asked for one.
+    """
+    def __init__(self):
+        c42api.Server.__init__(self, 'test.com', '7777', 'testname', 'testword')
+        self.login_token_count = 0
+
+    def post(self, resource, payload=None, login_token=None):
+        """Answers a storage login token request"""
+        self.login_token_count += 1
+        data = {'serverUrl': 'https://node.test.com:4285', 'loginToken': 'token'}
+        return FakeResponse(json.dumps({'data': data}))
+
+
+def _mock_routes(func):
+    """
+    Decorator that mocks out pings, destinations and node auth, and hands the
+    test a list of every pinged url.
+    """
+    def wrapper():
+        """The wrapper function for the decorator to return"""
+        pinged = []
+
+        def mock_network_ping(node_url, session, **kwargs):
+            """Records the ping"""
+            pinged.append(node_url)
+
+        storage_server._network_ping = mock_network_ping
+        storage_server._fetch_all_destinations = lambda authority: [{'guid': 'dest', 'type': 'PROVIDER'}]
+        storage_server._request_auth_token = lambda server, login_token: 'auth-token'
+        func(pinged)
+    wrapper.__name__ = func.__name__
+    return test_lib.reload_modules_post_execution(storage_server)(wrapper)
+
+
+@_mock_routes
+def test_route_cache_reused_across_plans(pinged):
+    """Test that devices sharing a storage node ping and authenticate once"""
+    authority = _Authority()
+    storage_dict = {'url': 'https://node.test.com:4285'}
+    first = storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict)
+    second = storage_server._server_object_for_destination(authority, 'plan2', 'dest', storage_dict)
+    assert first is second
+    assert first.authorization == 'auth-token'
+    assert pinged == ['https://node.test.com:4285']
+    assert authority.login_token_count == 1
+
+    other = storage_server._server_object_for_destination(_Authority(), 'plan1', 'dest', storage_dict)
+    assert other is not first
+
+
+@_mock_routes
+def test_route_cache_invalidation(pinged):
+    """Test that a 401 or a connection error drops the cached node"""
+    authority = _Authority()
+    storage_dict = {'url': 'https://node.test.com:4285'}
+    first = storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict)
+
+    not_found = requests.HTTPError(response=FakeResponse('', status_code=404))
+    storage_server.invalidate_storage_server(first, not_found)
+    assert storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict) is first
+
+    unauthorized = requests.HTTPError(response=FakeResponse('', status_code=401))
+    storage_server.invalidate_storage_server(first, unauthorized)
+    second = storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict)
+    assert second is not first
+    assert authority.login_token_count == 2
+
+    storage_server.invalidate_storage_server(second, requests.ConnectionError())
+    storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict)
+    assert len(pinged) == 3
+
+
+@_mock_routes
+def test_unreachable_node_cached(pinged):
+    """Test that an unreachable node is not pinged again for every device"""
+    def failing_ping(node_url, session, **kwargs):
+        """Fails the ping"""
+        pinged.append(node_url)
+        raise requests.ConnectionError()
+    storage_server._network_ping = failing_ping
+    authority = _Authority()
+    storage_dict = {'url': 'https://node.test.com:4285'}
+    assert storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict) is None
+    assert storage_server._server_object_for_destination(authority, 'plan2', 'dest', storage_dict) is None
+    assert len(pinged) == 1
+    assert authority.login_token_count == 0
+
+    # The failure is forgotten well before a successful ping would be.
+    assert storage_server.FAILED_PING_TTL < storage_server.PING_TTL
+    now = time.time()
+    storage_server.time = _Clock(now + storage_server.FAILED_PING_TTL + 1)
+    storage_server._network_ping = lambda node_url, session, **kwargs: pinged.append(node_url)
+    assert storage_server._server_object_for_destination(authority, 'plan1', 'dest', storage_dict)
+    assert len(pinged) == 2
+
+
+class _Clock(object):
+    """Stands in for the time module, stopped at a given time"""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        """:return: The stopped time"""
+        return self.now
+
+
+def test_pool_fits_node_requests():
+    """Test that the shared connection pool keeps every node request's connection alive"""
+    server = c42api.Server('test.com', '4285')
+    adapter = server.session.get_adapter('https://test.com:4285')
+    assert adapter._pool_maxsize >= storage_server.NODE_MAX_IN_FLIGHT  # pylint: disable=protected-access
+
+
+# pylint: disable=too-few-public-methods
+class FakeResponse(object):
+    """A dummy response object that has relevant instance variables"""
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+if __name__ == '__main__':
+    test_lib.run_all_tests()
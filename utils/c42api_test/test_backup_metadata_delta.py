@@ -28,8 +28,12 @@ This script contains unit test code for the backup_metadata_delta component.
 import os
 import datetime
 import json
+import multiprocessing
+import shutil
+import tempfile
 
 import httpretty
+import requests
 import hypothesis
 
 from c42api import backup_metadata_delta
@@ -186,5 +190,252 @@ def test_calculate_delta_filtering():
     # Assert `delta` filtered one of the two versions in the response.
     assert len(delta) == 1
 
+
+@httpretty.activate
+@test_lib.disable_storage_server
+@test_lib.warning_to_null
+def test_calculate_fleet_delta_in_process():
+    """
+    Test that a fleet delta downloads each device's metadata and yields the
+    same events calculate_delta does, tagged with each deviceGuid.
+
+    :raise AssertionError: Events are missing or mislabelled.
+    """
+    minimum_date = datetime.datetime(2015, 8, 14)
+    maximum_date = datetime.datetime(2015, 8, 15)
+    metadata_response = RESPONSE_DATA["test_calculate_delta_event_structure"]
+
+    httpretty.register_uri(httpretty.POST, _api_url(resources.DATA_KEY_TOKEN),
+                           body='{"data":{"dataKeyToken":""}}', content_type='application/json')
+    for device_guid in (1234, 5678):
+        httpretty.register_uri(httpretty.GET, _api_url([resources.ARCHIVE_METADATA, device_guid]),
+                               body=json.dumps(metadata_response), content_type='application/json')
+
+    expected = list(backup_metadata_delta.calculate_delta(SERVER, 1234, minimum_date, maximum_date))
+    delta = list(backup_metadata_delta.calculate_fleet_delta(SERVER, [1234, 5678], minimum_date, maximum_date,
+                                                             num_threads=1, num_processes=0))
+
+    assert len(delta) == 2 * len(expected)
+    assert sorted(event['deviceGuid'] for event in delta) == [1234] * len(expected) + [5678] * len(expected)
+    assert [event for event in delta if event['deviceGuid'] == 1234] == expected
+
+
+@test_lib.reload_modules_post_execution(backup_metadata_delta)
+def test_calculate_fleet_delta_worker_processes():
+    """
+    Test that a fleet delta parses metadata in worker processes, keeping each
+    device's events sorted by path.
+
+    :raise AssertionError: Events are missing or out of order.
+    """
+    def fake_download(_, device_guid, tmp_dir):
+        """Writes a small archive of versions for the device"""
+        if device_guid == 3:
+            return None
+        versions = [{'path': '/f%d' % (9 - i), 'versionTimestamp': '2015-08-14T13:22:10.750-05:00',
+                     'fileType': 0, 'sourceLength': i, 'sourceChecksum': 'abc', 'timestamp': i}
+                    for i in range(10)]
+        path = os.path.join(tmp_dir, 'device-%d.json' % device_guid)
+        with open(path, 'wb') as metadata_file:
+            json.dump({'data': versions}, metadata_file)
+        return path
+
+    backup_metadata_delta._download_archive_metadata = fake_download
+    delta = list(backup_metadata_delta.calculate_fleet_delta(SERVER, [1, 2, 3], datetime.datetime(2015, 8, 14),
+                                                             datetime.datetime(2015, 8, 15), num_threads=2,
+                                                             num_processes=2, sort_buffer_size=3))
+
+    for device_guid in (1, 2):
+        paths = [event['files'][0]['fullPath'] for event in delta if event['deviceGuid'] == device_guid]
+        assert paths == ['/f%d' % i for i in range(10)]
+    assert len(delta) == 20
+
+    # A pool the caller created is used, and left running.
+    pool = multiprocessing.Pool(2)
+    try:
+        delta = list(backup_metadata_delta.calculate_fleet_delta(SERVER, [1, 2, 3], datetime.datetime(2015, 8, 14),
+                                                                 datetime.datetime(2015, 8, 15), num_threads=2,
+                                                                 sort_buffer_size=3, pool=pool))
+        assert len(delta) == 20
+        assert pool.apply(len, ('still running',)) == 13
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+@test_lib.reload_modules_post_execution(backup_metadata_delta)
+def test_calculate_fleet_delta_download_failure():
+    """
+    Test that a device whose metadata fails to download is skipped, while
+    the other devices' events are still yielded.
+
+    :raise AssertionError: The failure stopped the other devices.
+    """
+    def fake_download(_, device_guid, tmp_dir):
+        """Fails for device 2, and writes one version for the rest"""
+        if device_guid == 2:
+            raise requests.ConnectionError("Storage server unreachable")
+        versions = [{'path': '/f', 'versionTimestamp': '2015-08-14T13:22:10.750-05:00',
+                     'fileType': 0, 'sourceLength': 1, 'sourceChecksum': 'abc', 'timestamp': 1}]
+        path = os.path.join(tmp_dir, 'device-%d.json' % device_guid)
+        with open(path, 'wb') as metadata_file:
+            json.dump({'data': versions}, metadata_file)
+        return path
+
+    backup_metadata_delta._download_archive_metadata = fake_download
+    delta = list(backup_metadata_delta.calculate_fleet_delta(SERVER, [1, 2, 3], datetime.datetime(2015, 8, 14),
+                                                             datetime.datetime(2015, 8, 15), num_threads=1,
+                                                             num_processes=0))
+
+    assert sorted(event['deviceGuid'] for event in delta) == [1, 3]
+
+
+def _version(path, minute, mtime=None, checksum='6666cd76f96956469e7be39d750cc7d9', length=5, deleted=False):
+    """
+    A minimal file version, backed up at the given minute past 13:00 and
+    last modified at mtime, which defaults to the minute
+    """
+    version = {'path': path, 'versionTimestamp': '2015-08-14T13:%02d:10.750-05:00' % minute,
+               'timestamp': minute if mtime is None else mtime,
+               'fileType': 0, 'sourceLength': length, 'sourceChecksum': checksum}
+    if deleted:
+        version['checksum'] = backup_metadata_delta.DELETED_CHECKSUM
+    return version
+
+
+@httpretty.activate
+@test_lib.disable_storage_server
+@test_lib.warning_to_null
+def test_calculate_incremental_delta():
+    """
+    Test that each run only yields versions backed up and changed since the
+    last one.
+
+    :raise AssertionError: Old or unchanged versions were yielded.
+    """
+    device_guid = 1234
+    first = [_version('/a', 1), _version('/b', 2)]
+    second = first + [_version('/a', 3, length=6), _version('/b', 4), _version('/c', 5)]
+    third = second + [_version('/c', 6, length=0, deleted=True)]
+    # A new version of a file restored with an old modification time.
+    fourth = third + [_version('/a', 7, mtime=0, checksum='0' * 32)]
+
+    httpretty.register_uri(httpretty.POST, _api_url(resources.DATA_KEY_TOKEN),
+                           body='{"data":{"dataKeyToken":""}}', content_type='application/json')
+    httpretty.register_uri(httpretty.GET, _api_url([resources.ARCHIVE_METADATA, device_guid]),
+                           responses=[httpretty.Response(body=json.dumps({'data': versions}), status=200)
+                                      for versions in (first, second, third, fourth, fourth)])
+    snapshot_dir = tempfile.mkdtemp()
+    try:
+        def run():
+            """:return: The (path, event type, timestamp) of each event from an incremental run"""
+            delta = backup_metadata_delta.calculate_incremental_delta(SERVER, device_guid, snapshot_dir,
+                                                                      sort_buffer_size=2)
+            return sorted((event['files'][0]['fullPath'], event['eventType'], event['timestamp'])
+                          for event in delta)
+
+        assert run() == [('/a', 'BACKUP_FILE_ACTIVITY', 1), ('/b', 'BACKUP_FILE_ACTIVITY', 2)]
+        # /b's new version repeats its checksum and length, so it isn't a change.
+        assert run() == [('/a', 'BACKUP_FILE_ACTIVITY', 3), ('/c', 'BACKUP_FILE_ACTIVITY', 5)]
+        assert run() == [('/c', 'BACKUP_FILE_DELETED', 6)]
+        assert run() == [('/a', 'BACKUP_FILE_ACTIVITY', 0)]
+        assert run() == []
+    finally:
+        shutil.rmtree(snapshot_dir)
+
+
+@httpretty.activate
+@test_lib.disable_storage_server
+@test_lib.warning_to_null
+def test_calculate_incremental_delta_clock_changes():
+    """
+    Test that versions backed up after a daylight saving change, or in the
+    same millisecond as the last run's newest version, are still yielded.
+
+    :raise AssertionError: A new version was skipped.
+    """
+    device_guid = 1234
+
+    def version(path, timestamp):
+        """A version of path backed up at timestamp"""
+        version = _version(path, 0)
+        version['versionTimestamp'] = timestamp
+        return version
+    first = [version('/a', '2015-11-01T01:50:00.000-05:00')]
+    # The clocks went back an hour, so this is later than /a.
+    second = first + [version('/b', '2015-11-01T01:10:00.000-06:00')]
+    # Backed up in the same millisecond as /b, but only listed since.
+    third = second + [version('/c', '2015-11-01T01:10:00.000-06:00')]
+
+    httpretty.register_uri(httpretty.POST, _api_url(resources.DATA_KEY_TOKEN),
+                           body='{"data":{"dataKeyToken":""}}', content_type='application/json')
+    httpretty.register_uri(httpretty.GET, _api_url([resources.ARCHIVE_METADATA, device_guid]),
+                           responses=[httpretty.Response(body=json.dumps({'data': versions}), status=200)
+                                      for versions in (first, second, third, third)])
+    snapshot_dir = tempfile.mkdtemp()
+    try:
+        def run():
+            """:return: The paths of the events from an incremental run"""
+            return sorted(event['files'][0]['fullPath'] for event in
+                          backup_metadata_delta.calculate_incremental_delta(SERVER, device_guid, snapshot_dir))
+
+        assert run() == ['/a']
+        assert run() == ['/b']
+        assert run() == ['/c']
+        assert run() == []
+    finally:
+        shutil.rmtree(snapshot_dir)
+
+
+_DATETIMES = hypothesis.strategies.builds(
+    lambda micros: datetime.datetime(1900, 1, 1) + datetime.timedelta(microseconds=micros),
+    hypothesis.strategies.integers(0, 200 * 365 * 24 * 3600 * 10 ** 6))
+
+
+@hypothesis.given(_DATETIMES, _DATETIMES, _DATETIMES,
+                  hypothesis.strategies.sampled_from(['-05:00', '+09:30', 'Z', '']))
+def test_timestamp_filter_matches_dateutil(min_date, max_date, version_date, offset):
+    """
+    Test that the fixed format timestamp filter agrees with parsing each
+    timestamp with dateutil and comparing its wall clock time.
+
+    :raise AssertionError: The two filters disagree.
+    """
+    from dateutil import parser
+    timestamp = version_date.strftime('%Y-%m-%dT%H:%M:%S.') + '%03d' % (version_date.microsecond // 1000) + offset
+    expected = min_date < parser.parse(timestamp).replace(tzinfo=None) < max_date
+    assert backup_metadata_delta.timestamp_filter(min_date, max_date)(timestamp) == expected
+
+
+@hypothesis.given(_DATETIMES, hypothesis.strategies.sampled_from(['-05:00', '+0930', 'Z', '']))
+def test_version_time_matches_dateutil(version_date, offset):
+    """
+    Test that a versionTimestamp's time agrees with parsing it with dateutil
+    and converting it to UTC.
+
+    :raise AssertionError: The two times disagree.
+    """
+    from dateutil import parser
+    import calendar
+    timestamp = version_date.strftime('%Y-%m-%dT%H:%M:%S.') + '%03d' % (version_date.microsecond // 1000) + offset
+    parsed = parser.parse(timestamp)
+    expected = calendar.timegm(parsed.utctimetuple()) * 1000 + parsed.microsecond // 1000
+    assert backup_metadata_delta._version_time(timestamp) == expected
+    assert backup_metadata_delta._version_time(timestamp.replace('T', ' ')) == expected
+
+
+def test_timestamp_filter_falls_back_to_dateutil():
+    """
+    Test that timestamps in other formats are still filtered.
+
+    :raise AssertionError: An unusual timestamp was filtered incorrectly.
+    """
+    in_range = backup_metadata_delta.timestamp_filter(datetime.datetime(2015, 8, 14),
+                                                      datetime.datetime(2015, 8, 15))
+    assert in_range('2015-08-14 13:22:10')
+    assert in_range('Aug 14 2015 1:22PM')
+    assert not in_range('2015-08-15T00:00:00.000001-05:00')
+
+
 if __name__ == "__main__":
     test_lib.run_all_tests()
@@ -46,6 +46,12 @@ class WriteTester(object):
         """
         self.line_list.append(text)
 
+    def flush(self):
+        """
+        Nothing is buffered, so there is nothing to flush.
+        """
+        pass
+
     def lines(self):
         """
         :return: The list of string "lines" that were "written".
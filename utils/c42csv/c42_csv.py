@@ -24,6 +24,12 @@ This module is designed to help make CSV files out of JSON-style data.
 
 # pylint: disable=superfluous-parens
 import json
+import re
+
+# The characters that mean a csv value has to be quoted.
+_NEEDS_QUOTES = re.compile(u'[\r\n,"]')
+# The same, less the separator, for checking a whole row at once.
+_ROW_NEEDS_QUOTES = re.compile(u'[\r\n"]')
 
 class KeySet(object):
     """KeySet behaves like a set of Keys that merges appropriately
@@ -31,9 +37,13 @@ class KeySet(object):
     keys to Keys so when a potentially new key is added it merges the
     old key with it if need be. It also supports a union operator
     which generates a new KeySet with all keys appropriately merged.
+
+    Once every key has been added a KeySet can be frozen, after which
+    the RowPlan for writing rows with it is only compiled once.
     """
     def __init__(self):
         self.keys = {}
+        self._plans = None
 
     def add_key(self, new_key):
         """Add a Key object to this KetSet. Will attempt to merge
@@ -42,6 +52,8 @@ class KeySet(object):
         Keyword arguments:
         new_key -- the Key object to add
         """
+        if self.frozen:
+            raise ValueError("Can't add key '{}' to a frozen KeySet".format(new_key.key))
         try:
             val = self.keys[new_key.key]
             new_key.merge_keys(val)
@@ -69,6 +81,34 @@ class KeySet(object):
         for key in sorted_keys:
             yield self.keys[key]
 
+    @property
+    def frozen(self):
+        """Whether keys can no longer be added"""
+        return self._plans is not None
+
+    def freeze(self):
+        """Stop any more keys from being added, so the plans compiled
+        for this KeySet can be reused. Returns the KeySet.
+        """
+        if self._plans is None:
+            self._plans = {}
+        return self
+
+    def plan(self, shallow=False):
+        """Return a RowPlan for writing rows with this KeySet. A frozen
+        KeySet compiles each plan once and hands back the same one after.
+
+        Keyword arguments:
+        shallow -- bool value of whether or not to shallow parse.
+        """
+        if not self.frozen:
+            return RowPlan(self, shallow)
+        try:
+            return self._plans[shallow]
+        except KeyError:
+            plan = self._plans[shallow] = RowPlan(self, shallow)
+            return plan
+
     def __len__(self):
         return len(list(self.keys.keys()))
 
@@ -106,6 +146,122 @@ class Key(object):
         self.subkeys = self.subkeys.union(other.subkeys)
 
 
+class RowPlan(object):
+    """A KeySet compiled into a tree of the keys that make up each csv
+    column, with the flattened header worked out ahead of time. Each
+    row is then made in one pass over the tree and one join, rather
+    than by walking the KeySet again.
+
+    Every row has exactly one value per header column. Where a key is
+    missing, a list is empty or a value that should be a dictionary
+    isn't one, its columns are empty.
+    """
+    def __init__(self, keyset, shallow=False, order=None):
+        """
+        :param keyset:  The KeySet to compile
+        :param shallow: Whether only the top level keys are columns, with
+                        dictionaries and lists written as json
+        :param order:   The index, in sorted key order, of each column to
+                        write, or None to write them all in sorted order
+        """
+        self.header = []
+        for key in keyset.all_keys():
+            self.header = flattened_keys(key, self.header)
+        self._order = order
+        if order is not None:
+            self.header = [self.header[index] for index in order]
+        self._shallow = shallow
+        if shallow:
+            self._plan = tuple(key.key for key in keyset.all_keys())
+        else:
+            self._plan = tuple(_compile_key(key) for key in keyset.all_keys())
+
+    def header_string(self):
+        """Return the csv header row"""
+        return ",".join(self.header)
+
+    def values(self, item):
+        """Return the value for each column of the given dictionary
+
+        Keyword arguments:
+        item -- the dictionary to make a row from
+        """
+        if self._shallow:
+            values = [item.get(key, "") for key in self._plan]
+        else:
+            values = []
+            _extract_values(item, self._plan, values)
+        if self._order is not None:
+            values = [values[index] for index in self._order]
+        return values
+
+    def csv_string(self, item):
+        """Return the csv row for the given dictionary
+
+        Keyword arguments:
+        item -- the dictionary to make a row from
+        """
+        strings = [value if isinstance(value, unicode) else _string_value(value)
+                   for value in self.values(item)]
+        row = u",".join(strings)
+        # Most rows need no quoting, which shows as no extra separators.
+        if row.count(u",") != len(strings) - 1 or _ROW_NEEDS_QUOTES.search(row):
+            row = u",".join([_csv_value(value) for value in strings])
+        return row
+
+
+def _compile_key(key):
+    """Return a (key string, compiled subkeys, column count) tuple for a
+    Key. A Key with no subkeys is a single column, and has None for its
+    compiled subkeys.
+
+    Keyword arguments:
+    key -- Key object to compile
+    """
+    if not key.subkeys:
+        return key.key, None, 1
+    subkeys = tuple(_compile_key(subkey) for subkey in key.subkeys.all_keys())
+    return key.key, subkeys, sum(width for _, _, width in subkeys)
+
+
+def _extract_values(value, plan, values):
+    """Append the value for each column of a compiled plan. A list
+    stands for its first item, as in values_for_keys.
+
+    Keyword arguments:
+    value -- the dictionary to take values from, or anything else if
+    its columns should be empty
+    plan -- tuple of compiled keys, from _compile_key
+    values -- list to append each value to
+    """
+    is_dict = isinstance(value, dict)
+    for key, subkeys, width in plan:
+        child = value.get(key, "") if is_dict else ""
+        while isinstance(child, list):
+            child = child[0] if child else ""
+        if subkeys is None:
+            values.append(child)
+        elif isinstance(child, dict):
+            _extract_values(child, subkeys, values)
+        else:
+            values.extend([""] * width)
+
+
+def _string_value(value):
+    """Return a single value as a string, dictionaries and lists as json."""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return unicode(value)
+
+
+def _csv_value(value):
+    """Return a single value as it's written in a csv row."""
+    string_value = value if isinstance(value, unicode) else _string_value(value)
+    if _NEEDS_QUOTES.search(string_value):
+        string_value = '"' + string_value.replace('"', '""') + '"'
+    return string_value
+
+
 def _print_key_hierarchy(key, depth=0):
     """DEBUG: print the given Key object's key and each of its
     subkeys (one key per line). Hierarchy shown with indentation.
@@ -270,14 +426,4 @@ def create_csv_string(value_list):
     Keyword arguments:
     value_list -- List of values to turn into strings and make into .csv file row
     """
-    csvpieces = []
-    for value in value_list:
-        if isinstance(value, dict) or isinstance(value, list):
-            string_value = json.dumps(value)
-        else:
-            string_value = unicode(value)
-        if any((c in string_value) for c in ['\r', '\n', ',', '"']):
-            string_value = string_value.replace('"', '""')
-            string_value = '"' + string_value + '"'
-        csvpieces.append(string_value)
-    return ",".join(csvpieces)
+    return ",".join([_csv_value(value) for value in value_list])
@@ -23,16 +23,198 @@ A module with common functions for writing Splunk lookup tables.
 """
 
 # pylint: disable=import-error, relative-import
+import hashlib
+import itertools
+import json
 import os
 import shutil
+import sqlite3
 import csv as pycsv
 
 from c42api.common import script_common
 from c42api.common import script_output
 from c42csv import c42_csv as csv
 
+# Bumped whenever the row hash changes, so an index of old hashes is rebuilt.
+HASH_VERSION = 2
 
-def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, time_key=None):
+
+class _LookupIndex(object):
+    """
+    A sidecar index of a lookup table, backed by SQLite. It holds the hash of
+    every (uid, row) in the table, along with the table's header, size and
+    modification time when the index was last updated, so a run can tell which
+    rows are new without reading the table.
+    """
+    def __init__(self, path):
+        """
+        :param path: The path of the SQLite database
+        """
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS row_hash '
+                                     '(uid TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (uid, hash))')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def header(self, table_path):
+        """
+        :param table_path: The path of the lookup table the index is for
+        :return:           The table's header as a list of columns, or None if
+                            the index does not match the table
+        """
+        meta = dict(self._connection.execute('SELECT key, value FROM meta').fetchall())
+        try:
+            if meta.get('hash_version') != str(HASH_VERSION) or meta['stat'] != _stat_string(table_path):
+                return None
+            return json.loads(meta['header'])
+        except (KeyError, ValueError, OSError):
+            return None
+
+    def contains(self, uid, row_hash):
+        """
+        :return: True if the table has a row for uid with row_hash
+        """
+        return self._connection.execute('SELECT 1 FROM row_hash WHERE uid = ? AND hash = ?',
+                                        (unicode(uid), str(row_hash))).fetchone() is not None
+
+    def add(self, uid, row_hash):
+        """
+        Records a row appended to the table. It is committed by commit().
+        """
+        self._connection.execute('INSERT OR IGNORE INTO row_hash (uid, hash) VALUES (?, ?)',
+                                 (unicode(uid), str(row_hash)))
+
+    def commit(self, table_path, header):
+        """
+        Commits every added row along with the table's current header, size
+        and modification time. Must only be called once the table has been written and closed.
+
+        :param table_path: The path of the lookup table the index is for
+        :param header:     The table's header as a list of columns
+        """
+        meta = [('hash_version', str(HASH_VERSION)),
+                ('stat', _stat_string(table_path)),
+                ('header', json.dumps(header))]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', meta)
+
+    def rebuild(self, table_path, header, hash_map):
+        """
+        Replaces the index with the hashes of a rewritten table.
+
+        :param table_path: The path of the lookup table the index is for
+        :param header:     The table's header as a list of columns
+        :param hash_map:   A dictionary of uid -> set of row hashes
+        """
+        with self._connection:
+            self._connection.execute('DELETE FROM row_hash')
+            self._connection.execute('DELETE FROM meta')
+        for uid, hashes in hash_map.items():
+            for row_hash in hashes:
+                self.add(uid, row_hash)
+        self.commit(table_path, header)
+
+    def close(self):
+        """
+        Closes the underlying database, discarding anything not committed.
+        """
+        self._connection.close()
+
+
+def _stat_string(path):
+    """
+    :return: A string of a file's size and modification time, which changes
+              whenever the file is written
+    """
+    stat = os.stat(path)
+    return '{0}:{1!r}'.format(stat.st_size, stat.st_mtime)
+
+
+def _canonical_value(value):
+    """
+    :return: The unicode string a value is written to a lookup table as, with
+              dictionaries and lists serialized with sorted keys. Strings of
+              a JSON dictionary or list, as the table holds them, are decoded
+              first, so they match whatever the csv writer serialized them
+              with.
+    """
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if isinstance(value, unicode) and value[:1] in (u'[', u'{'):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            decoded = None
+        if isinstance(decoded, (dict, list)):
+            value = decoded
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return unicode(value)
+
+
+def fingerprint_row(row, keys_to_ignore=()):
+    """
+    Return a stable fingerprint of a lookup table row, ignoring given keys.
+
+    Unlike hash(), the fingerprint covers nested dictionaries and lists, and
+    is the same across processes and interpreters, so it may be stored and
+    compared across runs. Values are compared as they are written to the
+    lookup table, so a row read back from the table has the same fingerprint
+    as the json dictionary it was written from, and an empty value is the same
+    as a missing one.
+
+    :param row:            The dictionary to fingerprint
+    :param keys_to_ignore: List of keys to ignore when fingerprinting
+    :return:               A 128 bit fingerprint as a hex string
+    """
+    pairs = []
+    for key, value in row.items():
+        if key in keys_to_ignore:
+            continue
+        value = _canonical_value(value)
+        if value:
+            pairs.append((_canonical_value(key), value))
+    pairs.sort()
+    canonical = json.dumps(pairs, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
+
+def _append_lookup_rows(old_path, index, header, json_iter, uid_key, keys_to_ignore):
+    # pylint: disable=too-many-arguments
+    """
+    Append the rows that are not in the index to a lookup table, without
+    reading the table. Stops at the first row with a column the table does not
+    have, as adding a column means rewriting the table.
+
+    :param old_path:       Path to the lookup table to append to.
+    :param index:          The _LookupIndex of the lookup table.
+    :param header:         The lookup table's header as a list of columns.
+    :param json_iter:      Iterator of json objects to append.
+    :param uid_key:        The key in the json dictionary pointing to the
+                            object's unique identifier.
+    :param keys_to_ignore: List of keys to ignore when hashing the row
+                            dictionaries.
+    :return:               The json dictionary with a new column, or None if
+                            every row was appended.
+    """
+    key_set = csv.KeySet()
+    for column in header:
+        key_set.add_key(csv.create_key(column, None, shallow=True))
+    key_set.freeze()
+    columns = set(header)
+    with open(old_path, 'a') as old:
+        for json_dict in json_iter:
+            if not columns.issuperset(json_dict):
+                return json_dict
+            json_hash = fingerprint_row(json_dict, keys_to_ignore)
+            uid = json_dict[uid_key]
+            if not index.contains(uid, json_hash):
+                script_output.write_csv(old, [json_dict], header=False, shallow=True, keyset=key_set)
+                index.add(uid, json_hash)
+    return None
+
+
+def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, time_key=None, index_path=None):
     # pylint: disable=too-many-arguments
     """
     Write a Splunk lookup table. Will overwrite an already-existing lookup
@@ -41,6 +223,12 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
 
     New rows will only be added to the lookup table if they have a different
     hash value than already-existing rows in the lookup table.
+
+    If index_path is given, the hashes of the table's rows are kept in an index
+    there, and new rows are appended to the table rather than rewriting it, so
+    a run only does I/O for the rows that changed. The table is only rewritten
+    (and the index rebuilt) when a row has a column the table doesn't, or when
+    the index no longer matches the table.
     :param old_path:       Path to old lookup table. If no lookup table already
                             exists, this is the path to where the final lookup
                             table should go.
@@ -53,6 +241,7 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
                             dictionaries.
     :param time_key:       The key in the json dictionary pointing to the
                             object's time value, used by the lookup table.
+    :param index_path:     Optional path to the lookup table's index.
     """
 
     def hash_in_map(hash_to_check, hash_map, uid):
@@ -83,24 +272,6 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
         else:
             hash_map[uid] = {hash_to_add}
 
-    def hash_dictionary(dict_to_hash):
-        """
-        Return the hash value of a dictionary, ignoring given keys when hashing.
-
-        :param dict_to_hash: The dictionary to hash
-        :return:             A hash value of the dictionary
-        """
-        prime = 31
-        result = 1
-        for key, value in dict_to_hash.items():
-            if key in keys_to_ignore:
-                continue
-            try:
-                result = prime * result + hash(value)
-            except TypeError:
-                continue
-        return result
-
     def write_lookup_row(out, json_dict, key_set, hash_map):
         """
         Write a row to the given lookup table if it should (based on hashes).
@@ -111,22 +282,25 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
         :param hash_map:  Hash map to check to see if the row should be
                            written.
         """
-        json_hash = hash_dictionary(json_dict)
+        json_hash = fingerprint_row(json_dict, keys_to_ignore)
         uid = json_dict[uid_key]
         if not hash_in_map(json_hash, hash_map, uid):
             script_output.write_csv(out, [json_dict], header=False, shallow=True, keyset=key_set)
             add_hash_to_map(json_hash, hash_map, uid)
 
-    def _run():
+    def _run(json_iter):
         """
         Run the function.
+
+        :return: The header and hash map of the written table, or None if
+                  nothing was written.
         """
         with script_common.smart_open(tmp_path) as tmp:
             key_set = csv.KeySet()
             hash_map = {}
             wrote_header = False
             modify_time = False
-            for json_dict in json_list:
+            for json_dict in json_iter:
                 if not key_set:
                     for key, value in json_dict.items():
                         json_key = csv.create_key(key, value, shallow=True)
@@ -140,6 +314,7 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
                                     for key, value in row.items():
                                         json_key = csv.create_key(key, value, shallow=True)
                                         key_set.add_key(json_key)
+                                    key_set.freeze()
                                     script_output.write_header_from_keyset(key_set, tmp)
                                     wrote_header = True
                                     first = False
@@ -147,6 +322,7 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
                     except IOError:
                         modify_time = time_key or modify_time
                 if not wrote_header:
+                    key_set.freeze()
                     script_output.write_header_from_keyset(key_set, tmp)
                     wrote_header = True
                 if modify_time:
@@ -156,7 +332,26 @@ def write_lookup_table(old_path, tmp_path, json_list, uid_key, keys_to_ignore, t
             os.remove(old_path)
         if key_set:
             shutil.move(tmp_path, old_path)
-        else:
-            os.remove(tmp_path)
+            return [key.key for key in key_set.all_keys()], hash_map
+        os.remove(tmp_path)
+        return None
+
+    json_iter = iter(json_list)
+    if not index_path:
+        _run(json_iter)
+        return
 
-    _run()
+    index = _LookupIndex(index_path)
+    try:
+        header = index.header(old_path) if os.path.exists(old_path) else None
+        if header:
+            new_column_dict = _append_lookup_rows(old_path, index, header, json_iter, uid_key, keys_to_ignore)
+            index.commit(old_path, header)
+            if new_column_dict is None:
+                return
+            json_iter = itertools.chain([new_column_dict], json_iter)
+        written = _run(json_iter)
+        if written:
+            index.rebuild(old_path, *written)
+    finally:
+        index.close()
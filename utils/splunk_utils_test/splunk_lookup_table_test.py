@@ -23,7 +23,9 @@ Tests for the Splunk lookup table functions
 """
 # pylint: disable=invalid-name, import-error
 
+import csv
 import os
+import shutil
 import tempfile
 
 from c42api_test import test_lib
@@ -260,5 +262,116 @@ def test_initial_lookup_time_extra_rows():
         assert lines[2].split(',') == ['nick', '12345', 'james', '2015-08-27\n']
     os.remove(old_lookup_table)
 
+
+def _write_indexed(lookup_dir, data):
+    """
+    Write the lookup table in lookup_dir with an index.
+
+    :return: The lines of the lookup table
+    """
+    old_lookup_table = os.path.join(lookup_dir, 'old.csv')
+    splunk_lookup_table.write_lookup_table(old_lookup_table, os.path.join(lookup_dir, 'tmp.csv'), data, 'id',
+                                           ['time'], index_path=os.path.join(lookup_dir, 'index.db'))
+    with open(old_lookup_table, 'r') as new:
+        return new.readlines()
+
+
+def test_indexed_lookup_appends():
+    """
+    Test that with an index, changed rows are appended without rewriting the
+    lookup table.
+    """
+    lookup_dir = tempfile.mkdtemp()
+    try:
+        _write_indexed(lookup_dir, [{'first': 'nick', 'last': 'wallin', 'id': '12345', 'time': 'now'},
+                                    {'first': 'carl', 'last': 'benson', 'id': '11223', 'time': 'now'}])
+        old_lookup_table = os.path.join(lookup_dir, 'old.csv')
+        inode = os.stat(old_lookup_table).st_ino
+        lines = _write_indexed(lookup_dir, [{'first': 'nick', 'last': 'wallin', 'id': '12345', 'time': 'later'},
+                                            {'first': 'carl', 'last': 'james', 'id': '11223', 'time': 'later'}])
+        assert os.stat(old_lookup_table).st_ino == inode
+        assert [line.split(',') for line in lines] == [['first', 'id', 'last', 'time\n'],
+                                                       ['nick', '12345', 'wallin', 'now\n'],
+                                                       ['carl', '11223', 'benson', 'now\n'],
+                                                       ['carl', '11223', 'james', 'later\n']]
+        assert not os.path.exists(os.path.join(lookup_dir, 'tmp.csv'))
+    finally:
+        shutil.rmtree(lookup_dir)
+
+
+def test_indexed_lookup_new_column():
+    """
+    Test that with an index, a row with a new column rewrites the lookup table.
+    """
+    lookup_dir = tempfile.mkdtemp()
+    try:
+        _write_indexed(lookup_dir, [{'first': 'nick', 'id': '12345'}])
+        lines = _write_indexed(lookup_dir, [{'first': 'carl', 'id': '11223'},
+                                            {'first': 'nick', 'id': '12345', 'last': 'wallin'},
+                                            {'first': 'carl', 'id': '11223'}])
+        assert [line.split(',') for line in lines] == [['first', 'id', 'last\n'],
+                                                       ['nick', '12345', '\n'],
+                                                       ['carl', '11223', '\n'],
+                                                       ['nick', '12345', 'wallin\n']]
+        lines = _write_indexed(lookup_dir, [{'first': 'nick', 'id': '12345', 'last': 'wallin'}])
+        assert len(lines) == 4
+    finally:
+        shutil.rmtree(lookup_dir)
+
+
+def test_indexed_lookup_out_of_date():
+    """
+    Test that an index that no longer matches its lookup table is rebuilt.
+    """
+    lookup_dir = tempfile.mkdtemp()
+    try:
+        _write_indexed(lookup_dir, [{'first': 'nick', 'id': '12345'}])
+        with open(os.path.join(lookup_dir, 'old.csv'), 'w') as old:
+            old.write('first,id\ncarl,112233\n')
+        lines = _write_indexed(lookup_dir, [{'first': 'nick', 'id': '12345'}])
+        assert lines == ['first,id\n', 'carl,112233\n', 'nick,12345\n']
+    finally:
+        shutil.rmtree(lookup_dir)
+
+
+def test_fingerprint_row():
+    """
+    Test that row fingerprints cover nested values, honour ignored keys and
+    match a row read back from the lookup table.
+    """
+    row = {'id': 12345, 'roles': ['admin', 'user'], 'active': True, 'time': 'now'}
+    fingerprint = splunk_lookup_table.fingerprint_row(row, ['time'])
+    assert fingerprint == splunk_lookup_table.fingerprint_row(dict(row, time='later'), ['time'])
+    assert fingerprint != splunk_lookup_table.fingerprint_row(dict(row, roles=['admin']), ['time'])
+    assert fingerprint != splunk_lookup_table.fingerprint_row(row)
+    assert splunk_lookup_table.fingerprint_row({'settings': {'a': 1, 'b': 2}}) == \
+        splunk_lookup_table.fingerprint_row({'settings': {'b': 2, 'a': 1}})
+
+    assert splunk_lookup_table.fingerprint_row({'name': u'\xe9'}) == \
+        splunk_lookup_table.fingerprint_row({'name': u'\xe9'.encode('utf-8')})
+    assert splunk_lookup_table.fingerprint_row({'id': '1'}) == '52566f15c41080c27b4795970a886823'
+
+
+def test_fingerprint_row_round_trip():
+    """
+    Test that a row read back from the lookup table has the same fingerprint
+    as the json dictionary it was written from, so an unchanged row isn't
+    appended again.
+    """
+    lookup_dir = tempfile.mkdtemp()
+    try:
+        row = {'id': '12345', 'roles': ['admin', 'user'], 'settings': {'b': [1, 2], 'a': u'\xe9'},
+               'active': True, 'time': 'now'}
+        _write_indexed(lookup_dir, [row])
+        with open(os.path.join(lookup_dir, 'old.csv'), 'r') as lookup_table:
+            csv_rows = list(csv.DictReader(lookup_table))
+        assert len(csv_rows) == 1
+        assert splunk_lookup_table.fingerprint_row(csv_rows[0], ['time']) == \
+            splunk_lookup_table.fingerprint_row(row, ['time'])
+        lines = _write_indexed(lookup_dir, [dict(row, time='later')])
+        assert len(lines) == 2
+    finally:
+        shutil.rmtree(lookup_dir)
+
 if __name__ == '__main__':
     test_lib.run_all_tests()